@@ -14,14 +14,15 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
 django.setup()  # initialize Django before importing any apps
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 import chat.routing
+from chat.middleware import JWTAuthMiddleware
 
 
 # application = get_asgi_application()
 application = ProtocolTypeRouter(
     {
         "http": get_asgi_application(),
-        "websocket": AuthMiddlewareStack(URLRouter(chat.routing.websocket_urlpatterns)),
+        # websockets authenticate with the app's JWT, see chat.middleware
+        "websocket": JWTAuthMiddleware(URLRouter(chat.routing.websocket_urlpatterns)),
     }
 )
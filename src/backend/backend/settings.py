@@ -29,6 +29,11 @@ EMAIL_USE_TLS = os.getenv("EMAIL_USE_TLS")
 EMAIL_HOST_USER = os.getenv("EMAIL_HOST_USER")
 EMAIL_HOST_PASSWORD = os.getenv("EMAIL_HOST_PASSWORD")
 DEFAULT_FROM_EMAIL = os.getenv("DEFAULT_FROM_EMAIL")
+# mail is sent by a background thread over one SMTP connection (False sends it in the
+# committing thread), see otpauth.mailer
+EMAIL_WORKER = os.getenv("EMAIL_WORKER", "true").lower() == "true"
+EMAIL_RETRIES = 3  # retries of a failed message, after the rest of the queue, before dropping it
+EMAIL_RETRY_BACKOFF = 2  # seconds before the first retry, doubled for every next one
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.1/howto/deployment/checklist/
@@ -103,6 +108,27 @@ AWS_DEFAULT_ACL = None
 
 DEFAULT_FILE_STORAGE = "storages.backends.s3boto3.S3Boto3Storage"
 
+# threads resizing uploaded images in the background (0 resizes them in the request thread)
+IMAGE_RENDITION_WORKERS = int(os.getenv("IMAGE_RENDITION_WORKERS", 2))
+# images are uploaded straight to storage with presigned URLs (see items.uploads)
+IMAGE_UPLOAD_MAX_SIZE = 15 * 1024 * 1024  # bytes
+IMAGE_UPLOAD_EXPIRY = 15 * 60  # seconds an upload URL stays valid
+
+# chat messages are broadcast first and saved in batches in the background (see chat.buffer)
+CHAT_WRITE_BEHIND = os.getenv("CHAT_WRITE_BEHIND", "false").lower() == "true"
+CHAT_WRITE_BEHIND_INTERVAL = 50  # milliseconds a message waits at most before being saved
+CHAT_WRITE_BEHIND_BATCH = 100  # messages saved at once when the buffer fills up
+CHAT_WRITE_BEHIND_RETRIES = 8  # retries (with backoff) before a message that fails is dropped
+
+# notifications are saved by a background thread after commit (False saves them in the
+# committing thread), see notifications.fanout
+NOTIFICATION_WORKER = os.getenv("NOTIFICATION_WORKER", "true").lower() == "true"
+NOTIFICATION_RETRIES = 5  # retries of a batch that fails to save before it is dropped
+NOTIFICATION_RETRY_BACKOFF = 1  # seconds before the first retry, doubled for every next one
+CHAT_NOTIFICATION_WINDOW = 10 * 60  # seconds a chat notification collapses new messages
+NOTIFICATION_READ_RETENTION = 30  # days read notifications are kept, see prune_notifications
+NOTIFICATION_RETENTION = 180  # days any notification is kept
+
 
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
@@ -163,8 +189,11 @@ FILE_UPLOAD_HANDLERS = [
 WSGI_APPLICATION = "backend.wsgi.application"
 ASGI_APPLICATION = "backend.asgi.application"
 
+# check if ENV in environment varialbe is development or running `python manage.py test``
+USE_SQLITE = os.environ.get("ENV") == "development" or "test" in sys.argv
+
 # Channel layers con`figuration for Redis
-if DEBUG:
+if DEBUG or USE_SQLITE:
     CHANNEL_LAYERS = {
         "default": {
             "BACKEND": "channels.layers.InMemoryChannelLayer",  # ONLY FOR DEVELOPMENTTT
@@ -189,9 +218,6 @@ else:
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-# check if ENV in environment varialbe is development or running `python manage.py test``
-USE_SQLITE = os.environ.get("ENV") == "development" or "test" in sys.argv
-
 if USE_SQLITE:
     DATABASES = {
         "default": {
@@ -211,6 +237,22 @@ else:
         }
     }
 
+# Cache shared by all the workers (counters like the chat unread counts are mirrored in it)
+if USE_SQLITE:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+else:
+    REDIS_AUTH = f":{os.getenv('REDIS_PASSWORD')}@" if os.getenv("REDIS_PASSWORD") else ""
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": f"redis://{REDIS_AUTH}{os.getenv('REDIS_HOST')}:6379/1",
+        }
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -0,0 +1,149 @@
+# buffer.py - Write-behind saving of chat messages
+# With settings.CHAT_WRITE_BEHIND on, ChatConsumer broadcasts a message right away and hands it
+# to message_buffer instead of waiting on its INSERTs. The buffer saves whatever accumulated
+# with Message.bulk_send every CHAT_WRITE_BEHIND_INTERVAL ms, or as soon as
+# CHAT_WRITE_BEHIND_BATCH messages are waiting.
+#
+# A batch that fails to save is saved again one message at a time, so one message that can
+# never be saved (e.g. its room was deleted) doesn't hold back the others. Messages that still
+# fail go back in the buffer and are retried with backoff, up to CHAT_WRITE_BEHIND_RETRIES
+# times, then logged and dropped. The buffer is flushed when a socket disconnects and when
+# the process exits. Messages still buffered when the process is killed outright are lost,
+# which is the price of not waiting on the database.
+
+import asyncio
+import atexit
+import logging
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class MessageBuffer:
+    def __init__(self):
+        self.pending = []
+        self.timer = None
+        self.tasks = set()  # running flushes, referenced so they aren't garbage collected
+
+    async def add(self, message):
+        """
+        Queues an unsaved Message, to be saved with the next flush.
+        """
+        self.pending.append(message)
+        if len(self.pending) >= settings.CHAT_WRITE_BEHIND_BATCH:
+            task = asyncio.ensure_future(self.flush())
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        elif self.timer is None or self.timer.done():
+            self.timer = asyncio.ensure_future(self.flush_later())
+
+    async def flush_later(self, delay=None):
+        if delay is None:
+            delay = settings.CHAT_WRITE_BEHIND_INTERVAL
+        await asyncio.sleep(delay / 1000)
+        # no longer cancellable by other flushes: cancelling the save would lose its batch
+        if self.timer is asyncio.current_task():
+            self.timer = None
+        await self.flush()
+
+    async def flush(self):
+        """
+        Saves the buffered messages.
+
+        Returns:
+            int: How many messages were saved.
+        """
+        if self.timer is not None:
+            self.timer.cancel()  # this flush saves what the (still sleeping) timer waited for
+        batch, self.pending = self.pending, []
+        if not batch:
+            return 0
+        failed = await database_sync_to_async(self.save)(batch)
+        retried = self.retry(failed)
+        if retried:
+            # back off from a struggling database: 1, 2, 4... times the interval
+            attempts = max(message.write_attempts for message in retried)
+            delay = settings.CHAT_WRITE_BEHIND_INTERVAL * 2 ** (attempts - 1)
+            if self.timer is None or self.timer.done():
+                self.timer = asyncio.ensure_future(self.flush_later(delay))
+        return len(batch) - len(failed)
+
+    def retry(self, failed):
+        """
+        Puts messages that could not be saved back in front of the buffer, dropping the ones
+        out of retries.
+
+        Returns:
+            list[Message]: The messages that will be retried.
+        """
+        retried = []
+        for message in failed:
+            message.write_attempts = getattr(message, "write_attempts", 0) + 1
+            if message.write_attempts > settings.CHAT_WRITE_BEHIND_RETRIES:
+                logger.error(
+                    "Dropping a chat message of user %s in room %s after %s attempts",
+                    message.sender_id,
+                    message.room_id,
+                    message.write_attempts,
+                )
+            else:
+                retried.append(message)
+        self.pending[:0] = retried
+        return retried
+
+    def flush_sync(self):
+        """
+        Saves the buffered messages from synchronous code, e.g. when the process exits.
+        """
+        batch, self.pending = self.pending, []
+        if batch:
+            for message in self.save(batch):
+                logger.error(
+                    "Dropping a chat message of user %s in room %s on exit",
+                    message.sender_id,
+                    message.room_id,
+                )
+
+    @classmethod
+    def save(cls, batch):
+        """
+        Saves a batch with one bulk_send, or one message at a time if that fails.
+
+        Returns:
+            list[Message]: The messages that could not be saved.
+        """
+        try:
+            cls.save_batch(batch)
+            return []
+        except Exception:
+            logger.exception("Could not save %s chat messages", len(batch))
+            if len(batch) == 1:
+                return batch
+        failed = []
+        for message in batch:
+            try:
+                cls.save_batch([message])
+            except Exception:
+                logger.exception("Could not save a chat message in room %s", message.room_id)
+                failed.append(message)
+        return failed
+
+    @staticmethod
+    def save_batch(batch):
+        from .models import Message
+
+        try:
+            Message.bulk_send(batch)
+        except Exception:
+            # the transaction was rolled back, so none of them are saved
+            for message in batch:
+                message.pk = None
+                message.seq = 0
+            raise
+
+
+# the buffer of this process
+message_buffer = MessageBuffer()
+atexit.register(message_buffer.flush_sync)
@@ -1,51 +1,219 @@
 import json
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from notifications import unread as notification_unread
+from . import events, presence, unread
+from .buffer import message_buffer
 from .models import ChatRoom, Message
 from channels.db import database_sync_to_async
-from django.contrib.auth.models import User
-from django.utils import timezone
 
+# at most this many missed messages are replayed to a resuming socket
+REPLAY_LIMIT = 200
+
+
+class MessageSenderMixin:
+    """
+    Saving and broadcasting chat messages, shared by the consumers users send messages with.
+    """
+
+    async def post_message(self, room, receiver, message):
+        if settings.CHAT_WRITE_BEHIND:
+            # broadcast first, the message is saved with the next batch (see chat.buffer)
+            # its timestamp is set here and saved as is, so clients see the same time either way
+            message_obj = self.build_message(room, receiver, message)
+            await self.broadcast(message_obj)
+            await message_buffer.add(message_obj)
+        else:
+            # Save message to database w/ is_read=False for unread_messages stuff
+            message_obj = await self.save_message(room, receiver, message)
+            await self.broadcast(message_obj)
+
+    async def broadcast(self, message_obj):
+        event = {
+            "type": "chat_message",
+            "room_id": message_obj.room_id,
+            "message": message_obj.content,
+            "user_id": self.user.id,
+            "receiver_id": message_obj.receiver_id,
+            "username": self.user.username,
+            "timestamp": message_obj.timestamp.isoformat(),
+            "seq": message_obj.seq or None,  # not numbered yet with write-behind
+        }
+        # Send message to room group, and to the user sockets of both participants
+        await self.channel_layer.group_send(f"chat_{message_obj.room_id}", event)
+        await self.channel_layer.group_send(events.user_group(message_obj.receiver_id), event)
+        await self.channel_layer.group_send(events.user_group(self.user.id), event)
+
+    async def send_typing(self, room, receiver, typing):
+        event = {
+            "type": "typing",
+            "room_id": room.id,
+            "user_id": self.user.id,
+            "typing": typing,
+        }
+        # to the room, and to the other user's socket for their room list
+        await self.channel_layer.group_send(f"chat_{room.id}", event)
+        await self.channel_layer.group_send(events.user_group(receiver.id), event)
+
+    async def read_frame(self, text_data):
+        """
+        Decodes a frame from the socket, answering anything but a JSON object with an error.
+
+        Returns:
+            dict: The frame, or None if it was answered with an error.
+        """
+        try:
+            data = json.loads(text_data) if text_data is not None else None
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            await self.send_error(None, "Frames must be JSON objects")
+            return None
+        return data
+
+    async def send_error(self, room_id, error):
+        await self.send(text_data=json.dumps({"type": "error", "room_id": room_id, "error": error}))
+
+    def build_message(self, room, receiver, message):
+        # create message with is_read=False by defualt
+        return Message(
+            room=room,
+            sender=self.user,
+            receiver=receiver,
+            content=message,
+            is_read=False,
+        )
+
+    @database_sync_to_async
+    def save_message(self, room, receiver, message):
+        message_obj = self.build_message(room, receiver, message)
+        message_obj.save()
+        return message_obj
+
+
+class ChatConsumer(MessageSenderMixin, AsyncWebsocketConsumer):
+    """
+    A websocket per user and chat room.
+
+    The user comes from the JWT of the handshake (see chat.middleware). The room and both
+    participants are loaded once in connect(), so a message only costs its INSERT, or
+    nothing at all before the broadcast with settings.CHAT_WRITE_BEHIND (see chat.buffer).
+
+    Besides messages, the client can send {"type": "typing", "typing": true/false} and
+    {"type": "ping"}, and gets {"type": "typing", ...} and {"type": "presence", "online": ...,
+    "last_seen": ...} events about the other user, starting with their presence right after
+    connecting. Neither touches the database (see chat.presence). Typing events are dropped
+    beyond one per second, so clients should hide the indicator after a few seconds without
+    one.
+
+    Messages carry their "seq" in the room (None when broadcast ahead of saving with
+    write-behind). A client that lost its socket reconnects with ?resume_from=<last seq it
+    got> and is sent the messages it missed before any live ones, or {"type": "resync"} if
+    more than REPLAY_LIMIT were missed and it should reload chat_history instead. Messages
+    can arrive twice around the reconnect, clients drop the seqs they already have.
+    """
 
-class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.room_id = self.scope["url_route"]["kwargs"]["room_id"]
         self.room_group_name = f"chat_{self.room_id}"
+        self.present = False
+
+        # only the two participants of the room can connect
+        self.user = self.scope.get("user")
+        if self.user is None or not self.user.is_authenticated:
+            await self.close(code=4001)
+            return
+        self.room = await self.get_room()
+        if self.room is None or self.user.id not in (self.room.user1_id, self.room.user2_id):
+            await self.close(code=4003)
+            return
+        # the user object of the token stands in for the one of the room
+        if self.room.user1_id == self.user.id:
+            self.room.user1, self.receiver = self.user, self.room.user2
+        else:
+            self.room.user2, self.receiver = self.user, self.room.user1
 
         # Join room group
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.accept()
+        await self.accept(subprotocol=self.scope.get("subprotocol"))
+
+        self.present = True
+        if await presence.connected(self.user.id):
+            await self.send_presence(online=True, last_seen=None)
+        # whether the other user is here
+        await self.send(
+            text_data=json.dumps({"type": "presence", **await presence.status(self.receiver.id)})
+        )
+
+        # after joining the group, so nothing sent meanwhile falls between replay and live
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        resume_from = query.get("resume_from", [""])[0]
+        if resume_from.isdigit():
+            await self.replay(int(resume_from))
 
     async def disconnect(self, close_code):
         # Leave room group
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        if self.present and await presence.disconnected(self.user.id):
+            await self.send_presence(online=False, last_seen=timezone.now().isoformat())
+        if settings.CHAT_WRITE_BEHIND:
+            await message_buffer.flush()
 
     # Receive message from WebSocket
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        message = data["message"]
-        sender_id = data["user_id"]
-        receiver_id = data["receiver_id"]
-
-        # Save message to database w/ is_read=False for unread_messages stuff
-        message_obj = await self.save_message(sender_id, receiver_id, message)
+    async def receive(self, text_data=None, bytes_data=None):
+        data = await self.read_frame(text_data)
+        if data is None:
+            return
+        kind = data.get("type", "chat_message")
+        if kind not in ("chat_message", "typing", "ping"):
+            await self.send_error(self.room.id, f"Unknown frame type {kind!r}")
+            return
+        if kind == "chat_message" and not isinstance(data.get("message"), str):
+            await self.send_error(self.room.id, "No message")
+            return
+        if kind == "typing":
+            if await presence.may_type(self.room.id, self.user.id):
+                await presence.touch(self.user.id)
+                await self.send_typing(self.room, self.receiver, bool(data.get("typing", True)))
+            return
+        await presence.touch(self.user.id)
+        if kind == "ping":
+            return
+        # the sender is the authenticated user, whatever user_id the payload claims
+        await self.post_message(self.room, self.receiver, data["message"])
 
-        # Send message to room group
+    async def send_presence(self, online, last_seen):
         await self.channel_layer.group_send(
             self.room_group_name,
             {
-                "type": "chat_message",
-                "message": message,
-                "user_id": sender_id,
-                "receiver_id": receiver_id,
-                "username": await self.get_username(sender_id),
-                "timestamp": (
-                    message_obj.timestamp.isoformat()
-                    if message_obj
-                    else timezone.now().isoformat()
-                ),
+                "type": "presence",
+                "user_id": self.user.id,
+                "online": online,
+                "last_seen": last_seen,
             },
         )
 
+    async def replay(self, resume_from):
+        missed = await self.get_missed_messages(resume_from)
+        if missed is None:
+            await self.send(text_data=json.dumps({"type": "resync"}))
+            return
+        users = {self.user.id: self.user, self.receiver.id: self.receiver}
+        for message in missed:
+            await self.chat_message(
+                {
+                    "message": message["content"],
+                    "user_id": message["sender_id"],
+                    "receiver_id": message["receiver_id"],
+                    "username": users[message["sender_id"]].username,
+                    "timestamp": message["timestamp"].isoformat(),
+                    "seq": message["seq"],
+                }
+            )
+
     # Receive message from room group
     async def chat_message(self, event):
         # Send message to WebSocket
@@ -57,20 +225,136 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     "receiver_id": event["receiver_id"],
                     "username": event["username"],
                     "timestamp": event.get("timestamp"),
+                    "seq": event.get("seq"),
                 }
             )
         )
 
+    # Receive a read receipt from room group (see chat.unread.mark_room_read)
+    async def read_receipt(self, event):
+        # Send it to WebSocket, so the sender sees their messages were read
+        await self.send(text_data=json.dumps(event))
+
+    # Receive presence and typing events from room group, only the other user's are sent
+    async def presence(self, event):
+        if event["user_id"] != self.user.id:
+            await self.send(text_data=json.dumps(event))
+
+    typing = presence
+
     @database_sync_to_async
-    def save_message(self, sender_id, receiver_id, message):
-        room = ChatRoom.objects.get(id=int(self.room_id))
-        sender = User.objects.get(id=sender_id)
-        receiver = User.objects.get(id=receiver_id)
-        # create message with is_read=False by defualt
-        return Message.objects.create(
-            room=room, sender=sender, receiver=receiver, content=message, is_read=False
+    def get_room(self):
+        return (
+            ChatRoom.objects.select_related("user1", "user2")
+            .filter(id=self.room_id)
+            .first()
+        )
+
+    @database_sync_to_async
+    def get_missed_messages(self, resume_from):
+        # one range read off the (room, seq) index, None if there are too many
+        missed = list(
+            Message.objects.filter(room=self.room, seq__gt=resume_from)
+            .order_by("seq")
+            .values("content", "sender_id", "receiver_id", "timestamp", "seq")[
+                : REPLAY_LIMIT + 1
+            ]
+        )
+        return None if len(missed) > REPLAY_LIMIT else missed
+
+
+class UserConsumer(MessageSenderMixin, AsyncWebsocketConsumer):
+    """
+    One websocket per user for all their rooms, joined to the "user_<id>" group.
+
+    It carries the events of chat.events as JSON with their "type": messages of every room,
+    read receipts, unread count deltas, new notifications and typing in their rooms. Right
+    after connecting it sends the current counts as
+    {"type": "unread_counts", "chat": ..., "notifications": ...}.
+    The client can send what it sends on a room socket, with the "room_id" it is for:
+    {"room_id": ..., "message": ...} and {"type": "typing", "room_id": ..., "typing": ...},
+    plus {"type": "ping"}. Frames it can't act on get {"type": "error", "error": ...} back.
+    """
+
+    async def connect(self):
+        self.user = self.scope.get("user")
+        if self.user is None or not self.user.is_authenticated:
+            await self.close(code=4001)
+            return
+        self.group_name = events.user_group(self.user.id)
+        self.receivers = {}  # room id -> (room, receiver) of the rooms messages were sent to
+
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept(subprotocol=self.scope.get("subprotocol"))
+        chat_count, notification_count = await self.get_unread_counts()
+        await self.send(
+            text_data=json.dumps(
+                {"type": "unread_counts", "chat": chat_count, "notifications": notification_count}
+            )
+        )
+
+    async def disconnect(self, close_code):
+        if hasattr(self, "group_name"):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        if settings.CHAT_WRITE_BEHIND:
+            await message_buffer.flush()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        data = await self.read_frame(text_data)
+        if data is None:
+            return
+        kind = data.get("type", "chat_message")
+        room_id = data.get("room_id")
+        if kind == "ping":
+            await presence.touch(self.user.id)
+            return
+        if kind not in ("chat_message", "typing"):
+            await self.send_error(room_id, f"Unknown frame type {kind!r}")
+            return
+        if kind == "chat_message" and not isinstance(data.get("message"), str):
+            await self.send_error(room_id, "No message")
+            return
+        if room_id not in self.receivers:
+            room = await self.get_room(room_id)
+            if room is None:
+                await self.send_error(room_id, "Chat room not found")
+                return
+            if room.user1_id == self.user.id:
+                room.user1, receiver = self.user, room.user2
+            else:
+                room.user2, receiver = self.user, room.user1
+            self.receivers[room_id] = (room, receiver)
+        room, receiver = self.receivers[room_id]
+
+        if kind == "typing":
+            if await presence.may_type(room.id, self.user.id):
+                await presence.touch(self.user.id)
+                await self.send_typing(room, receiver, bool(data.get("typing", True)))
+            return
+        await presence.touch(self.user.id)
+        await self.post_message(room, receiver, data["message"])
+
+    # every event of the user's group goes to the socket as is
+    async def forward(self, event):
+        await self.send(text_data=json.dumps(event))
+
+    chat_message = read_receipt = unread_count = typing = forward
+    notification = notification_count = forward
+
+    @database_sync_to_async
+    def get_room(self, room_id):
+        # only rooms of the user
+        if not isinstance(room_id, int):
+            return None
+        return (
+            ChatRoom.objects.select_related("user1", "user2")
+            .filter(Q(user1=self.user) | Q(user2=self.user), id=room_id)
+            .first()
         )
 
     @database_sync_to_async
-    def get_username(self, user_id):
-        return User.objects.get(id=user_id).username
+    def get_unread_counts(self):
+        return (
+            unread.total(self.user.id),
+            notification_unread.count(self.user.id),
+        )
@@ -0,0 +1,40 @@
+# events.py - Events pushed to the user websocket
+# Every connected user has a UserConsumer in the channel group "user_<id>", one socket for all
+# their rooms. Whatever changes for a user is sent to that group once it is committed:
+#   chat_message        a message in one of their rooms (see ChatConsumer.broadcast)
+#   read_receipt        the other user read their messages (see chat.unread.mark_room_read)
+#   unread_count        their unread messages in a room changed by "delta" (see chat.unread)
+#   notification        a new Notification, with their "unread_count" (see notifications.models)
+#   notification_count  their unread notifications changed to "unread_count"
+#   typing              the other user of a room is typing (see ChatConsumer)
+# so the app doesn't have to poll the unread counts, or keep a socket per room.
+
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+
+def user_group(user_id):
+    return f"user_{user_id}"
+
+
+def send_to_user(user_id, event):
+    """
+    Sends an event to the sockets of a user, from synchronous code.
+    """
+    try:
+        async_to_sync(get_channel_layer().group_send)(user_group(user_id), event)
+    except Exception:
+        # events are only live updates, whatever they announce is saved already
+        logger.exception("Could not send a %s event to user %s", event.get("type"), user_id)
+
+
+def send_on_commit(user_id, event):
+    """
+    Sends an event to the sockets of a user once the current transaction commits.
+    """
+    transaction.on_commit(lambda: send_to_user(user_id, event))
@@ -0,0 +1,126 @@
+import asyncio
+import time
+
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+
+from chat.buffer import message_buffer
+from chat.consumers import ChatConsumer
+from chat.models import ChatRoom, Message
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark chat messages per second through ChatConsumer, saving every message "
+        "before its broadcast vs. the write-behind buffer, and the database queries per second "
+        "with and without typing events. The bench users and rooms are deleted afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--messages",
+            type=int,
+            default=2000,
+            help="Messages sent per mode (default: 2000)",
+        )
+        parser.add_argument(
+            "--sockets",
+            type=int,
+            default=4,
+            help="Sockets sending concurrently, one room each (default: 4)",
+        )
+        parser.add_argument(
+            "--batch",
+            type=int,
+            default=100,
+            help="CHAT_WRITE_BEHIND_BATCH for the write-behind run (default: 100)",
+        )
+        parser.add_argument(
+            "--typing",
+            type=int,
+            default=5,
+            help="Typing events sent before each message in the typing run (default: 5)",
+        )
+
+    def handle(self, *args, **options):
+        users = []
+        rooms = []
+        for i in range(options["sockets"]):
+            sender = User.objects.create_user(username=f"bench_sender_{i}")
+            receiver = User.objects.create_user(username=f"bench_receiver_{i}")
+            users += [sender, receiver]
+            rooms.append(ChatRoom.objects.create(user1=sender, user2=receiver, item_id=i + 1))
+
+        try:
+            results = {}
+            modes = (
+                ("save, then broadcast", False, 0),
+                ("write-behind", True, 0),
+                ("save, typing", False, options["typing"]),
+            )
+            for name, write_behind, typing in modes:
+                cache.clear()  # presence and typing throttles
+                with override_settings(
+                    CHAT_WRITE_BEHIND=write_behind,
+                    CHAT_WRITE_BEHIND_BATCH=options["batch"],
+                ):
+                    before = Message.objects.count()
+                    with CaptureQueriesContext(connection) as queries:
+                        sent, elapsed = async_to_sync(self.run)(
+                            rooms, options["messages"], typing
+                        )
+                    saved = Message.objects.count() - before
+                results[name] = sent / elapsed
+                self.stdout.write(
+                    f"{name:>22}: {results[name]:8.0f} msgs/s "
+                    f"{len(queries) / elapsed:8.0f} queries/s "
+                    f"{len(queries) / sent:6.2f} queries/msg "
+                    f"({sent} messages in {elapsed:.2f}s, {saved} saved)"
+                )
+        finally:
+            # the consumers save through their own connections, so clean up instead of
+            # rolling back (deleting the users takes their rooms, messages and notifications)
+            User.objects.filter(id__in=[user.id for user in users]).delete()
+
+        speedup = results["write-behind"] / results["save, then broadcast"]
+        self.stdout.write(self.style.SUCCESS(f"write-behind is {speedup:.1f}x the current path"))
+
+    async def run(self, rooms, count, typing=0):
+        """
+        Sends count messages spread over one socket per room, each after typing typing
+        events, waits for every broadcast to come back, then for the buffer to be saved.
+        Returns the number of messages sent and the elapsed seconds.
+        """
+        communicators = []
+        for room in rooms:
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/{room.id}/")
+            communicator.scope["url_route"] = {"kwargs": {"room_id": str(room.id)}}
+            communicator.scope["user"] = room.user1
+            connected, _ = await communicator.connect()
+            assert connected
+            await communicator.receive_json_from()  # the receiver's presence
+            communicators.append(communicator)
+
+        per_socket = count // len(communicators)
+
+        async def chat(communicator):
+            for i in range(per_socket):
+                for _ in range(typing):
+                    await communicator.send_json_to({"type": "typing", "typing": True})
+                await communicator.send_json_to({"message": f"message {i}"})
+                await communicator.receive_json_from(timeout=10)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(chat(communicator) for communicator in communicators))
+        await message_buffer.flush()
+        elapsed = time.perf_counter() - started
+
+        for communicator in communicators:
+            await communicator.disconnect()
+        return per_socket * len(communicators), elapsed
@@ -0,0 +1,117 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Exists, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+from chat import unread
+from chat.models import Message, UnreadCounter
+
+
+def expected_count():
+    """
+    Returns the subquery computing the true value of an UnreadCounter.
+    """
+    messages = (
+        Message.objects.filter(
+            room=OuterRef("room"), receiver=OuterRef("user"), is_read=False
+        )
+        .order_by()
+        .values("room")
+        .annotate(count=Count("id"))
+        .values("count")
+    )
+    return Coalesce(Subquery(messages), 0)
+
+
+class Command(BaseCommand):
+    help = "Repair drift in the chat unread counters and the cached unread totals"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Counters repaired per UPDATE (default: 1000)",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report how many counters have drifted",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        dry_run = options["dry_run"]
+
+        drifted = (
+            UnreadCounter.objects.annotate(expected=expected_count())
+            .filter(~Q(count=F("expected")))
+            .order_by("id")
+            .values_list("id", "user_id")
+        )
+        batch = []
+        repaired = 0
+        for row in drifted.iterator(chunk_size=batch_size):
+            batch.append(row)
+            if len(batch) == batch_size:
+                repaired += self.repair(batch, dry_run)
+                batch = []
+        if batch:
+            repaired += self.repair(batch, dry_run)
+
+        # unread messages of rooms the receiver has no counter for yet
+        missing = (
+            Message.objects.filter(is_read=False)
+            .exclude(
+                Exists(
+                    UnreadCounter.objects.filter(
+                        user=OuterRef("receiver"), room=OuterRef("room")
+                    )
+                )
+            )
+            .values("receiver", "room")
+            .annotate(count=Count("id"))
+            .order_by()
+        )
+        created = 0
+        batch = []
+        for row in missing.iterator(chunk_size=batch_size):
+            batch.append(
+                UnreadCounter(user_id=row["receiver"], room_id=row["room"], count=row["count"])
+            )
+            if len(batch) == batch_size:
+                created += self.create(batch, dry_run)
+                batch = []
+        if batch:
+            created += self.create(batch, dry_run)
+
+        if dry_run:
+            self.stdout.write(f"{repaired} counters have drifted, {created} are missing.")
+        else:
+            self.stdout.write(
+                self.style.SUCCESS(f"Repaired {repaired} counters and created {created}.")
+            )
+
+    def repair(self, rows, dry_run):
+        if dry_run:
+            return len(rows)
+        # each batch is its own short transaction, so locks are only held briefly
+        with transaction.atomic():
+            UnreadCounter.objects.filter(id__in=[row[0] for row in rows]).update(
+                count=expected_count()
+            )
+            self.forget_totals(row[1] for row in rows)
+        return len(rows)
+
+    def create(self, counters, dry_run):
+        if dry_run:
+            return len(counters)
+        with transaction.atomic():
+            UnreadCounter.objects.bulk_create(counters, ignore_conflicts=True)
+            self.forget_totals(counter.user_id for counter in counters)
+        return len(counters)
+
+    def forget_totals(self, user_ids):
+        # the cached totals are rebuilt from the repaired counters on their next read
+        user_ids = set(user_ids)
+        transaction.on_commit(lambda: unread.forget(*user_ids))
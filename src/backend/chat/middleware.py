@@ -0,0 +1,57 @@
+# middleware.py - JWT authentication for websockets
+# The app authenticates with JWTs, not sessions, so AuthMiddlewareStack never found a user and
+# the chat trusted whatever user_id the client put in its messages. This middleware reads the
+# access token the app already has and puts its user in scope["user"].
+#
+# Browsers can't set headers on websockets, so the token comes either from the query string
+#   ws://host/ws/chat/<room_id>/?token=<jwt>
+# or from the subprotocols, which keeps it out of server logs
+#   new WebSocket(url, ["access_token", "<jwt>"])
+
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.contrib.auth.models import AnonymousUser
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+
+TOKEN_SUBPROTOCOL = "access_token"
+
+
+def get_raw_token(scope):
+    """
+    Returns the JWT sent with a websocket handshake and the subprotocol to accept (None when
+    the token came in the query string), or (None, None) if there is no token.
+    """
+    subprotocols = scope.get("subprotocols") or []
+    if len(subprotocols) >= 2 and subprotocols[0] == TOKEN_SUBPROTOCOL:
+        return subprotocols[1], TOKEN_SUBPROTOCOL
+    query = parse_qs(scope.get("query_string", b"").decode())
+    if query.get("token"):
+        return query["token"][0], None
+    return None, None
+
+
+@database_sync_to_async
+def get_user(raw_token):
+    authentication = JWTAuthentication()
+    try:
+        return authentication.get_user(authentication.get_validated_token(raw_token))
+    except (InvalidToken, AuthenticationFailed):
+        return AnonymousUser()
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """
+    Sets scope["user"] from the JWT of the handshake (AnonymousUser if it is missing or
+    invalid), and scope["subprotocol"] to the subprotocol the consumer should accept.
+    """
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+        raw_token, subprotocol = get_raw_token(scope)
+        scope["user"] = await get_user(raw_token) if raw_token else AnonymousUser()
+        scope["subprotocol"] = subprotocol
+        return await super().__call__(scope, receive, send)
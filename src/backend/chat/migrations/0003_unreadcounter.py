@@ -0,0 +1,48 @@
+# Generated by Django 4.2.20 on 2026-10-17 18:03
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count
+
+
+def count_existing(apps, schema_editor):
+    Message = apps.get_model("chat", "Message")
+    UnreadCounter = apps.get_model("chat", "UnreadCounter")
+    unread = (
+        Message.objects.filter(is_read=False)
+        .values("receiver", "room")
+        .annotate(count=Count("id"))
+        .order_by()
+    )
+    UnreadCounter.objects.bulk_create(
+        (
+            UnreadCounter(user_id=row["receiver"], room_id=row["room"], count=row["count"])
+            for row in unread.iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0002_message_message_unread_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnreadCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='unread_counters', to='chat.chatroom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='unread_counters', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'room')},
+            },
+        ),
+        migrations.RunPython(count_existing, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.20 on 2026-10-17 18:21
+
+from django.db import migrations, models
+
+
+def number_existing(apps, schema_editor):
+    ChatRoom = apps.get_model("chat", "ChatRoom")
+    Message = apps.get_model("chat", "Message")
+    for room_id in ChatRoom.objects.values_list("id", flat=True).iterator():
+        # in the order chat_history shows them
+        ids = list(
+            Message.objects.filter(room_id=room_id)
+            .order_by("timestamp", "id")
+            .values_list("id", flat=True)
+        )
+        Message.objects.bulk_update(
+            [Message(id=message_id, seq=seq) for seq, message_id in enumerate(ids, 1)],
+            ["seq"],
+            batch_size=1000,
+        )
+        ChatRoom.objects.filter(id=room_id).update(last_seq=len(ids))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_message_room_timeline_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_seq',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(number_existing, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,13 @@
 # chat/models.py
-from django.db import models
+from collections import Counter
+
+from django.db import models, transaction
+from django.db.models import F
 from django.contrib.auth.models import User
 from django.utils import timezone
 
-from notifications.models import Notification, NotificationType
+from notifications import fanout
+from . import unread
 
 
 class ChatRoom(models.Model):
@@ -17,6 +21,7 @@ class ChatRoom(models.Model):
 
     # name = models.CharField(max_length=100)
     created_at = models.DateTimeField(auto_now_add=True)
+    last_seq = models.PositiveIntegerField(default=0)  # seq of the latest message
 
     class Meta:
         # This is the unique user1, user2, item_id combo that defines each new chat room
@@ -28,6 +33,24 @@ class ChatRoom(models.Model):
     def participants(self):
         return [self.user1, self.user2]
 
+    @classmethod
+    def reserve_seqs(cls, room_id, count=1):
+        """
+        Takes the next sequence numbers of a room for new messages. Must be called in a
+        transaction: the room's row stays locked until it commits, so the messages of a room
+        commit in seq order and a client resuming after seq n never misses a lower one.
+
+        Args:
+            room_id (int): The id of the room.
+            count (int): How many numbers to take.
+
+        Returns:
+            int: The first of the numbers.
+        """
+        rooms = cls.objects.filter(id=room_id)
+        rooms.update(last_seq=F("last_seq") + count)
+        return rooms.values_list("last_seq", flat=True).get() - count + 1
+
 
 class Message(models.Model):
     room = models.ForeignKey(
@@ -40,9 +63,32 @@ class Message(models.Model):
         User, on_delete=models.CASCADE, related_name="received_messages"
     )  # current user
     content = models.TextField()  # actual message content
-    timestamp = models.DateTimeField(auto_now_add=True)  # time the message was sent
+    # set when the message is built, so a write-behind message keeps the time it was broadcast with
+    timestamp = models.DateTimeField(default=timezone.now)  # time the message was sent
     is_read = models.BooleanField(default=False)  # track the read status
     read_at = models.DateTimeField(null=True, blank=True)  # when the message was read
+    # 1, 2, 3... in the order messages were sent to the room, so clients can ask for
+    # whatever they missed after the last one they got
+    seq = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        # unread counts only look at unread messages, which are a small part of the table
+        indexes = [
+            models.Index(
+                fields=["room", "sender"],
+                condition=models.Q(is_read=False),
+                name="message_unread_idx",
+            ),
+            # chat history pages, read in (timestamp, id) order from either end
+            models.Index(
+                fields=["room", "timestamp", "id"],
+                name="message_room_timeline_idx",
+            ),
+        ]
+        constraints = [
+            # also the index websocket catch-up reads (room, seq > n) off
+            models.UniqueConstraint(fields=["room", "seq"], name="message_room_seq_uniq"),
+        ]
 
     def __str__(self):
         return f"Message from {self.sender.username} to {self.receiver.username} at {self.timestamp}"
@@ -52,17 +98,81 @@ class Message(models.Model):
             self.is_read = True
             self.read_at = timezone.now()
             self.save()
+            unread.adjust(self.room_id, self.receiver_id, -1)
+
+    @classmethod
+    def bulk_send(cls, messages):
+        """
+        Saves many new messages with one INSERT, plus per room one UPDATE for their seqs and
+        one counter UPDATE per receiver, and queues their notifications, doing what save()
+        does for a single message.
+
+        Args:
+            messages (list[Message]): Unsaved messages, with room and sender loaded.
+
+        Returns:
+            list[Message]: The saved messages.
+        """
+        with transaction.atomic():
+            by_room = {}
+            for message in messages:
+                by_room.setdefault(message.room_id, []).append(message)
+            # rooms in id order, so concurrent batches lock them in the same order
+            for room_id in sorted(by_room):
+                first = ChatRoom.reserve_seqs(room_id, len(by_room[room_id]))
+                for seq, message in enumerate(by_room[room_id], first):
+                    message.seq = seq
+            created = cls.objects.bulk_create(messages)
+            for message in created:
+                if message.room.item_id:
+                    fanout.notify_chat(
+                        message.receiver_id, message.room_id, message.sender.username
+                    )
+            unread_by_room = Counter(
+                (message.room_id, message.receiver_id) for message in created if not message.is_read
+            )
+            for (room_id, receiver_id), count in unread_by_room.items():
+                unread.adjust(room_id, receiver_id, count)
+        return created
 
     # create the message notification
     def save(self, *args, **kwargs):
         # first check if the key is null. If yes then notification is new
         is_new = self.pk is None
-        super().save(*args, **kwargs)
-
-        # create the actual notification
-        if is_new and self.room.item_id:
-            Notification.objects.create(
-                recipient=self.receiver,
-                type=NotificationType.CHAT,
-                message=f"{self.sender.username} sent a message about an item you posted",
-            )
+        if not is_new:
+            super().save(*args, **kwargs)
+            return
+
+        # numbered and counted in one transaction, which holds the room row from the seq
+        # UPDATE on, so a concurrent mark_room_read (see chat.unread) runs before or after
+        with transaction.atomic():
+            if not self.seq:
+                self.seq = ChatRoom.reserve_seqs(self.room_id)
+            super().save(*args, **kwargs)
+            if not self.is_read:
+                unread.adjust(self.room_id, self.receiver_id, 1)
+
+            # create the actual notification, after commit and collapsed with the room's others
+            if self.room.item_id:
+                fanout.notify_chat(self.receiver_id, self.room_id, self.sender.username)
+
+
+class UnreadCounter(models.Model):
+    """
+    The number of unread messages of a user in a room, kept up to date by chat.unread so the
+    unread count doesn't have to COUNT the messages of every room.
+    """
+
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="unread_counters"
+    )
+    room = models.ForeignKey(
+        ChatRoom, on_delete=models.CASCADE, related_name="unread_counters"
+    )
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ("user", "room")
+
+    def __str__(self):
+        return f"{self.user_id} has {self.count} unread in room {self.room_id}"
@@ -0,0 +1,82 @@
+# presence.py - Online status and typing indicators
+# Whether a user is online and when they were last seen lives in the cache only, and typing
+# events only go through the channel layer, so neither ever writes to the database.
+#
+# A user is online while they have a chat socket open: connected() and disconnected() keep a
+# count of their sockets, which expires after PRESENCE_TIMEOUT unless touch() is called (any
+# frame the client sends), so a crashed server doesn't leave them online forever.
+# Typing events are throttled to one per user and room per TYPING_INTERVAL seconds, across
+# processes, with cache.add().
+
+from django.core.cache import cache
+from django.utils import timezone
+
+PRESENCE_TIMEOUT = 2 * 60  # seconds a socket counts as open without hearing from it
+LAST_SEEN_TIMEOUT = 30 * 24 * 60 * 60  # how long "last seen" is remembered
+TYPING_INTERVAL = 1  # seconds between typing events of a user in a room
+
+
+def online_key(user_id):
+    return f"chat:online:{user_id}"
+
+
+def last_seen_key(user_id):
+    return f"chat:last_seen:{user_id}"
+
+
+async def connected(user_id):
+    """
+    Counts a new socket of the user.
+
+    Returns:
+        bool: True if the user just came online.
+    """
+    await cache.aadd(online_key(user_id), 0, PRESENCE_TIMEOUT)
+    count = await cache.aincr(online_key(user_id))
+    await cache.atouch(online_key(user_id), PRESENCE_TIMEOUT)
+    return count == 1
+
+
+async def disconnected(user_id):
+    """
+    Counts a closed socket of the user, and remembers when they were last seen.
+
+    Returns:
+        bool: True if the user went offline.
+    """
+    await cache.aset(last_seen_key(user_id), timezone.now().isoformat(), LAST_SEEN_TIMEOUT)
+    try:
+        count = await cache.adecr(online_key(user_id))
+    except ValueError:
+        count = 0  # expired already
+    if count <= 0:
+        await cache.adelete(online_key(user_id))
+        return True
+    return False
+
+
+async def touch(user_id):
+    # the client is still there
+    await cache.atouch(online_key(user_id), PRESENCE_TIMEOUT)
+
+
+async def status(user_id):
+    """
+    Returns:
+        dict: "user_id", whether they are "online", and when they were "last_seen" (an ISO
+            timestamp, None if never or too long ago).
+    """
+    values = await cache.aget_many([online_key(user_id), last_seen_key(user_id)])
+    return {
+        "user_id": user_id,
+        "online": values.get(online_key(user_id), 0) > 0,
+        "last_seen": values.get(last_seen_key(user_id)),
+    }
+
+
+async def may_type(room_id, user_id):
+    """
+    Returns True if a typing event of the user in the room can be sent now, at most once per
+    TYPING_INTERVAL.
+    """
+    return await cache.aadd(f"chat:typing:{room_id}:{user_id}", 1, TYPING_INTERVAL)
@@ -14,7 +14,7 @@ class MessageSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Message
-        fields = ["id", "content", "sender", "timestamp", "is_read", "read_at"]
+        fields = ["id", "seq", "content", "sender", "timestamp", "is_read", "read_at"]
 
     def get_username(self, obj):
         return obj.user.username if obj.user else "Unknown"
@@ -48,11 +48,18 @@ class ChatRoomSerializer(serializers.ModelSerializer):
         return 2  # there will always be 2 users in a private room
 
     def get_message_count(self, obj):
+        # room_list annotates the count, so a page of rooms doesn't count them one by one
+        if hasattr(obj, "message_count"):
+            return obj.message_count
         return obj.messages.count()
 
     def get_item_title(self, obj):
         from items.models import Listing
 
+        # room_list loads the titles of a whole page at once
+        item_titles = self.context.get("item_titles")
+        if item_titles is not None:
+            return item_titles.get(obj.item_id)
         try:
             item = Listing.objects.get(id=obj.item_id)
             return item.title
@@ -4,6 +4,32 @@ from rest_framework.test import APITestCase
 from django.contrib.auth.models import User
 from chat.models import ChatRoom, Message
 from django.urls import reverse
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from chat.consumers import ChatConsumer
+from chat.middleware import JWTAuthMiddleware
+from chat.routing import websocket_urlpatterns
+from channels.routing import URLRouter
+from rest_framework_simplejwt.tokens import AccessToken
+from django.core.cache import cache
+from django.core.management import call_command
+from io import StringIO
+from chat.models import UnreadCounter
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from categories.models import Category
+from items.models import Listing
+from unittest import mock
+import asyncio
+import threading
+from django.db import DatabaseError, transaction
+from contextlib import contextmanager
+from django.db.models import QuerySet
+from django.test import override_settings
+from chat import unread
+from chat.buffer import MessageBuffer
+from notifications.models import Notification
 
 class ChatRoomTestCase(APITestCase):
     def setUp(self):
@@ -51,4 +77,778 @@ class MessageTestCase(APITestCase):
     def test_mark_as_read(self):
         self.message.mark_as_read()
         self.assertTrue(self.message.is_read)
-        self.assertIsNotNone(self.message.read_at)
\ No newline at end of file
+        self.assertIsNotNone(self.message.read_at)
+
+
+class RoomListTestCase(APITestCase):
+    def setUp(self):
+        self.me = User.objects.create_user(username="me", password="pass")
+        self.client.force_authenticate(user=self.me)
+        self.category = Category.objects.create(name="Books")
+
+    def add_rooms(self, count):
+        rooms = []
+        for _ in range(count):
+            other = User.objects.create_user(username=f"other{User.objects.count()}")
+            listing = Listing.objects.create(
+                title=f"Book {other.id}", category=self.category, price=5, seller=self.me
+            )
+            room = ChatRoom.objects.create(user1=self.me, user2=other, item_id=listing.id)
+            Message.objects.create(room=room, sender=other, receiver=self.me, content="hi")
+            Message.objects.create(room=room, sender=self.me, receiver=other, content="hey")
+            rooms.append(room)
+        return rooms
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("room_list"))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_is_constant(self):
+        self.add_rooms(2)
+        few = self.count_queries()
+        self.add_rooms(20)
+        self.assertEqual(self.count_queries(), few)
+
+    def test_rooms_carry_counts_and_titles(self):
+        (room,) = self.add_rooms(1)
+        data = self.client.get(reverse("room_list")).data["rooms"][0]
+        self.assertEqual(data["id"], room.id)
+        self.assertEqual(data["unread_count"], 1)
+        self.assertEqual(data["message_count"], 2)
+        self.assertEqual(data["item_title"], Listing.objects.get(id=room.item_id).title)
+        self.assertIsNotNone(data["last_message_time"])
+
+    def test_ordered_by_last_activity_and_paginated(self):
+        rooms = self.add_rooms(55)
+        oldest = rooms[0]
+        Message.objects.create(room=oldest, sender=self.me, receiver=oldest.user2, content="?")
+        quiet = ChatRoom.objects.create(user1=self.me, user2=rooms[1].user2, item_id=None)
+
+        response = self.client.get(reverse("room_list"))
+        ids = [room["id"] for room in response.data["rooms"]]
+        self.assertEqual(ids[:2], [quiet.id, oldest.id])
+        self.assertEqual(len(ids), 50)
+        response = self.client.get(response.data["next"])
+        ids += [room["id"] for room in response.data["rooms"]]
+        self.assertIsNone(response.data["next"])
+        self.assertEqual(sorted(ids), sorted([room.id for room in rooms] + [quiet.id]))
+
+
+@override_settings(NOTIFICATION_WORKER=False)
+class UnreadCounterTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.me = User.objects.create_user(username="me", password="pass")
+        self.other = User.objects.create_user(username="other", password="pass")
+        self.client.force_authenticate(user=self.me)
+        self.rooms = [
+            ChatRoom.objects.create(user1=self.me, user2=self.other, item_id=item_id)
+            for item_id in (1, 2)
+        ]
+
+    def send(self, room, count=1):
+        for _ in range(count):
+            with self.captureOnCommitCallbacks(execute=True):
+                Message.objects.create(
+                    room=room, sender=self.other, receiver=self.me, content="hi"
+                )
+
+    def unread_count(self):
+        response = self.client.get(reverse("unread_count"))
+        self.assertEqual(response.status_code, 200)
+        return response.data["unread_count"]
+
+    def test_counts_messages_across_rooms(self):
+        self.send(self.rooms[0], 2)
+        self.assertEqual(self.unread_count(), 2)
+        self.send(self.rooms[1])  # the cached total is kept up to date
+        self.assertEqual(self.unread_count(), 3)
+        self.assertEqual(UnreadCounter.objects.get(room=self.rooms[0], user=self.me).count, 2)
+
+    def test_lookup_is_constant(self):
+        self.send(self.rooms[0], 3)
+        self.unread_count()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.unread_count(), 3)
+        self.assertEqual(len(queries), 0)
+
+    def test_reading_a_room_resets_it(self):
+        self.send(self.rooms[0], 2)
+        self.send(self.rooms[1], 1)
+        self.assertEqual(self.unread_count(), 3)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("mark-room-as-read", args=[self.rooms[0].id]))
+        self.assertEqual(self.unread_count(), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse("chat_history", args=[self.rooms[1].id]))
+        self.assertEqual(self.unread_count(), 0)
+
+    def test_total_is_not_seeded_with_a_count_a_delta_raced(self):
+        self.send(self.rooms[0], 2)
+        cache.clear()
+        count_counters = unread.count_counters
+
+        def racing_count(user_id):
+            count = count_counters(user_id)
+            # a message committed while the counters were read
+            unread.adjust_total(user_id, 1)
+            return count
+
+        with mock.patch("chat.unread.count_counters", side_effect=racing_count):
+            self.assertEqual(unread.total(self.me.id), 2)
+        self.assertIsNone(cache.get(unread.total_key(self.me.id)))
+        # the next read counts again, and seeds the cache
+        self.assertEqual(unread.total(self.me.id), 2)
+        self.assertEqual(cache.get(unread.total_key(self.me.id)), 2)
+
+    def test_read_right_after_a_send_commits(self):
+        # a reader blocked on the room while a message was sent gets in as soon as the send's
+        # transaction ends, before whatever save() does after it
+        atomic, depth, done = transaction.atomic, [0], []
+
+        @contextmanager
+        def atomic_then_read(*args, **kwargs):
+            depth[0] += 1
+            try:
+                with atomic(*args, **kwargs):
+                    yield
+            finally:
+                depth[0] -= 1
+            if depth[0] == 0 and not done:
+                done.append(True)
+                unread.mark_room_read(self.rooms[0].id, self.me.id)
+
+        with mock.patch.object(transaction, "atomic", atomic_then_read):
+            Message.objects.create(
+                room=self.rooms[0], sender=self.other, receiver=self.me, content="hi"
+            )
+        self.assertTrue(done)
+        self.assertFalse(Message.objects.filter(is_read=False).exists())
+        # the message was counted before the read, which reset the count
+        self.assertEqual(UnreadCounter.objects.get(room=self.rooms[0], user=self.me).count, 0)
+
+    def test_counter_is_reset_with_the_messages(self):
+        self.send(self.rooms[0], 2)
+        update = QuerySet.update
+
+        def failing_update(queryset, **kwargs):
+            if queryset.model is Message:
+                raise DatabaseError("deadlock detected")
+            return update(queryset, **kwargs)
+
+        with mock.patch.object(QuerySet, "update", failing_update):
+            with self.assertRaises(DatabaseError):
+                unread.mark_room_read(self.rooms[0].id, self.me.id)
+        # nothing was marked read, so the counter wasn't reset either
+        self.assertEqual(UnreadCounter.objects.get(room=self.rooms[0], user=self.me).count, 2)
+        self.assertEqual(Message.objects.filter(is_read=False).count(), 2)
+
+    def test_recount_unread_repairs_drift(self):
+        self.send(self.rooms[0], 2)
+        self.send(self.rooms[1], 1)
+        UnreadCounter.objects.filter(room=self.rooms[0]).update(count=9)
+        UnreadCounter.objects.filter(room=self.rooms[1]).delete()
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("recount_unread", stdout=out)
+        self.assertIn("Repaired 1 counters and created 1.", out.getvalue())
+        self.assertEqual(self.unread_count(), 3)
+
+
+class ChatHistoryTestCase(APITestCase):
+    def setUp(self):
+        self.me = User.objects.create_user(username="me", password="pass")
+        self.other = User.objects.create_user(username="other", password="pass")
+        self.client.force_authenticate(user=self.me)
+        self.room = ChatRoom.objects.create(user1=self.me, user2=self.other, item_id=1)
+        self.url = reverse("chat_history", args=[self.room.id])
+        self.messages = self.send(120)
+
+    def send(self, count):
+        Message.bulk_send(
+            [
+                Message(room=self.room, sender=self.other, receiver=self.me, content=str(i))
+                for i in range(count)
+            ]
+        )
+        return list(Message.objects.filter(room=self.room).order_by("timestamp", "id"))
+
+    def ids(self, response):
+        return [message["id"] for message in response.data["messages"]]
+
+    def test_latest_page_first_then_scroll_back(self):
+        response = self.client.get(self.url)
+        self.assertEqual(self.ids(response), [m.id for m in self.messages[-50:]])
+        self.assertTrue(response.data["has_older"])
+        self.assertFalse(response.data["has_newer"])
+
+        ids = self.ids(response)
+        while response.data["has_older"]:
+            response = self.client.get(self.url, {"before": ids[0]})
+            self.assertTrue(response.data["has_newer"])
+            ids = self.ids(response) + ids
+        self.assertEqual(ids, [m.id for m in self.messages])
+
+    def test_after_returns_newer_messages(self):
+        response = self.client.get(self.url, {"after": self.messages[-3].id, "limit": 10})
+        self.assertEqual(self.ids(response), [m.id for m in self.messages[-2:]])
+        self.assertFalse(response.data["has_newer"])
+
+    def test_rejects_cursors_from_other_rooms(self):
+        other_room = ChatRoom.objects.create(user1=self.me, user2=self.other, item_id=2)
+        message = Message.objects.create(
+            room=other_room, sender=self.other, receiver=self.me, content="elsewhere"
+        )
+        response = self.client.get(self.url, {"before": message.id})
+        self.assertEqual(response.status_code, 400)
+
+    def test_page_cost_does_not_grow_with_the_room(self):
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(self.url, {"before": self.messages[-1].id})
+            self.assertEqual(len(response.data["messages"]), 50)
+            return len(queries)
+
+        few = count_queries()
+        self.messages = self.send(200)
+        self.assertEqual(count_queries(), few)
+
+
+class ReadReceiptTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.me = User.objects.create_user(username="me", password="pass")
+        self.other = User.objects.create_user(username="other", password="pass")
+        self.client.force_authenticate(user=self.me)
+        self.room = ChatRoom.objects.create(user1=self.me, user2=self.other, item_id=1)
+        Message.objects.create(room=self.room, sender=self.me, receiver=self.other, content="q")
+        self.sent = [
+            Message.objects.create(
+                room=self.room, sender=self.other, receiver=self.me, content=str(i)
+            )
+            for i in range(5)
+        ]
+        self.layer = get_channel_layer()
+        self.channel = async_to_sync(self.layer.new_channel)()
+        async_to_sync(self.layer.group_add)(f"chat_{self.room.id}", self.channel)
+
+    def test_mark_read_is_one_update(self):
+        url = reverse("mark-room-as-read", args=[self.room.id])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url)
+        self.assertEqual(response.data["message"], "Marked 5 messages as read")
+        updates = [q for q in queries if q["sql"].startswith('UPDATE "chat_message"')]
+        self.assertEqual(len(updates), 1)
+        self.assertFalse(Message.objects.filter(receiver=self.me, is_read=False).exists())
+        # my own message to the other user is still unread
+        self.assertTrue(Message.objects.filter(receiver=self.other, is_read=False).exists())
+
+    def test_receipt_is_broadcast_to_the_room(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.get(reverse("chat_history", args=[self.room.id]))
+        self.assertTrue(all(m["is_read"] for m in response.data["messages"][1:]))
+        event = async_to_sync(self.layer.receive)(self.channel)
+        self.assertEqual(event["type"], "read_receipt")
+        self.assertEqual(event["reader_id"], self.me.id)
+        self.assertEqual(event["first_id"], self.sent[0].id)
+        self.assertEqual(event["last_id"], self.sent[-1].id)
+        self.assertEqual(event["count"], 5)
+
+    def test_consumer_forwards_receipts(self):
+        async def receive_receipt():
+            communicator = WebsocketCommunicator(
+                ChatConsumer.as_asgi(), f"/ws/chat/{self.room.id}/"
+            )
+            communicator.scope["url_route"] = {"kwargs": {"room_id": str(self.room.id)}}
+            communicator.scope["user"] = self.me
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.receive_json_from()  # the other user's presence
+            await self.layer.group_send(
+                f"chat_{self.room.id}",
+                {"type": "read_receipt", "reader_id": self.me.id, "first_id": 1, "last_id": 2},
+            )
+            frame = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return frame
+
+        frame = async_to_sync(receive_receipt)()
+        self.assertEqual(frame["type"], "read_receipt")
+        self.assertEqual(frame["last_id"], 2)
+
+
+class ChatConsumerTestCase(APITestCase):
+    def setUp(self):
+        self.me = User.objects.create_user(username="me", password="pass")
+        self.other = User.objects.create_user(username="other", password="pass")
+        self.stranger = User.objects.create_user(username="stranger", password="pass")
+        self.room = ChatRoom.objects.create(user1=self.me, user2=self.other, item_id=1)
+        self.application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+    def communicator(self, user=None, subprotocol=False):
+        path = f"/ws/chat/{self.room.id}/"
+        token = str(AccessToken.for_user(user)) if user else None
+        if token and subprotocol:
+            return WebsocketCommunicator(
+                self.application, path, subprotocols=["access_token", token]
+            )
+        return WebsocketCommunicator(
+            self.application, f"{path}?token={token}" if token else path
+        )
+
+    def test_messages_are_sent_as_the_authenticated_user(self):
+        async def chat():
+            communicator = self.communicator(self.me)
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.receive_json_from()  # the other user's presence
+            # the user_id of the payload is ignored
+            await communicator.send_json_to({"message": "hi", "user_id": self.stranger.id})
+            frame = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return frame
+
+        frame = async_to_sync(chat)()
+        self.assertEqual(frame["user_id"], self.me.id)
+        self.assertEqual(frame["receiver_id"], self.other.id)
+        self.assertEqual(frame["username"], "me")
+        message = Message.objects.get()
+        self.assertEqual((message.sender, message.receiver), (self.me, self.other))
+
+    def test_bad_frames_are_answered_with_errors(self):
+        async def chat():
+            communicator = self.communicator(self.me)
+            await communicator.connect()
+            await communicator.receive_json_from()  # the other user's presence
+            await communicator.send_to(text_data="not json")
+            await communicator.send_to(bytes_data=b"\x00")
+            await communicator.send_json_to(["hi"])
+            await communicator.send_json_to({"type": "shout", "message": "hi"})
+            await communicator.send_json_to({"message": None})
+            errors = [await communicator.receive_json_from() for _ in range(5)]
+            # the socket is still up
+            await communicator.send_json_to({"message": "still here"})
+            frame = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return errors, frame
+
+        errors, frame = async_to_sync(chat)()
+        self.assertEqual({error["type"] for error in errors}, {"error"})
+        self.assertEqual(
+            [error["error"] for error in errors],
+            ["Frames must be JSON objects"] * 3 + ["Unknown frame type 'shout'", "No message"],
+        )
+        self.assertEqual(errors[-1]["room_id"], self.room.id)
+        self.assertEqual(frame["message"], "still here")
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_token_in_subprotocol(self):
+        async def connect():
+            communicator = self.communicator(self.other, subprotocol=True)
+            connected, subprotocol = await communicator.connect()
+            await communicator.disconnect()
+            return connected, subprotocol
+
+        self.assertEqual(async_to_sync(connect)(), (True, "access_token"))
+
+    def test_rejects_anonymous_users_and_strangers(self):
+        async def connect(user=None, path=None):
+            if path:
+                communicator = WebsocketCommunicator(self.application, path)
+            else:
+                communicator = self.communicator(user)
+            return await communicator.connect()
+
+        self.assertEqual(async_to_sync(connect)(), (False, 4001))
+        self.assertEqual(async_to_sync(connect)(self.stranger), (False, 4003))
+        bad_token = f"/ws/chat/{self.room.id}/?token=not-a-jwt"
+        self.assertEqual(async_to_sync(connect)(path=bad_token), (False, 4001))
+
+
+@override_settings(CHAT_WRITE_BEHIND=True, CHAT_WRITE_BEHIND_BATCH=3, NOTIFICATION_WORKER=False)
+class WriteBehindTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.me = User.objects.create_user(username="me", password="pass")
+        self.other = User.objects.create_user(username="other", password="pass")
+        self.room = ChatRoom.objects.create(user1=self.me, user2=self.other, item_id=1)
+        self.application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+    def chat(self, *messages):
+        async def chat():
+            path = f"/ws/chat/{self.room.id}/?token={AccessToken.for_user(self.me)}"
+            communicator = WebsocketCommunicator(self.application, path)
+            await communicator.connect()
+            await communicator.receive_json_from()  # the other user's presence
+            frames = []
+            for message in messages:
+                await communicator.send_json_to({"message": message})
+                frames.append(await communicator.receive_json_from())
+            await communicator.disconnect()  # saves what is left in the buffer
+            return frames
+
+        return async_to_sync(chat)()
+
+    def test_messages_are_saved_in_batches(self):
+        with CaptureQueriesContext(connection) as queries:
+            with self.captureOnCommitCallbacks(execute=True):
+                frames = self.chat("one", "two", "three", "four")
+        self.assertEqual([frame["message"] for frame in frames], ["one", "two", "three", "four"])
+        messages = list(Message.objects.order_by("id"))
+        self.assertEqual([m.content for m in messages], ["one", "two", "three", "four"])
+        # saved with the time they were broadcast with
+        self.assertEqual(
+            [frame["timestamp"] for frame in frames], [m.timestamp.isoformat() for m in messages]
+        )
+        inserts = [
+            q for q in queries.captured_queries if q["sql"].startswith('INSERT INTO "chat_message"')
+        ]
+        self.assertEqual(len(inserts), 2)
+        # the notifications of the room collapse into one
+        notification = Notification.objects.get(recipient=self.other)
+        self.assertEqual(notification.count, 4)
+        self.assertEqual(unread.total(self.other.id), 4)
+        self.assertEqual(UnreadCounter.objects.get(user=self.other).count, 4)
+
+    def test_failed_batch_is_retried(self):
+        bulk_send = Message.bulk_send
+        calls = []
+
+        def flaky(messages):
+            calls.append(len(messages))
+            if len(calls) == 1:
+                raise DatabaseError("gone away")
+            return bulk_send(messages)
+
+        with mock.patch.object(Message, "bulk_send", side_effect=flaky):
+            with self.assertLogs("chat.buffer"):
+                self.chat("one", "two", "three", "four")
+        # the failed batch is saved one message at a time
+        self.assertEqual(calls, [3, 1, 1, 1, 1])
+        self.assertEqual(Message.objects.count(), 4)
+
+    @override_settings(CHAT_WRITE_BEHIND_INTERVAL=1)
+    def test_failing_timer_flush_survives_another_flush(self):
+        bulk_send = Message.bulk_send
+        entered, release = threading.Event(), threading.Event()
+
+        def slow_failure(messages):
+            if not entered.is_set():
+                entered.set()
+                release.wait(5)
+                raise DatabaseError("gone away")
+            return bulk_send(messages)
+
+        buffer = MessageBuffer()
+
+        def message(content):
+            return Message(room=self.room, sender=self.me, receiver=self.other, content=content)
+
+        async def flush():
+            await buffer.add(message("one"))
+            timer = buffer.timer
+            while not entered.is_set():  # the timer's flush is saving "one"
+                await asyncio.sleep(0.001)
+            await buffer.add(message("two"))
+            # e.g. a socket disconnecting
+            other = asyncio.ensure_future(buffer.flush())
+            await asyncio.sleep(0.01)
+            release.set()
+            await other
+            await timer
+            # wait for the retry, whichever flush picks it up
+            while buffer.pending or len(asyncio.all_tasks()) > 1:
+                await asyncio.sleep(0.01)
+
+        with mock.patch.object(Message, "bulk_send", side_effect=slow_failure):
+            with self.assertLogs("chat.buffer"):
+                async_to_sync(flush)()
+        self.assertEqual(
+            sorted(Message.objects.values_list("content", flat=True)), ["one", "two"]
+        )
+
+    @override_settings(CHAT_WRITE_BEHIND_RETRIES=2, CHAT_WRITE_BEHIND_INTERVAL=1)
+    def test_message_that_cannot_be_saved_is_dropped(self):
+        bulk_send = Message.bulk_send
+
+        def poisoned(messages):
+            if any(message.content == "poison" for message in messages):
+                raise DatabaseError("violates foreign key constraint")
+            return bulk_send(messages)
+
+        buffer = MessageBuffer()
+
+        async def flush():
+            for content in ("one", "poison", "two"):
+                await buffer.add(
+                    Message(room=self.room, sender=self.me, receiver=self.other, content=content)
+                )
+            return [await buffer.flush() for _ in range(4)]
+
+        with mock.patch.object(Message, "bulk_send", side_effect=poisoned):
+            with self.assertLogs("chat.buffer") as logs:
+                saved = async_to_sync(flush)()
+        # the others are saved right away, the poisoned one is retried twice then dropped
+        self.assertEqual(saved, [2, 0, 0, 0])
+        self.assertEqual(buffer.pending, [])
+        self.assertEqual(
+            list(Message.objects.order_by("id").values_list("content", flat=True)),
+            ["one", "two"],
+        )
+        self.assertIn("after 3 attempts", logs.output[-1])
+
+
+@override_settings(NOTIFICATION_WORKER=False)
+class UserSocketTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.me = User.objects.create_user(username="me", password="pass")
+        self.other = User.objects.create_user(username="other", password="pass")
+        self.third = User.objects.create_user(username="third", password="pass")
+        self.room = ChatRoom.objects.create(user1=self.me, user2=self.other, item_id=1)
+        self.second_room = ChatRoom.objects.create(user1=self.third, user2=self.me, item_id=2)
+        self.application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+        self.layer = get_channel_layer()
+
+    def communicator(self, user):
+        return WebsocketCommunicator(
+            self.application, f"/ws/user/?token={AccessToken.for_user(user)}"
+        )
+
+    def test_connect_sends_unread_counts(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.create(
+                room=self.room, sender=self.other, receiver=self.me, content="hi"
+            )
+
+        async def connect():
+            communicator = self.communicator(self.me)
+            connected, _ = await communicator.connect()
+            frame = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return connected, frame
+
+        connected, frame = async_to_sync(connect)()
+        self.assertTrue(connected)
+        self.assertEqual(frame, {"type": "unread_counts", "chat": 1, "notifications": 1})
+
+        async def connect_anonymously():
+            return await WebsocketCommunicator(self.application, "/ws/user/").connect()
+
+        self.assertEqual(async_to_sync(connect_anonymously)(), (False, 4001))
+
+    def test_carries_messages_of_every_room(self):
+        async def chat():
+            mine, others, thirds = (self.communicator(u) for u in (self.me, self.other, self.third))
+            for communicator in (mine, others, thirds):
+                await communicator.connect()
+                await communicator.receive_json_from()  # unread_counts
+            await others.send_json_to({"room_id": self.room.id, "message": "from other"})
+            await thirds.send_json_to({"room_id": self.second_room.id, "message": "from third"})
+            frames = [await mine.receive_json_from() for _ in range(2)]
+            # the sender's own socket gets the message too, e.g. for their other devices
+            echo = await others.receive_json_from()
+            await thirds.receive_json_from()
+            # and nobody can send to rooms that aren't theirs
+            await thirds.send_json_to({"room_id": self.room.id, "message": "sneaky"})
+            error = await thirds.receive_json_from()
+            for communicator in (mine, others, thirds):
+                await communicator.disconnect()
+            return frames, echo, error
+
+        frames, echo, error = async_to_sync(chat)()
+        self.assertEqual(
+            {(f["type"], f["room_id"], f["message"]) for f in frames},
+            {
+                ("chat_message", self.room.id, "from other"),
+                ("chat_message", self.second_room.id, "from third"),
+            },
+        )
+        self.assertEqual(echo["message"], "from other")
+        self.assertEqual(error["type"], "error")
+        self.assertFalse(Message.objects.filter(content="sneaky").exists())
+
+    def test_typing_ping_and_bad_frames(self):
+        async def chat():
+            mine, others = self.communicator(self.me), self.communicator(self.other)
+            for communicator in (mine, others):
+                await communicator.connect()
+                await communicator.receive_json_from()  # unread_counts
+            await others.send_json_to({"type": "ping"})
+            await others.send_json_to({"type": "typing", "room_id": self.room.id})
+            typing = await mine.receive_json_from()
+            await others.send_json_to({"room_id": self.room.id})
+            await others.send_json_to({"message": "where to?"})
+            await others.send_to(text_data="{")
+            errors = [await others.receive_json_from() for _ in range(3)]
+            # the socket is still up
+            await others.send_json_to({"room_id": self.room.id, "message": "still here"})
+            message = await mine.receive_json_from()
+            for communicator in (mine, others):
+                await communicator.disconnect()
+            return typing, errors, message
+
+        typing, errors, message = async_to_sync(chat)()
+        self.assertEqual(
+            typing,
+            {"type": "typing", "room_id": self.room.id, "user_id": self.other.id, "typing": True},
+        )
+        self.assertEqual(
+            [e["error"] for e in errors],
+            ["No message", "Chat room not found", "Frames must be JSON objects"],
+        )
+        self.assertEqual(message["message"], "still here")
+
+    def test_unread_deltas_notifications_and_receipts_are_pushed(self):
+        mine = async_to_sync(self.layer.new_channel)()
+        others = async_to_sync(self.layer.new_channel)()
+        async_to_sync(self.layer.group_add)(f"user_{self.me.id}", mine)
+        async_to_sync(self.layer.group_add)(f"user_{self.other.id}", others)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.create(
+                room=self.room, sender=self.other, receiver=self.me, content="hi"
+            )
+        events = {}
+        for _ in range(2):
+            event = async_to_sync(self.layer.receive)(mine)
+            events[event["type"]] = event
+        self.assertEqual(events["unread_count"]["room_id"], self.room.id)
+        self.assertEqual(events["unread_count"]["delta"], 1)
+        self.assertEqual(events["notification"]["notification"]["type"], "chat")
+        self.assertEqual(events["notification"]["unread_count"], 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            unread.mark_room_read(self.room.id, self.me.id)
+        event = async_to_sync(self.layer.receive)(mine)
+        self.assertEqual((event["type"], event["delta"]), ("unread_count", -1))
+        receipt = async_to_sync(self.layer.receive)(others)
+        self.assertEqual((receipt["type"], receipt["room_id"]), ("read_receipt", self.room.id))
+        self.assertEqual(receipt["reader_id"], self.me.id)
+
+
+class PresenceTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.me = User.objects.create_user(username="me", password="pass")
+        self.other = User.objects.create_user(username="other", password="pass")
+        self.room = ChatRoom.objects.create(user1=self.me, user2=self.other, item_id=1)
+        self.application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+    def communicator(self, user):
+        path = f"/ws/chat/{self.room.id}/?token={AccessToken.for_user(user)}"
+        return WebsocketCommunicator(self.application, path)
+
+    def test_online_and_last_seen(self):
+        async def visit():
+            mine = self.communicator(self.me)
+            await mine.connect()
+            before = await mine.receive_json_from()
+            others = self.communicator(self.other)
+            await others.connect()
+            seen_by_other = await others.receive_json_from()
+            came = await mine.receive_json_from()
+            await others.disconnect()
+            left = await mine.receive_json_from()
+            await mine.disconnect()
+            return before, seen_by_other, came, left
+
+        before, seen_by_other, came, left = async_to_sync(visit)()
+        self.assertEqual(
+            before,
+            {"type": "presence", "user_id": self.other.id, "online": False, "last_seen": None},
+        )
+        self.assertTrue(seen_by_other["online"])
+        self.assertEqual((came["user_id"], came["online"]), (self.other.id, True))
+        self.assertEqual((left["user_id"], left["online"]), (self.other.id, False))
+        self.assertIsNotNone(left["last_seen"])
+
+    def test_typing_is_throttled_and_costs_no_queries(self):
+        async def chat(typing):
+            mine, others = self.communicator(self.me), self.communicator(self.other)
+            await mine.connect()
+            await mine.receive_json_from()
+            await others.connect()
+            await others.receive_json_from()
+            await mine.receive_json_from()  # the other user came online
+            for _ in range(typing):
+                await mine.send_json_to({"type": "typing", "typing": True})
+            frames = []
+            while not await others.receive_nothing(timeout=0.2):
+                frames.append(await others.receive_json_from())
+            await others.disconnect()
+            await mine.disconnect()
+            return frames
+
+        with CaptureQueriesContext(connection) as quiet:
+            self.assertEqual(async_to_sync(chat)(0), [])
+        cache.clear()
+        with CaptureQueriesContext(connection) as typing:
+            frames = async_to_sync(chat)(20)
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(frames[0]["type"], "typing")
+        self.assertEqual(frames[0]["user_id"], self.me.id)
+        self.assertEqual(len(typing), len(quiet))
+
+
+class ResumeTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.me = User.objects.create_user(username="me", password="pass")
+        self.other = User.objects.create_user(username="other", password="pass")
+        self.room = ChatRoom.objects.create(user1=self.me, user2=self.other, item_id=1)
+        self.sent = [
+            Message.objects.create(
+                room=self.room, sender=self.other, receiver=self.me, content=str(i)
+            )
+            for i in range(5)
+        ]
+        self.application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+    def test_messages_are_numbered_per_room(self):
+        self.assertEqual([m.seq for m in self.sent], [1, 2, 3, 4, 5])
+        second_room = ChatRoom.objects.create(user1=self.me, user2=self.other, item_id=2)
+        batch = [
+            Message(room=room, sender=self.me, receiver=self.other, content="batch")
+            for room in (self.room, second_room, self.room)
+        ]
+        Message.bulk_send(batch)
+        self.assertEqual([m.seq for m in batch], [6, 1, 7])
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_seq, 7)
+
+    def resume(self, resume_from, send=None):
+        async def resume():
+            path = (
+                f"/ws/chat/{self.room.id}/?token={AccessToken.for_user(self.me)}"
+                f"&resume_from={resume_from}"
+            )
+            communicator = WebsocketCommunicator(self.application, path)
+            await communicator.connect()
+            await communicator.receive_json_from()  # the other user's presence
+            if send:
+                await communicator.send_json_to({"message": send})
+            frames = []
+            while not await communicator.receive_nothing(timeout=0.2):
+                frames.append(await communicator.receive_json_from())
+            await communicator.disconnect()
+            return frames
+
+        return async_to_sync(resume)()
+
+    def test_missed_messages_are_replayed_before_live_ones(self):
+        with CaptureQueriesContext(connection) as queries:
+            frames = self.resume(2, send="back")
+        self.assertEqual([f["seq"] for f in frames], [3, 4, 5, 6])
+        self.assertEqual([f["message"] for f in frames], ["2", "3", "4", "back"])
+        self.assertEqual(frames[0]["username"], "other")
+        replays = [q for q in queries.captured_queries if '"chat_message"."seq" >' in q["sql"]]
+        self.assertEqual(len(replays), 1)
+
+    def test_too_many_missed_messages_ask_for_a_resync(self):
+        with mock.patch("chat.consumers.REPLAY_LIMIT", 2):
+            frames = self.resume(0)
+        self.assertEqual(frames, [{"type": "resync"}])
+        self.assertEqual(self.resume(5), [])
@@ -0,0 +1,201 @@
+# unread.py - Maintained unread message counts
+# Every user has an UnreadCounter row per room, bumped when a message is sent to them and
+# reset when they read the room. Their total across all rooms is mirrored in the cache, so the
+# unread count the app keeps polling is a single cache read however many rooms they have.
+# The recount_unread command repairs counters that drifted from the messages.
+# Reading a room marks its messages read with a single UPDATE and sends a read_receipt event
+# to the room's channel group, so the sender sees it live.
+# Every committed change is also pushed to the user's socket (see chat.events), so the app
+# doesn't have to poll for it.
+
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F, Max, Min, Sum
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from . import events
+
+logger = logging.getLogger(__name__)
+
+# totals are rebuilt from the counters at least this often, in case the cache missed a delta
+TOTAL_TIMEOUT = 24 * 60 * 60
+REBUILD_TIMEOUT = 60  # seconds a rebuild of a total may take
+
+
+def total_key(user_id):
+    return f"chat:unread:{user_id}"
+
+
+def rebuild_key(user_id):
+    # deltas that arrived while total() was counting
+    return f"chat:unread:{user_id}:rebuild"
+
+
+def adjust(room_id, user_id, delta):
+    """
+    Adds delta to the user's unread counter of a room (never going below 0), and to their
+    cached total once the transaction commits.
+    """
+    from .models import UnreadCounter
+
+    counters = UnreadCounter.objects.filter(user_id=user_id, room_id=room_id)
+    if delta < 0:
+        if counters.filter(count__gt=0).update(count=Greatest(F("count") + delta, 0)):
+            transaction.on_commit(lambda: changed(room_id, user_id, delta))
+        return
+
+    if not counters.update(count=F("count") + delta):
+        try:
+            with transaction.atomic():
+                UnreadCounter.objects.create(user_id=user_id, room_id=room_id, count=delta)
+        except IntegrityError:
+            # another message created the row first
+            counters.update(count=F("count") + delta)
+    transaction.on_commit(lambda: changed(room_id, user_id, delta))
+
+
+def reset(room_id, user_id):
+    """
+    Sets the user's unread counter of a room back to 0, as they have read all of it.
+
+    Returns:
+        int: How many messages were unread.
+    """
+    from .models import UnreadCounter
+
+    with transaction.atomic():
+        counter = (
+            UnreadCounter.objects.select_for_update()
+            .filter(user_id=user_id, room_id=room_id, count__gt=0)
+            .first()
+        )
+        if counter is None:
+            return 0
+        UnreadCounter.objects.filter(id=counter.id).update(count=0)
+    transaction.on_commit(lambda: changed(room_id, user_id, -counter.count))
+    return counter.count
+
+
+def changed(room_id, user_id, delta):
+    # a counter change was committed
+    events.send_to_user(
+        user_id,
+        {
+            "type": "unread_count",
+            "room_id": room_id,
+            "delta": delta,
+            "total": adjust_total(user_id, delta),
+        },
+    )
+
+
+def adjust_total(user_id, delta):
+    """
+    Adds delta to the cached total of the user.
+
+    Returns:
+        int: The new total, or None if it isn't cached.
+    """
+    try:
+        count = cache.incr(total_key(user_id), delta)
+    except ValueError:
+        # not cached, the next total() reads the counters anyway; a total() counting right
+        # now may have missed this delta, so it is told not to cache its count
+        try:
+            cache.incr(rebuild_key(user_id), 1)
+        except ValueError:
+            pass
+        return None
+    if count < 0:
+        forget(user_id)
+        return None
+    return count
+
+
+def forget(*user_ids):
+    """
+    Drops the cached totals of users, e.g. after rooms were deleted or counters repaired.
+    """
+    cache.delete_many([total_key(user_id) for user_id in user_ids])
+
+
+def total(user_id):
+    """
+    Returns the number of unread messages of the user across all rooms.
+    """
+    count = cache.get(total_key(user_id))
+    if count is None:
+        # seeded only if no delta came in while counting, as the count may or may not
+        # include it and incrementing the seeded total would then lose or repeat it
+        cache.set(rebuild_key(user_id), 0, REBUILD_TIMEOUT)
+        count = count_counters(user_id)
+        if cache.get(rebuild_key(user_id)) == 0:
+            cache.add(total_key(user_id), count, TOTAL_TIMEOUT)
+        cache.delete(rebuild_key(user_id))
+    return count
+
+
+def count_counters(user_id):
+    from .models import UnreadCounter
+
+    return (
+        UnreadCounter.objects.filter(user_id=user_id).aggregate(total=Sum("count"))["total"] or 0
+    )
+
+
+def mark_room_read(room_id, user_id):
+    """
+    Marks every message sent to the user in a room as read with one UPDATE and resets their
+    counter in the same transaction, then broadcasts a read receipt to the room and the
+    sender's socket once it commits.
+
+    Returns:
+        dict: The receipt: "reader_id", the "first_id" and "last_id" of the messages marked
+            read, their "count" and "read_at". None if there was nothing to mark.
+    """
+    from .models import ChatRoom, Message
+
+    unread_messages = Message.objects.filter(room_id=room_id, is_read=False).exclude(
+        sender_id=user_id
+    )
+    with transaction.atomic():
+        # the room is locked first. Sending a message numbers it with an UPDATE of the room
+        # and counts it in the same transaction (see Message.save and bulk_send), so a message
+        # sent meanwhile is either committed and counted before this reads, or waits for this
+        # to commit: it is never marked read here and then counted, nor reset uncounted. The
+        # room row exists even when the user has no counter yet.
+        list(ChatRoom.objects.select_for_update().filter(id=room_id).values_list("id", flat=True))
+        # the unread messages all come from the other user of the room
+        span = unread_messages.aggregate(
+            first_id=Min("id"), last_id=Max("id"), sender_id=Max("sender_id")
+        )
+        sender_id = span.pop("sender_id")
+        if span["last_id"] is None:
+            reset(room_id, user_id)
+            return None
+
+        read_at = timezone.now()
+        count = unread_messages.filter(id__lte=span["last_id"]).update(
+            is_read=True, read_at=read_at
+        )
+        reset(room_id, user_id)
+    receipt = {"reader_id": user_id, **span, "count": count, "read_at": read_at.isoformat()}
+    transaction.on_commit(lambda: send_read_receipt(room_id, sender_id, receipt))
+    return receipt
+
+
+def send_read_receipt(room_id, sender_id, receipt):
+    try:
+        async_to_sync(get_channel_layer().group_send)(
+            f"chat_{room_id}", {"type": "read_receipt", **receipt}
+        )
+    except Exception:
+        # the receipt is only a live update, the messages are marked read already
+        logger.exception("Could not send the read receipt of room %s", room_id)
+    events.send_to_user(sender_id, {"type": "read_receipt", "room_id": room_id, **receipt})
+
@@ -1,4 +1,3 @@
-from django.utils import timezone
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.decorators import api_view, permission_classes
@@ -6,54 +5,75 @@ from rest_framework.permissions import IsAuthenticated
 
 from django.contrib.auth.models import User
 from chat.serializers import ChatRoomSerializer, MessageSerializer
+from . import unread
 from .models import ChatRoom, Message
-from django.db.models import Q
+from django.db.models import Count, Max, Q
+from django.db.models.functions import Coalesce
+from items.models import Listing
+from items.pagination import HttpsCursorPagination
 
 # using api_view here cause I'm scared I'll break something
 
 
+DEFAULT_HISTORY_PAGE = 50
+MAX_HISTORY_PAGE = 200
+
+
+class RoomCursorPagination(HttpsCursorPagination):
+    """
+    Rooms with the latest activity first. Most users have only a handful of rooms, so a
+    page holds more of them than a page of listings.
+    """
+
+    page_size = 50
+    ordering = ("-last_activity", "-id")
+
+
 @api_view(["GET"])
 def room_list(request):
+    """
+    Lists the current user's rooms, most recently active first, with their unread count,
+    message count and last message time.
+
+    Everything comes from one annotated query plus one query for the item titles of the
+    page, however many rooms the user has.
+
+    Returns:
+        Response: {"rooms": [...], "next": <url or None>, "previous": <url or None>}
+    """
     # get current user
     user = request.user
 
-    # find rooms for current user
-    rooms = ChatRoom.objects.filter(Q(user1=user) | Q(user2=user))
-
-    # get unread counts for each room
-    room_data = []
-    for room in rooms:
-        # get unread message count for this user
-        unread_count = (
-            Message.objects.filter(
-                room=room,
-                is_read=False,
-            )
-            .exclude(sender=user)
-            .count()
+    # find rooms for current user, counting messages in the same query
+    rooms = (
+        ChatRoom.objects.filter(Q(user1=user) | Q(user2=user))
+        .select_related("user1", "user2")
+        .annotate(
+            message_count=Count("messages"),
+            # unread message count for this user
+            unread_count=Count(
+                "messages", filter=Q(messages__is_read=False) & ~Q(messages__sender=user)
+            ),
+            # now get the timestamp of the last message
+            last_message_time=Max("messages__timestamp"),
+            last_activity=Coalesce(Max("messages__timestamp"), "created_at"),
         )
+    )
+    paginator = RoomCursorPagination()
+    page = paginator.paginate_queryset(rooms, request)
 
-        # now get the timestamp of the last message
-        last_message = Message.objects.filter(room=room).order_by("-timestamp").first()
-        last_message_time = last_message.timestamp if last_message else None
+    # the titles of all the items of the page in one query
+    item_ids = {room.item_id for room in page if room.item_id}
+    item_titles = dict(Listing.objects.filter(id__in=item_ids).values_list("id", "title"))
 
-        # create a temporary dict with room data
-        room_dict = {
-            "room": room,
-            "unread_count": unread_count,
-            "last_message_time": last_message_time,
+    serializer = ChatRoomSerializer(page, many=True, context={"item_titles": item_titles})
+    return Response(
+        {
+            "rooms": serializer.data,
+            "next": paginator.get_next_link(),
+            "previous": paginator.get_previous_link(),
         }
-        room_data.append(room_dict)
-
-    # serialize the rooms with additional data
-    serialized_rooms = []
-    for item in room_data:
-        serializer = ChatRoomSerializer(item["room"])
-        data = serializer.data
-        data["unread_count"] = item["unread_count"]
-        data["last_message_time"] = item["last_message_time"]
-        serialized_rooms.append(data)
-    return Response({"rooms": serialized_rooms})
+    )
 
 
 @api_view(["GET"])
@@ -62,27 +82,28 @@ def unread_count(request):
     """
     Get the total count of unread messages across all chat rooms for the current user
     """
-    user = request.user
-    rooms = ChatRoom.objects.filter(
-        Q(user1=user) | Q(user2=user)
-    )  # get the rooms the user is part of
-    # Count all the unread messages not setn by the current user
-    total_unread = 0
-    for room in rooms:
-        unread_count = (
-            Message.objects.filter(
-                room=room,
-                is_read=False,
-            )
-            .exclude(sender=user)
-            .count()
-        )
-        total_unread += unread_count
-    return Response({"unread_count": total_unread})
+    # a cache read, the counters are maintained as messages are sent and read (see chat.unread)
+    return Response({"unread_count": unread.total(request.user.id)})
 
 
 @api_view(["GET"])
 def chat_history(request, room_id):
+    """
+    Returns a page of the room's messages, oldest first.
+
+    Without a cursor this is the latest page. Clients scroll back with ?before=<id of the
+    oldest message they have> and catch up with ?after=<id of the newest one>. Pages are read
+    straight off the (room, timestamp, id) index, so they cost the same however long the
+    conversation is.
+
+    Args:
+        request (Request): The request object. Takes an optional "before" or "after" message
+            id and "limit" (default 50, at most 200).
+        room_id (int): The id of the room.
+
+    Returns:
+        Response: {"messages": [...], "has_older": bool, "has_newer": bool}
+    """
     try:
         # get room
         room = ChatRoom.objects.get(id=room_id)
@@ -91,29 +112,69 @@ def chat_history(request, room_id):
         user = request.user
 
         # check if the user has access to this room
-        if user != room.user1 and user != room.user2:
+        if user.id not in (room.user1_id, room.user2_id):
             return Response(
                 {"error": "You don't have access to this room"},
                 status=status.HTTP_403_FORBIDDEN,
             )
-        # find messages for current room & sort by timestamp
-        messages = Message.objects.filter(room=room).order_by("timestamp")
-
-        # filter messages that are read when history is fetched
-        unread_messagees = messages.filter(is_read=False).exclude(sender=user)
-        current_time = timezone.now()
-
-        # mark those messages as read
-        for message in unread_messagees:
-            message.is_read = True
-            message.read_at = current_time
-            message.save()
-        # serialize messages for response
-        serializer = MessageSerializer(messages, many=True)
-        return Response({"messages": serializer.data})
     except ChatRoom.DoesNotExist:
         return Response(status=status.HTTP_404_NOT_FOUND)
 
+    try:
+        limit = int(request.query_params.get("limit", DEFAULT_HISTORY_PAGE))
+    except ValueError:
+        limit = DEFAULT_HISTORY_PAGE
+    limit = min(max(limit, 1), MAX_HISTORY_PAGE)
+
+    messages = Message.objects.filter(room=room).select_related("sender")
+    before = request.query_params.get("before")
+    after = request.query_params.get("after")
+    cursor_id = before or after
+    if cursor_id:
+        cursor = None
+        if cursor_id.isdigit():
+            cursor = messages.filter(id=cursor_id).values("timestamp", "id").first()
+        if cursor is None:
+            return Response(
+                {"error": "The cursor is not a message of this room"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+    if after and not before:
+        # newer messages, oldest first
+        page = list(
+            messages.filter(
+                Q(timestamp__gt=cursor["timestamp"])
+                | Q(timestamp=cursor["timestamp"], id__gt=cursor["id"])
+            ).order_by("timestamp", "id")[: limit + 1]
+        )
+        has_newer, has_older = len(page) > limit, True
+        page = page[:limit]
+    else:
+        # the latest messages, or the ones before the cursor
+        if before:
+            messages = messages.filter(
+                Q(timestamp__lt=cursor["timestamp"])
+                | Q(timestamp=cursor["timestamp"], id__lt=cursor["id"])
+            )
+        page = list(messages.order_by("-timestamp", "-id")[: limit + 1])
+        has_older, has_newer = len(page) > limit, bool(before)
+        page = page[:limit][::-1]
+
+    if not before:
+        # the user is looking at the latest messages, so mark the unread ones as read
+        receipt = unread.mark_room_read(room.id, user.id)
+        for message in page if receipt else []:
+            read_now = not message.is_read and message.sender_id != user.id
+            if read_now and message.id <= receipt["last_id"]:
+                message.is_read, message.read_at = True, receipt["read_at"]
+
+    # serialize messages for response
+    serializer = MessageSerializer(page, many=True)
+    return Response(
+        {"messages": serializer.data, "has_older": has_older, "has_newer": has_newer}
+    )
+
 
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
@@ -172,19 +233,10 @@ def mark_room_as_read(request, room_id):
                 status=status.HTTP_403_FORBIDDEN,
             )
 
-        # Now find the messagees that are unread nad not sent by the current user
-        unread_messages = Message.objects.filter(
-            room=room,
-            is_read=False,
-        ).exclude(sender=user)
-
-        # Mark messages as read with a timestamp
-        unread_count = unread_messages.count()
-        current_time = timezone.now()
-        for message in unread_messages:
-            message.is_read = True
-            message.read_at = current_time
-            message.save()
+        # Mark the messages that are unread and not sent by the current user as read,
+        # with one UPDATE, and let the sender know over the websocket
+        receipt = unread.mark_room_read(room.id, user.id)
+        unread_count = receipt["count"] if receipt else 0
         return Response(
             {
                 "success": True,
@@ -212,6 +264,8 @@ def delete_room(request, room_id):
             return Response({"error": "Unauthorized"}, status=status.HTTP_403_FORBIDDEN)
 
         room.delete()
+        # their counters of the room are gone with it, so are the totals
+        unread.forget(room.user1_id, room.user2_id)
         return Response({"success": "Chat room deleted successfully"})
     except ChatRoom.DoesNotExist:
         return Response(
@@ -0,0 +1,100 @@
+import random
+import statistics
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from categories.models import Category
+from items.models import Listing
+from items.search import QFilterSearchBackend, get_search_backend
+
+WORDS = [
+    "calculator", "textbook", "lamp", "desk", "chair", "bike", "helmet", "monitor",
+    "keyboard", "mouse", "jacket", "boots", "microwave", "fridge", "kettle", "poster",
+    "guitar", "speaker", "headphones", "charger", "backpack", "mattress", "rug", "mirror",
+    "chemistry", "calculus", "biology", "economics", "vintage", "wooden", "blue", "large",
+]
+# filler vocabulary so the common words above stay reasonably selective, like in real listings
+FILLER = [f"{a}{b}{c}" for a in "bdfgklmnprstv" for b in "aeiou" for c in "nrstlkm"]
+QUERIES = ["calculator", "calc", "wooden desk", "chemistry textbook", "zzzz"]
+PAGE_SIZE = 10
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark listing search latency of the search backend against the old icontains "
+        "scan on synthetic listings. Everything runs in a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            nargs="+",
+            type=int,
+            default=[10_000, 100_000, 1_000_000],
+            help="Listing counts to measure at (default: 10k, 100k and 1M)",
+        )
+        parser.add_argument(
+            "--repeat", type=int, default=20, help="Runs per query (default: 20)"
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=5_000, help="Rows per bulk insert"
+        )
+
+    def handle(self, *args, **options):
+        backends = [
+            ("icontains", QFilterSearchBackend()),
+            (type(get_search_backend()).__name__, get_search_backend()),
+        ]
+        rng = random.Random(42)
+
+        with transaction.atomic():
+            seller = User.objects.create(username="bench_search_seller")
+            category = Category.objects.create(name="bench_search_category")
+            created = 0
+
+            for size in sorted(options["sizes"]):
+                self.stdout.write(f"Inserting listings up to {size}...")
+                while created < size:
+                    batch = min(options["batch_size"], size - created)
+                    Listing.objects.bulk_create(
+                        [self.make_listing(rng, seller, category) for _ in range(batch)]
+                    )
+                    created += batch
+
+                self.stdout.write(self.style.MIGRATE_HEADING(f"{size} listings"))
+                for query in QUERIES:
+                    timings = [
+                        f"{name}: {self.time_search(backend, query, options['repeat']):8.2f} ms"
+                        for name, backend in backends
+                    ]
+                    self.stdout.write(f"  {query!r:22} " + "   ".join(timings))
+
+            transaction.set_rollback(True)
+
+        self.stdout.write(self.style.SUCCESS("Benchmark complete. Synthetic data rolled back."))
+
+    def make_listing(self, rng, seller, category):
+        # bulk_create skips Listing.save(), so the denormalized names are filled in here
+        return Listing(
+            title=" ".join([rng.choice(WORDS), *rng.choices(FILLER, k=2)]),
+            description=" ".join([rng.choice(WORDS), *rng.choices(FILLER, k=15)]),
+            price=rng.randint(1, 200),
+            category=category,
+            category_name=category.name,
+            seller=seller,
+            seller_name=seller.username,
+        )
+
+    def time_search(self, backend, query, repeat):
+        """
+        Returns the median time in milliseconds to fetch the first page of results.
+        """
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            list(backend.search(Listing.objects.filter(is_sold=False), query)[:PAGE_SIZE])
+            timings.append((time.perf_counter() - start) * 1000)
+        return statistics.median(timings)
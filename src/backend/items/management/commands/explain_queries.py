@@ -0,0 +1,108 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Q
+
+from chat.models import ChatRoom, Message, UnreadCounter
+from items.models import Listing
+from notifications.models import Notification
+from purchase_requests.models import PurchaseRequest
+
+PAGE_SIZE = 10
+
+
+class Command(BaseCommand):
+    help = (
+        "Print the EXPLAIN plan of the main query behind each ViewSet, so a missing "
+        "or unused index shows up as a sequential scan."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--user",
+            type=int,
+            help="ID of the user to run the per-user queries as (default: the first user)",
+        )
+        parser.add_argument(
+            "--analyze",
+            action="store_true",
+            help="Run the queries and show actual timings (Postgres only)",
+        )
+
+    def handle(self, *args, **options):
+        user = self.get_user(options["user"])
+        explain_options = {}
+        if options["analyze"]:
+            if connection.vendor != "postgresql":
+                raise CommandError("--analyze is only supported on Postgres")
+            explain_options = {"analyze": True, "buffers": True}
+
+        for name, queryset in self.get_queries(user):
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            self.stdout.write(queryset.explain(**explain_options))
+            self.stdout.write("")
+
+    def get_user(self, user_id):
+        if user_id is not None:
+            try:
+                return User.objects.get(id=user_id)
+            except User.DoesNotExist:
+                raise CommandError(f"User {user_id} does not exist")
+        user = User.objects.order_by("id").first()
+        if user is None:
+            raise CommandError("There are no users to run the per-user queries as")
+        return user
+
+    def get_queries(self, user):
+        """
+        Returns (name, queryset) pairs mirroring the hot queries of the ViewSets.
+        """
+        # an empty IN () never reaches the database, so fall back to a placeholder id
+        page_ids = list(
+            Listing.objects.filter(is_sold=False)
+            .order_by("-created_at", "-id")
+            .values_list("id", flat=True)[:PAGE_SIZE]
+        ) or [0]
+        rooms = ChatRoom.objects.filter(Q(user1=user) | Q(user2=user))
+        return [
+            (
+                "ItemViewSet.list - unsold listings, newest first",
+                Listing.objects.filter(is_sold=False).order_by("-created_at", "-id")[:PAGE_SIZE],
+            ),
+            (
+                "ItemViewSet.search_my_items - the user's unsold listings",
+                Listing.objects.filter(seller=user, is_sold=False).order_by(
+                    "-created_at", "-id"
+                )[:PAGE_SIZE],
+            ),
+            (
+                "ItemSerializer - active purchase requests of a page",
+                PurchaseRequest.objects.filter(listing_id__in=page_ids, is_active=True),
+            ),
+            (
+                "ItemViewSet.request_purchase - duplicate request check",
+                PurchaseRequest.objects.filter(
+                    requester=user, listing_id__in=page_ids[:1], is_active=True
+                ),
+            ),
+            (
+                "chat room_list - unread messages sent to the user",
+                Message.objects.filter(room__in=rooms, is_read=False).exclude(sender=user),
+            ),
+            (
+                "chat chat_history - the latest page of a room",
+                Message.objects.filter(room__in=rooms[:1]).order_by("-timestamp", "-id")[:50],
+            ),
+            (
+                "chat unread_count - rebuilding the cached total from the counters",
+                UnreadCounter.objects.filter(user=user),
+            ),
+            (
+                "NotificationViewSet.list - the user's notifications, newest first",
+                Notification.objects.filter(recipient=user).order_by("-created_at")[:PAGE_SIZE],
+            ),
+            (
+                "NotificationViewSet.unread_count - the user's unread notifications",
+                Notification.objects.filter(recipient=user, is_read=False),
+            ),
+        ]
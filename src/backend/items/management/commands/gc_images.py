@@ -0,0 +1,169 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from items.models import ItemImage, Listing
+from items.renditions import RENDITION_SIZES
+from items.uploads import get_upload_storage
+
+# storage prefixes holding listing images: upload_to of the image fields, direct uploads
+# (items.uploads) and renditions (items.renditions)
+IMAGE_PREFIXES = ("item_images/", "item_additional_images/", "uploads/", "renditions/")
+
+
+def referenced_keys(keys):
+    """
+    Returns the subset of the storage keys that a Listing or ItemImage still points to.
+    """
+    keys = list(keys)
+    referenced = set()
+    for model in (Listing, ItemImage):
+        condition = Q(image__in=keys)
+        for name in RENDITION_SIZES:
+            condition |= Q(**{f"renditions__{name}__in": keys})
+        for image, renditions in model.objects.filter(condition).values_list(
+            "image", "renditions"
+        ):
+            referenced.add(image)
+            referenced.update(renditions.values())
+    return referenced.intersection(keys)
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete ItemImage rows no listing points to, then storage objects (images and "
+        "renditions) no row points to, in batches."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Rows or storage objects deleted per batch (default: 500)",
+        )
+        parser.add_argument(
+            "--min-age",
+            type=float,
+            default=24,
+            help="Only collect what is older than this many hours, so uploads of listings "
+            "still being created are left alone (default: 24)",
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=0,
+            help="Maximum deletions per second, 0 for no limit (default: 0)",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report what would be deleted",
+        )
+        parser.add_argument(
+            "--skip-storage",
+            action="store_true",
+            help="Only collect ItemImage rows, without scanning the storage",
+        )
+
+    def handle(self, *args, **options):
+        self.batch_size = options["batch_size"]
+        self.rate = options["rate"]
+        self.dry_run = options["dry_run"]
+        self.storage = get_upload_storage()
+        cutoff = timezone.now() - timedelta(hours=options["min_age"])
+
+        rows = self.collect_rows(cutoff)
+        objects = 0 if options["skip_storage"] else self.collect_storage(cutoff)
+
+        verb = "Would delete" if self.dry_run else "Deleted"
+        self.stdout.write(
+            self.style.SUCCESS(f"{verb} {rows} image rows and {objects} storage objects.")
+        )
+
+    def collect_rows(self, cutoff):
+        """
+        Deletes the ItemImage rows no listing points to, and their files.
+        """
+        orphans = (
+            ItemImage.objects.filter(listings=None, uploaded_at__lt=cutoff)
+            .order_by("id")
+            .values_list("id", "image", "renditions")
+        )
+        return self.run_batches(
+            "image rows", orphans.iterator(chunk_size=self.batch_size), self.delete_rows
+        )
+
+    def delete_rows(self, batch):
+        if self.dry_run:
+            return len(batch)
+        ids = [row_id for row_id, _, _ in batch]
+        with transaction.atomic():
+            # check again, a listing may have picked an image up since it was streamed
+            orphans = ItemImage.objects.select_for_update(of=("self",)).filter(
+                id__in=ids, listings=None
+            )
+            rows = list(orphans.values_list("id", "image", "renditions"))
+            orphans.delete()
+        keys = {image for _, image, _ in rows if image}
+        for _, _, renditions in rows:
+            keys.update(renditions.values())
+        # an upload key can be submitted again, so other rows may still share these files
+        self.storage.delete_keys(keys - referenced_keys(keys))
+        return len(rows)
+
+    def collect_storage(self, cutoff):
+        """
+        Deletes the storage objects under IMAGE_PREFIXES that no row points to.
+        """
+        deleted = 0
+        for prefix in IMAGE_PREFIXES:
+            keys = (key for key, modified in self.storage.iter_keys(prefix) if modified < cutoff)
+            deleted += self.run_batches(f"storage objects in {prefix}", keys, self.delete_keys)
+        return deleted
+
+    def delete_keys(self, batch):
+        unreferenced = set(batch) - referenced_keys(batch)
+        if not self.dry_run:
+            self.storage.delete_keys(unreferenced)
+        return len(unreferenced)
+
+    def run_batches(self, label, candidates, delete):
+        """
+        Streams candidates in batches of --batch-size through delete, which returns how many
+        were (or in a dry run, would be) deleted. Keeps under --rate deletions per second and
+        reports progress after every batch.
+
+        Returns:
+            int: The number of deleted (or, in a dry run, deletable) candidates.
+        """
+        started = time.monotonic()
+        scanned = deleted = 0
+        batch = []
+
+        def flush():
+            nonlocal deleted
+            deleted += delete(batch)
+            elapsed = time.monotonic() - started
+            if self.rate:
+                # sleep off any deletions made ahead of the allowed rate
+                time.sleep(max(0, deleted / self.rate - elapsed))
+                elapsed = time.monotonic() - started
+            self.stdout.write(
+                f"{label}: scanned {scanned}, {'deletable' if self.dry_run else 'deleted'} "
+                f"{deleted} ({deleted / elapsed if elapsed else 0:.0f}/s)"
+            )
+
+        for candidate in candidates:
+            scanned += 1
+            batch.append(candidate)
+            if len(batch) == self.batch_size:
+                flush()
+                batch = []
+        if batch:
+            flush()
+        return deleted
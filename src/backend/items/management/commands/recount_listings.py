@@ -0,0 +1,86 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+from items.models import Listing
+from purchase_requests.models import PurchaseRequest
+from userprofile.models import UserProfile
+
+
+def expected_counts():
+    """
+    Returns the subqueries computing the true value of each Listing counter.
+    """
+    active_requests = (
+        PurchaseRequest.objects.filter(listing=OuterRef("pk"), is_active=True)
+        .order_by()
+        .values("listing")
+        .annotate(count=Count("id"))
+        .values("count")
+    )
+    favorites = (
+        UserProfile.favorites.through.objects.filter(listing=OuterRef("pk"))
+        .order_by()
+        .values("listing")
+        .annotate(count=Count("id"))
+        .values("count")
+    )
+    return {
+        "active_request_count": Coalesce(Subquery(active_requests), 0),
+        "favorite_count": Coalesce(Subquery(favorites), 0),
+    }
+
+
+class Command(BaseCommand):
+    help = "Repair drift in the denormalized Listing counters (active_request_count, favorite_count)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Listings repaired per UPDATE (default: 1000)",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report how many listings have drifted",
+        )
+
+    def handle(self, *args, **options):
+        counts = expected_counts()
+        drifted_ids = (
+            Listing.objects.annotate(
+                expected_requests=counts["active_request_count"],
+                expected_favorites=counts["favorite_count"],
+            )
+            .filter(
+                ~Q(active_request_count=F("expected_requests"))
+                | ~Q(favorite_count=F("expected_favorites"))
+            )
+            .order_by("id")
+            .values_list("id", flat=True)
+        )
+
+        batch = []
+        repaired = 0
+        for listing_id in drifted_ids.iterator(chunk_size=options["batch_size"]):
+            batch.append(listing_id)
+            if len(batch) == options["batch_size"]:
+                repaired += self.repair(batch, counts, options["dry_run"])
+                batch = []
+        if batch:
+            repaired += self.repair(batch, counts, options["dry_run"])
+
+        if options["dry_run"]:
+            self.stdout.write(f"{repaired} listings have drifted counters.")
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Repaired counters of {repaired} listings."))
+
+    def repair(self, listing_ids, counts, dry_run):
+        if dry_run:
+            return len(listing_ids)
+        # each batch is its own short transaction, so locks are only held briefly
+        with transaction.atomic():
+            return Listing.objects.filter(id__in=listing_ids).update(**counts)
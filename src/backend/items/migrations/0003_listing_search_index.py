@@ -0,0 +1,58 @@
+from django.db import migrations
+
+from items.search import SQLITE_FTS_TABLE, install_sqlite_fts
+
+# Postgres keeps search_vector up to date itself as a generated column, so Django never writes it
+POSTGRES_FORWARD = [
+    """
+    ALTER TABLE items_listing ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('english'::regconfig, coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('english'::regconfig, coalesce(category_name, '')), 'B') ||
+        setweight(to_tsvector('english'::regconfig, coalesce(description, '')), 'C')
+    ) STORED
+    """,
+    "CREATE INDEX items_listing_search_vector_gin ON items_listing USING gin (search_vector)",
+]
+
+POSTGRES_BACKWARD = [
+    "DROP INDEX IF EXISTS items_listing_search_vector_gin",
+    "ALTER TABLE items_listing DROP COLUMN IF EXISTS search_vector",
+]
+
+SQLITE_BACKWARD = [
+    f"DROP TRIGGER IF EXISTS {SQLITE_FTS_TABLE}_ai",
+    f"DROP TRIGGER IF EXISTS {SQLITE_FTS_TABLE}_ad",
+    f"DROP TRIGGER IF EXISTS {SQLITE_FTS_TABLE}_au",
+    f"DROP TABLE IF EXISTS {SQLITE_FTS_TABLE}",
+]
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        for statement in POSTGRES_FORWARD:
+            schema_editor.execute(statement)
+    else:
+        install_sqlite_fts(schema_editor)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "postgresql":
+        statements = POSTGRES_BACKWARD
+    elif vendor == "sqlite":
+        statements = SQLITE_BACKWARD
+    else:
+        statements = []
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("items", "0002_itemimage_listing_additional_images"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.20 on 2026-10-17 17:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('items', '0004_listing_title_trigram_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='listing',
+            index=models.Index(condition=models.Q(('is_sold', False)), fields=['-created_at', '-id'], name='listing_unsold_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='listing',
+            index=models.Index(fields=['seller', 'is_sold', '-created_at'], name='listing_seller_sold_idx'),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 4.2.20 on 2026-10-17 17:52
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from items.search import install_sqlite_fts
+
+
+def count_existing(apps, schema_editor):
+    Listing = apps.get_model("items", "Listing")
+    PurchaseRequest = apps.get_model("purchase_requests", "PurchaseRequest")
+    UserProfile = apps.get_model("userprofile", "UserProfile")
+    active_requests = (
+        PurchaseRequest.objects.filter(listing=OuterRef("pk"), is_active=True)
+        .values("listing")
+        .annotate(count=Count("id"))
+        .values("count")
+    )
+    favorites = (
+        UserProfile.favorites.through.objects.filter(listing=OuterRef("pk"))
+        .values("listing")
+        .annotate(count=Count("id"))
+        .values("count")
+    )
+    Listing.objects.update(
+        active_request_count=Coalesce(Subquery(active_requests), 0),
+        favorite_count=Coalesce(Subquery(favorites), 0),
+    )
+
+
+def reinstall_sqlite_fts(apps, schema_editor):
+    # adding the columns makes SQLite rebuild items_listing, which drops the FTS triggers
+    install_sqlite_fts(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('items', '0005_listing_listing_unsold_recent_idx_and_more'),
+        ('purchase_requests', '0006_purchaserequest_purchase_req_active_idx_and_more'),
+        ('userprofile', '0002_userprofile_favorites'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='listing',
+            name='active_request_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='listing',
+            name='favorite_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='listing',
+            index=models.Index(condition=models.Q(('is_sold', False)), fields=['-favorite_count', '-id'], name='listing_unsold_popular_idx'),
+        ),
+        migrations.RunPython(count_existing, migrations.RunPython.noop),
+        migrations.RunPython(reinstall_sqlite_fts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.20 on 2026-10-17 17:54
+
+from django.db import migrations, models
+
+from items.search import install_sqlite_fts
+
+
+def reinstall_sqlite_fts(apps, schema_editor):
+    # adding the column makes SQLite rebuild items_listing, which drops the FTS triggers
+    install_sqlite_fts(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('items', '0006_listing_active_request_count_listing_favorite_count_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='itemimage',
+            name='renditions',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+        migrations.AddField(
+            model_name='listing',
+            name='renditions',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+        migrations.RunPython(reinstall_sqlite_fts, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,12 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
 from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 
 from categories.models import Category
+from .trigrams import title_index
 
 # Create your models here.
 
@@ -35,6 +40,54 @@ class Listing(models.Model):
     )  # New field to store the seller's name
     created_at = models.DateTimeField(auto_now_add=True)  # add date/time automatically
     # updated_at = models.DateTimeField(auto_now=True)  #TODO: do this after editing functionality
+    # storage names of the resized copies of image, filled in by items.renditions
+    renditions = models.JSONField(default=dict, blank=True, editable=False)
+
+    # Denormalized counters, only ever changed with F() expressions by PurchaseRequest and
+    # UserProfile.toggle_favorite (and repaired by the recount_listings command)
+    active_request_count = models.PositiveIntegerField(default=0, editable=False)
+    favorite_count = models.PositiveIntegerField(default=0, editable=False)
+
+    COUNTER_FIELDS = ("active_request_count", "favorite_count")
+
+    @classmethod
+    def adjust_counter(cls, listing_id, field, delta):
+        """
+        Atomically adds delta to one of the counter fields of a listing, never going below 0.
+        """
+        cls.objects.filter(pk=listing_id).update(**{field: Greatest(F(field) + delta, 0)})
+
+    def update_additional_images(self, new_images, keep_ids=None):
+        """
+        Adds new additional images to the listing and removes the dropped ones.
+
+        The new ItemImage rows and their links to the listing are each inserted with a single
+        bulk_create, in one transaction. Dropped images are unlinked and their rows deleted
+        (their files are left for the gc_images command).
+
+        Args:
+            new_images (list): Uploaded files or storage keys of the images to add.
+            keep_ids (list, optional): IDs of the current additional images to keep, all
+                others are removed. None keeps all of them.
+
+        Returns:
+            list[ItemImage]: The created images.
+        """
+        through = Listing.additional_images.through
+        with transaction.atomic():
+            if keep_ids is not None:
+                dropped = through.objects.filter(listing=self).exclude(itemimage_id__in=keep_ids)
+                dropped_ids = list(dropped.values_list("itemimage_id", flat=True))
+                if dropped_ids:
+                    dropped.delete()
+                    # only delete the rows no other listing still points to
+                    ItemImage.objects.filter(id__in=dropped_ids, listings=None).delete()
+
+            images = ItemImage.objects.bulk_create([ItemImage(image=image) for image in new_images])
+            through.objects.bulk_create(
+                [through(listing=self, itemimage=image) for image in images]
+            )
+        return images
 
     def get_purchase_request_count(self):
         """
@@ -43,7 +96,7 @@ class Listing(models.Model):
         Returns:
             int: The number of active purchase requests.
         """
-        return self.purchase_requests.filter(is_active=True).count()
+        return self.active_request_count
 
     def get_purchase_requesters(self):
         """
@@ -62,15 +115,43 @@ class Listing(models.Model):
 
     class Meta:
         ordering = ["-created_at"]
+        indexes = [
+            # the feed only ever shows unsold listings, newest first
+            models.Index(
+                fields=["-created_at", "-id"],
+                condition=models.Q(is_sold=False),
+                name="listing_unsold_recent_idx",
+            ),
+            # my items and search my items
+            models.Index(
+                fields=["seller", "is_sold", "-created_at"],
+                name="listing_seller_sold_idx",
+            ),
+            # the feed sorted by ?ordering=-favorite_count
+            models.Index(
+                fields=["-favorite_count", "-id"],
+                condition=models.Q(is_sold=False),
+                name="listing_unsold_popular_idx",
+            ),
+        ]
 
     def save(self, *args, **kwargs):
         """
         Overrides the default save method to automatically populate seller_name and category_name.
+
+        Updates of an existing listing never write the counter fields, so a stale in-memory
+        count can't overwrite increments made in the meantime.
         """
         if self.seller:
             self.seller_name = self.seller.username
         if self.category:
             self.category_name = self.category.name
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.COUNTER_FIELDS
+            ]
         super().save(*args, **kwargs)
 
     # To show the name of the categories
@@ -84,7 +165,27 @@ class Listing(models.Model):
 # new model for additional images
 class ItemImage(models.Model):
     image = models.ImageField(upload_to="item_additional_images")
+    # storage names of the resized copies of image, filled in by items.renditions
+    renditions = models.JSONField(default=dict, blank=True, editable=False)
     uploaded_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         return f"Image {self.id}"
+
+
+# keep the in-process trigram index used for title suggestions in sync with the listings
+# (until it's first built there is nothing to sync, and on Postgres it never is)
+@receiver(post_save, sender=Listing)
+def index_listing_title(sender, instance, **kwargs):
+    if title_index.built_at is None:
+        return
+    if instance.is_sold:
+        title_index.remove(instance.id)
+    else:
+        title_index.add(instance.id, instance.title)
+
+
+@receiver(post_delete, sender=Listing)
+def unindex_listing_title(sender, instance, **kwargs):
+    if title_index.built_at is not None:
+        title_index.remove(instance.id)
@@ -1,4 +1,6 @@
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.filters import OrderingFilter
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+from rest_framework.settings import api_settings
 
 
 class HttpsPageNumberPagination(PageNumberPagination):
@@ -9,3 +11,45 @@ class HttpsPageNumberPagination(PageNumberPagination):
     def get_previous_link(self):
         url = super().get_previous_link()
         return url.replace("http://", "https://") if url else None
+
+
+class HttpsCursorPagination(CursorPagination):
+    """
+    Keyset pagination for feeds that get scrolled deep, like the listing feed.
+
+    Unlike page numbers there is no COUNT(*) and no OFFSET: every page continues from the
+    position of the last row of the previous page, so pages cost the same however deep
+    they are, and cursors stay valid when new rows are inserted in front of them.
+
+    Ordering:
+        - `?ordering=` picks any field from the view's ordering_fields (e.g. price or title),
+          with id added as a tie-breaker so rows with equal values keep a stable order.
+        - querysets annotated with a search `rank` are ordered by relevance.
+        - otherwise newest first, on (-created_at, -id).
+
+    Select it on a view with `pagination_class = HttpsCursorPagination`.
+    """
+
+    ordering = ("-created_at", "-id")
+    ranked_ordering = ("-rank", "-id")
+
+    def get_ordering(self, request, queryset, view):
+        ordering_filters = [
+            filter_cls
+            for filter_cls in getattr(view, "filter_backends", [])
+            if issubclass(filter_cls, OrderingFilter)
+        ]
+        if ordering_filters and request.query_params.get(api_settings.ORDERING_PARAM):
+            # the filter only keeps fields listed in the view's ordering_fields
+            ordering = tuple(ordering_filters[0]().get_ordering(request, queryset, view))
+            if not any(field.lstrip("-") in ("id", "pk") for field in ordering):
+                ordering += ("-id",) if ordering[0].startswith("-") else ("id",)
+            return ordering
+
+        if "rank" in queryset.query.annotations:
+            return self.ranked_ordering
+        return self.ordering
+
+    def encode_cursor(self, cursor):
+        url = super().encode_cursor(cursor)
+        return url.replace("http://", "https://")
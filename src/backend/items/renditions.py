@@ -0,0 +1,140 @@
+# renditions.py - Resized copies of uploaded listing images
+# Phone photos are often 4-12 MB, far too large for the feed. After an upload is committed,
+# the original is resized into a few fixed renditions (see RENDITION_SIZES) by a small
+# worker pool, off the request path. Renditions are re-encoded as WebP (JPEG if Pillow has
+# no WebP support) without any EXIF data, and stored next to the originals in the default
+# storage, so S3 in production and the local filesystem in development both work.
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps, features
+
+logger = logging.getLogger(__name__)
+
+# the longest side of each rendition, in pixels (images are never upscaled)
+RENDITION_SIZES = {
+    "thumb": 200,
+    "card": 640,
+    "full": 1600,
+}
+
+if features.check("webp"):
+    RENDITION_FORMAT, RENDITION_EXTENSION = "WEBP", "webp"
+else:
+    RENDITION_FORMAT, RENDITION_EXTENSION = "JPEG", "jpg"
+RENDITION_QUALITY = 80
+
+_executor = None
+
+
+def get_executor():
+    """
+    Returns the process-wide worker pool, created on first use.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.IMAGE_RENDITION_WORKERS,
+            thread_name_prefix="image-renditions",
+        )
+    return _executor
+
+
+def schedule_renditions(instance, field_name="image"):
+    """
+    Queues rendition generation for an image field once the current transaction commits.
+
+    With settings.IMAGE_RENDITION_WORKERS set to 0 the renditions are generated right away
+    in the committing thread instead, which is what the tests use.
+
+    Args:
+        instance (Model): A Listing or ItemImage.
+        field_name (str): The name of the image field to render.
+    """
+    if not getattr(instance, field_name):
+        return
+    args = (instance._meta.label, instance.pk, field_name)
+
+    def submit():
+        if settings.IMAGE_RENDITION_WORKERS:
+            get_executor().submit(run_in_worker, *args)
+        else:
+            generate_renditions(*args)
+
+    transaction.on_commit(submit)
+
+
+def run_in_worker(model_label, pk, field_name):
+    """
+    Worker pool entry point. Errors are logged instead of being lost in the future, and the
+    thread's database connection is cleaned up after every job.
+    """
+    close_old_connections()
+    try:
+        generate_renditions(model_label, pk, field_name)
+    except Exception:
+        logger.exception("Could not generate renditions for %s %s", model_label, pk)
+    finally:
+        close_old_connections()
+
+
+def render(image, longest_side):
+    """
+    Returns the bytes of a copy of the image scaled down to fit in a longest_side square.
+    Pillow only writes EXIF data when asked to, so the result carries none.
+    """
+    copy = image.copy()
+    copy.thumbnail((longest_side, longest_side), Image.LANCZOS)
+    if RENDITION_FORMAT == "JPEG" and copy.mode != "RGB":
+        copy = copy.convert("RGB")
+    elif copy.mode not in ("RGB", "RGBA"):
+        copy = copy.convert("RGBA" if "A" in copy.getbands() else "RGB")
+    buffer = BytesIO()
+    copy.save(buffer, format=RENDITION_FORMAT, quality=RENDITION_QUALITY)
+    return buffer.getvalue()
+
+
+def generate_renditions(model_label, pk, field_name="image"):
+    """
+    Generates and stores every rendition of an image and records their storage names in the
+    instance's `renditions` field.
+
+    Args:
+        model_label (str): The model of the instance, e.g. "items.Listing".
+        pk (int): The primary key of the instance.
+        field_name (str): The name of the image field to render.
+
+    Returns:
+        dict: The rendition name -> storage name mapping, or None if there was nothing to do.
+    """
+    model = apps.get_model(model_label)
+    instance = model.objects.filter(pk=pk).first()
+    if instance is None or not getattr(instance, field_name):
+        return None
+    image_file = getattr(instance, field_name)
+    source_name = image_file.name
+
+    with image_file.open("rb") as source:
+        image = Image.open(source)
+        # apply the EXIF orientation before the EXIF data is dropped
+        image = ImageOps.exif_transpose(image)
+        image.load()
+
+    # keyed by the whole source path, as images in different folders can share a file name
+    stem = os.path.splitext(source_name)[0]
+    renditions = {}
+    for name, longest_side in RENDITION_SIZES.items():
+        path = f"renditions/{name}/{stem}.{RENDITION_EXTENSION}"
+        renditions[name] = default_storage.save(path, ContentFile(render(image, longest_side)))
+
+    # skip the update if the image was replaced while we were working on the old one
+    model.objects.filter(pk=pk, **{field_name: source_name}).update(renditions=renditions)
+    return renditions
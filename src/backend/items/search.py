@@ -0,0 +1,253 @@
+# search.py - Full-text search backends for listings
+# ItemViewSet's search actions hand their base queryset and the raw query string to a
+# search backend, which filters the listings and orders them by relevance.
+#  1. PostgresSearchBackend - uses the generated `search_vector` tsvector column (GIN indexed) and ts_rank
+#  2. SQLiteSearchBackend - uses the `items_listing_fts` FTS5 table (dev/test) and bm25
+#  3. QFilterSearchBackend - the original icontains scan, kept as a fallback and for benchmarks
+# Backends also suggest listing titles for typeahead: pg_trgm on Postgres, and the in-process
+# trigram index from items.trigrams everywhere else.
+
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.contrib.postgres.search import TrigramWordSimilarity
+from django.db.models import BooleanField, FloatField, Q
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Length
+from django.utils.module_loading import import_string
+
+from .models import Listing
+from .trigrams import DEFAULT_THRESHOLD, score, title_index, trigrams
+
+# only word characters make it into the engine queries, so user input can never break their syntax
+TERM_PATTERN = re.compile(r"\w+")
+MAX_TERMS = 8
+
+# shorter queries don't have enough trigrams to suggest anything useful
+MIN_SUGGEST_LENGTH = 2
+
+SQLITE_FTS_TABLE = "items_listing_fts"
+
+# Statements that create and fill the FTS5 table. The triggers live on items_listing, so any
+# migration that makes SQLite rebuild that table must run install_sqlite_fts() again.
+SQLITE_FTS_STATEMENTS = [
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {SQLITE_FTS_TABLE} USING fts5(
+        title, category_name, description,
+        content='items_listing', content_rowid='id', tokenize='porter unicode61'
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SQLITE_FTS_TABLE}_ai AFTER INSERT ON items_listing BEGIN
+        INSERT INTO {SQLITE_FTS_TABLE}(rowid, title, category_name, description)
+        VALUES (new.id, new.title, new.category_name, new.description);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SQLITE_FTS_TABLE}_ad AFTER DELETE ON items_listing BEGIN
+        INSERT INTO {SQLITE_FTS_TABLE}({SQLITE_FTS_TABLE}, rowid, title, category_name, description)
+        VALUES ('delete', old.id, old.title, old.category_name, old.description);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SQLITE_FTS_TABLE}_au AFTER UPDATE OF title, category_name, description
+    ON items_listing BEGIN
+        INSERT INTO {SQLITE_FTS_TABLE}({SQLITE_FTS_TABLE}, rowid, title, category_name, description)
+        VALUES ('delete', old.id, old.title, old.category_name, old.description);
+        INSERT INTO {SQLITE_FTS_TABLE}(rowid, title, category_name, description)
+        VALUES (new.id, new.title, new.category_name, new.description);
+    END
+    """,
+    f"INSERT INTO {SQLITE_FTS_TABLE}({SQLITE_FTS_TABLE}) VALUES ('rebuild')",
+]
+
+
+def install_sqlite_fts(schema_editor):
+    """
+    Creates (or repairs) the FTS5 index and its triggers, then rebuilds it from items_listing.
+    Does nothing on other databases.
+    """
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    for statement in SQLITE_FTS_STATEMENTS:
+        schema_editor.execute(statement)
+
+
+def get_search_terms(query):
+    """
+    Splits a raw query string into at most MAX_TERMS lowercase words.
+    """
+    return TERM_PATTERN.findall(query.lower())[:MAX_TERMS]
+
+
+class BaseSearchBackend:
+    """
+    Base class for listing search backends.
+
+    Subclasses implement filter_terms(), which receives the cleaned search terms and
+    returns the matching listings annotated with a `rank` (higher is more relevant).
+    """
+
+    def search(self, queryset, query):
+        """
+        Filters a Listing queryset by a raw search query and orders it by relevance.
+
+        Args:
+            queryset (QuerySet[Listing]): The listings to search in.
+            query (str): The query string typed by the user.
+
+        Returns:
+            QuerySet[Listing]: The matching listings, most relevant first. An empty query
+            returns the queryset unchanged.
+        """
+        terms = get_search_terms(query)
+        if not terms:
+            return queryset
+        return self.filter_terms(queryset, terms).order_by("-rank", "-created_at", "-id")
+
+    def filter_terms(self, queryset, terms):
+        raise NotImplementedError
+
+    def suggest(self, queryset, query, limit):
+        """
+        Suggests listing titles that look like the query, tolerating typos.
+
+        Candidates come from the in-process trigram index and are checked against the
+        queryset, so only listings it contains are suggested, scored on their current title.
+
+        Args:
+            queryset (QuerySet[Listing]): The listings that may be suggested.
+            query (str): What the user has typed so far.
+            limit (int): The maximum number of suggestions.
+
+        Returns:
+            list[dict]: Up to `limit` dicts with the listing "id" and "title", best match first.
+        """
+        query = query.strip()
+        if len(query) < MIN_SUGGEST_LENGTH:
+            return []
+        if title_index.is_stale():
+            title_index.build(
+                Listing.objects.filter(is_sold=False).values_list("id", "title").iterator()
+            )
+
+        # ask for a few extra candidates in case some of them are filtered out by the queryset
+        candidate_ids = title_index.search(query, limit * 3)
+        if not candidate_ids:
+            return []
+        rows = queryset.prefetch_related(None).filter(id__in=candidate_ids).values("id", "title")
+
+        query_trigrams = trigrams(query)
+        scored = []
+        for row in rows:
+            word_similarity, similarity = score(query_trigrams, trigrams(row["title"]))
+            if word_similarity >= DEFAULT_THRESHOLD:
+                scored.append((word_similarity, similarity, row["id"], row))
+        scored.sort(key=lambda entry: entry[:3], reverse=True)
+        return [entry[3] for entry in scored[:limit]]
+
+
+class QFilterSearchBackend(BaseSearchBackend):
+    """
+    The original search: an icontains scan over title, description and category name.
+    Every match gets the same rank, so results stay in newest-first order.
+    """
+
+    def search(self, queryset, query):
+        if not query:
+            return queryset
+        return queryset.filter(
+            Q(title__icontains=query)
+            | Q(description__icontains=query)
+            | Q(category__name__icontains=query)
+        )
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """
+    Postgres full-text search on the generated, GIN indexed `search_vector` column.
+    Every term is a prefix match so results show up while the user is still typing.
+    """
+
+    config = "english"
+
+    def filter_terms(self, queryset, terms):
+        tsquery = " & ".join(f"{term}:*" for term in terms)
+        matches = RawSQL(
+            "items_listing.search_vector @@ to_tsquery(%s::regconfig, %s)",
+            (self.config, tsquery),
+            output_field=BooleanField(),
+        )
+        # cast to double precision so the rank survives a round trip through a pagination cursor
+        rank = RawSQL(
+            "ts_rank(items_listing.search_vector, to_tsquery(%s::regconfig, %s))::double precision",
+            (self.config, tsquery),
+            output_field=FloatField(),
+        )
+        return queryset.filter(matches).annotate(rank=rank)
+
+    def suggest(self, queryset, query, limit):
+        """
+        Suggests listing titles with pg_trgm. The `<%` operator uses the GIN trigram index
+        on title and keeps titles above pg_trgm.word_similarity_threshold (0.6 by default).
+        """
+        query = query.strip()
+        if len(query) < MIN_SUGGEST_LENGTH:
+            return []
+        word_similar = RawSQL(
+            "%s <%% items_listing.title", (query,), output_field=BooleanField()
+        )
+        return list(
+            queryset.prefetch_related(None)
+            .filter(word_similar)
+            .annotate(similarity=TrigramWordSimilarity(query, "title"))
+            .order_by("-similarity", Length("title"), "-id")
+            .values("id", "title")[:limit]
+        )
+
+
+class SQLiteSearchBackend(BaseSearchBackend):
+    """
+    SQLite FTS5 search for development and tests, ranked with bm25.
+    """
+
+    # bm25 column weights, in the column order of the FTS table
+    weights = (10.0, 5.0, 1.0)
+
+    def filter_terms(self, queryset, terms):
+        match = " ".join(f'"{term}"*' for term in terms)
+        # join the FTS table once so bm25 is computed in the same pass as the MATCH
+        matches = queryset.extra(
+            tables=[SQLITE_FTS_TABLE],
+            where=[
+                f"{SQLITE_FTS_TABLE}.rowid = items_listing.id",
+                f"{SQLITE_FTS_TABLE} MATCH %s",
+            ],
+            params=[match],
+        )
+        # bm25 is lower for better matches, so flip the sign to make higher more relevant
+        weights = ", ".join(str(weight) for weight in self.weights)
+        rank = RawSQL(
+            f"-bm25({SQLITE_FTS_TABLE}, {weights})", (), output_field=FloatField()
+        )
+        return matches.annotate(rank=rank)
+
+
+BACKENDS_BY_VENDOR = {
+    "postgresql": PostgresSearchBackend,
+    "sqlite": SQLiteSearchBackend,
+}
+
+
+def get_search_backend():
+    """
+    Returns the search backend to use.
+
+    settings.ITEM_SEARCH_BACKEND can point to a backend class by dotted path, otherwise
+    the backend is picked from the database vendor.
+    """
+    backend_path = getattr(settings, "ITEM_SEARCH_BACKEND", None)
+    if backend_path:
+        return import_string(backend_path)()
+    return BACKENDS_BY_VENDOR.get(connection.vendor, QFilterSearchBackend)()
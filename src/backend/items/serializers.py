@@ -1,25 +1,65 @@
 from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import models
 from rest_framework import serializers
 
+from purchase_requests.models import PurchaseRequest
 from report.models import ItemReport
 from django.contrib.auth.models import User
 from .models import ItemImage, Listing
+from .renditions import RENDITION_SIZES
+from .uploads import validate_upload_key
+
+
+def storage_url(name):
+    """
+    Returns the public URL of a file in the default storage.
+    """
+    # to fix the weird url error wtih s3
+    if settings.AWS_STORAGE_BUCKET_NAME:
+        return f"https://{settings.AWS_STORAGE_BUCKET_NAME}.s3.{settings.AWS_S3_REGION_NAME}.amazonaws.com/{name}"
+    return default_storage.url(name)  # local filesystem storage in development
+
+
+def get_image_urls(obj):
+    """
+    Returns the URL of every rendition of an image, e.g. {"thumb": ..., "card": ..., "full": ...}.
+
+    Renditions are generated in the background after an upload, so until they are ready
+    every size points at the original image.
+
+    Args:
+        obj (Listing | ItemImage): The object owning the image.
+
+    Returns:
+        dict: Rendition name -> URL, or None if there is no image.
+    """
+    if not obj.image:
+        return None
+    original = storage_url(obj.image.name)
+    return {
+        name: storage_url(obj.renditions[name]) if name in obj.renditions else original
+        for name in RENDITION_SIZES
+    }
 
 
 # new serializer for the ItemImage model
 class ItemImageSerializer(serializers.ModelSerializer):
     image_url = serializers.SerializerMethodField()
+    image_urls = serializers.SerializerMethodField()
 
     class Meta:
         model = ItemImage
-        fields = ["id", "image", "image_url"]
+        fields = ["id", "image", "image_url", "image_urls"]
 
-    # to fix the weird url error wtih s3
     def get_image_url(self, obj):
         if obj.image:
-            return f"https://{settings.AWS_STORAGE_BUCKET_NAME}.s3.{settings.AWS_S3_REGION_NAME}.amazonaws.com/{obj.image.name}"
+            return storage_url(obj.image.name)
         return None
 
+    def get_image_urls(self, obj):
+        return get_image_urls(obj)
+
 
 class UserMiniSerializer(serializers.ModelSerializer):
     class Meta:
@@ -27,6 +67,76 @@ class UserMiniSerializer(serializers.ModelSerializer):
         fields = ("id", "username")
 
 
+class ListingPageLookup:
+    """
+    Resolves the viewer-dependent fields of ItemSerializer for a whole page of listings.
+
+    Instead of running one query per listing for each field, the favorites, reports and
+    active purchase requesters of every listing on the page are fetched once up front,
+    so serializing a page costs the same number of queries no matter how many rows it has.
+
+    Attributes:
+        favorited_ids (set): IDs of the listings the viewer has favorited.
+        reported_ids (set): IDs of the listings the viewer has reported.
+        requesters (dict): Maps a listing ID to the users with an active purchase request on it.
+    """
+
+    def __init__(self, listings, user=None):
+        listing_ids = [listing.id for listing in listings]
+        self.listing_ids = set(listing_ids)
+        self.favorited_ids = set()
+        self.reported_ids = set()
+        self.requesters = {}
+
+        if not listing_ids:
+            return
+
+        if user is not None and user.is_authenticated:
+            # go through the favorites join table so users without a profile don't raise
+            self.favorited_ids = set(
+                Listing.favorited_by.through.objects.filter(
+                    userprofile__user=user, listing_id__in=listing_ids
+                ).values_list("listing_id", flat=True)
+            )
+            self.reported_ids = set(
+                ItemReport.objects.filter(
+                    reporter=user, item_id__in=listing_ids
+                ).values_list("item_id", flat=True)
+            )
+
+        # the counter column tells us which listings have requesters worth loading
+        requested_ids = [listing.id for listing in listings if listing.active_request_count]
+        if not requested_ids:
+            return
+        active_requests = (
+            PurchaseRequest.objects.filter(listing_id__in=requested_ids, is_active=True)
+            .select_related("requester")
+            .order_by("created_at", "id")
+        )
+        for purchase_request in active_requests:
+            users = self.requesters.setdefault(purchase_request.listing_id, [])
+            if purchase_request.requester not in users:
+                users.append(purchase_request.requester)
+
+
+class ItemListSerializer(serializers.ListSerializer):
+    """
+    List serializer used whenever ItemSerializer is called with many=True.
+
+    Builds a single ListingPageLookup for the page before serializing each listing,
+    so the per-viewer fields don't fire their own queries per row.
+    """
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.manager.BaseManager) else data
+        listings = list(iterable)
+
+        request = self.context.get("request")
+        user = request.user if request else None
+        self.child.page_lookup = ListingPageLookup(listings, user)
+        return [self.child.to_representation(listing) for listing in listings]
+
+
 class ItemSerializer(serializers.ModelSerializer):
     # This is a read only field
     is_favorited = serializers.SerializerMethodField()
@@ -34,12 +144,23 @@ class ItemSerializer(serializers.ModelSerializer):
 
     # override the image field
     image_url = serializers.SerializerMethodField()
+    image_urls = serializers.SerializerMethodField()  # resized copies for the feed and detail view
 
     # new field for additional images
     additional_images = ItemImageSerializer(many=True, read_only=True)
     purchase_requesters = serializers.SerializerMethodField()
     purchase_request_count = serializers.SerializerMethodField()
 
+    # keys of images uploaded straight to storage (see items.uploads), instead of the files
+    image_key = serializers.CharField(write_only=True, required=False)
+    additional_image_keys = serializers.ListField(
+        child=serializers.CharField(), write_only=True, required=False
+    )
+    # IDs of the current additional images to keep when updating, the others are removed
+    additional_image_ids = serializers.ListField(
+        child=serializers.IntegerField(), write_only=True, required=False
+    )
+
     class Meta:
         model = Listing
         fields = [
@@ -51,6 +172,7 @@ class ItemSerializer(serializers.ModelSerializer):
             "price",
             "image",
             "image_url",  # to fix the weird url error wtih s3
+            "image_urls",
             "additional_images",
             "is_sold",
             "seller",
@@ -60,6 +182,10 @@ class ItemSerializer(serializers.ModelSerializer):
             "is_reported",
             "purchase_request_count",
             "purchase_requesters",
+            "favorite_count",
+            "image_key",
+            "additional_image_keys",
+            "additional_image_ids",
         ]  # get all fields
         read_only_fields = [
             "id",
@@ -68,14 +194,64 @@ class ItemSerializer(serializers.ModelSerializer):
             "category_name",
             "created_at",
             "image_url",
+            "image_urls",
+            "favorite_count",
         ]
+        list_serializer_class = ItemListSerializer
+
+    # set by ItemListSerializer while a page is being serialized
+    page_lookup = None
+
+    def validate_image_key(self, value):
+        return validate_upload_key(value, self.context["request"].user)
+
+    def validate_additional_image_keys(self, value):
+        user = self.context["request"].user
+        return [validate_upload_key(key, user) for key in value]
+
+    def validate_additional_image_ids(self, value):
+        current_ids = (
+            {image.id for image in self.instance.additional_images.all()} if self.instance else set()
+        )
+        unknown = set(value) - current_ids
+        if unknown:
+            raise serializers.ValidationError(
+                f"Not images of this listing: {', '.join(map(str, sorted(unknown)))}"
+            )
+        return value
+
+    def validate(self, attrs):
+        # an uploaded key stands in for the image file
+        if "image_key" in attrs:
+            attrs["image"] = attrs.pop("image_key")
+        return attrs
 
-    # to fix the weird url error wtih s3
     def get_image_url(self, obj):
         if obj.image:
-            return f"https://{settings.AWS_STORAGE_BUCKET_NAME}.s3.{settings.AWS_S3_REGION_NAME}.amazonaws.com/{obj.image.name}"
+            return storage_url(obj.image.name)
         return None
 
+    def get_image_urls(self, obj):
+        return get_image_urls(obj)
+
+    def get_lookup(self, obj):
+        """
+        Returns the page lookup for the listing being serialized.
+
+        When serializing a single listing (no ItemListSerializer around us), a lookup
+        is built just for that listing and reused by the other fields.
+
+        Args:
+            obj (Listing): The Listing object being serialized.
+
+        Returns:
+            ListingPageLookup: The lookup holding the viewer-dependent data.
+        """
+        if self.page_lookup is None or obj.id not in self.page_lookup.listing_ids:
+            request = self.context.get("request")
+            self.page_lookup = ListingPageLookup([obj], request.user if request else None)
+        return self.page_lookup
+
     def get_is_favorited(self, obj):
         """
         Checks if the listing is favorited by the current user.
@@ -86,8 +262,7 @@ class ItemSerializer(serializers.ModelSerializer):
         Returns:
             bool: True if the listing is favorited, False otherwise.
         """
-        user = self.context.get("request").user
-        return obj in user.profile.favorites.all()
+        return obj.id in self.get_lookup(obj).favorited_ids
 
     def get_is_reported(self, obj):
         """
@@ -99,14 +274,11 @@ class ItemSerializer(serializers.ModelSerializer):
         Returns:
             bool: True if the listing is reported, False otherwise.
         """
-        request = self.context.get("request")
-        if request and request.user.is_authenticated:
-            return ItemReport.objects.filter(item=obj, reporter=request.user).exists()
-        return False
+        return obj.id in self.get_lookup(obj).reported_ids
 
     def get_purchase_requesters(self, obj):
-        requesters = obj.get_purchase_requesters()
+        requesters = self.get_lookup(obj).requesters.get(obj.id, [])
         return UserMiniSerializer(requesters, many=True).data
 
     def get_purchase_request_count(self, obj):
-        return obj.get_purchase_request_count()
+        return obj.active_request_count
@@ -1,7 +1,24 @@
-from django.test import TestCase
+import shutil
+import tempfile
+from io import BytesIO, StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from django.contrib.auth.models import User
+from rest_framework.test import APITestCase
+from purchase_requests.models import PurchaseRequest
+from report.models import ItemReport
+from userprofile.models import UserProfile
 from .models import Category
-from .models import Listing
+from .models import ItemImage, Listing
+from .renditions import generate_renditions
+from .trigrams import TrigramIndex
+from PIL import Image
 
 class ListingModelTest(TestCase):
     def setUp(self):
@@ -41,3 +58,655 @@ class ListingModelTest(TestCase):
             seller=self.user,
         )
         self.assertEqual(str(listing), "Test Book")
+
+
+class ItemListQueryCountTest(APITestCase):
+    def setUp(self):
+        self.seller = User.objects.create_user(username="seller", password="pass")
+        self.viewer = User.objects.create_user(username="viewer", password="pass")
+        self.profile = UserProfile.objects.create(user=self.viewer)
+        self.category = Category.objects.create(name="Books")
+        self.client.force_authenticate(user=self.viewer)
+
+    def create_listings(self, count):
+        listings = []
+        for i in range(count):
+            listing = Listing.objects.create(
+                title=f"Book {i}",
+                category=self.category,
+                price=5,
+                seller=self.seller,
+            )
+            self.profile.favorites.add(listing)
+            ItemReport.objects.create(item=listing, reporter=self.viewer, reason="Spam")
+            PurchaseRequest.objects.create(listing=listing, requester=self.viewer)
+            listings.append(listing)
+        return listings
+
+    def count_list_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_page_size(self):
+        for url in [
+            "/api/items/",
+            "/api/items/favorites/",
+            "/api/items/search_items/?q=Book",
+        ]:
+            self.create_listings(2)
+            small_page = self.count_list_queries(url)
+            self.create_listings(6)
+            full_page = self.count_list_queries(url)
+            self.assertEqual(small_page, full_page, url)
+            Listing.objects.all().delete()
+
+    def test_page_lookup_fields(self):
+        favorited, other = self.create_listings(2)
+        self.profile.favorites.remove(other)
+        response = self.client.get("/api/items/")
+        results = {item["id"]: item for item in response.data["results"]}
+        self.assertTrue(results[favorited.id]["is_favorited"])
+        self.assertFalse(results[other.id]["is_favorited"])
+        self.assertTrue(results[other.id]["is_reported"])
+        self.assertEqual(results[other.id]["purchase_request_count"], 1)
+        self.assertEqual(
+            results[other.id]["purchase_requesters"],
+            [{"id": self.viewer.id, "username": "viewer"}],
+        )
+
+
+class ListingSearchTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="searcher", password="pass")
+        UserProfile.objects.create(user=self.user)
+        self.books = Category.objects.create(name="Books")
+        self.electronics = Category.objects.create(name="Electronics")
+        self.client.force_authenticate(user=self.user)
+
+    def create_listing(self, title, category, description=""):
+        return Listing.objects.create(
+            title=title,
+            category=category,
+            description=description,
+            price=5,
+            seller=self.user,
+        )
+
+    def search(self, action, query):
+        response = self.client.get(f"/api/items/{action}/", {"q": query})
+        self.assertEqual(response.status_code, 200)
+        return [item["id"] for item in response.data["results"]]
+
+    def test_prefix_terms_match_title_description_and_category(self):
+        calculator = self.create_listing("TI-84 Calculator", self.electronics)
+        lamp = self.create_listing("Desk lamp", self.electronics, "Works with any calculator desk")
+        novel = self.create_listing("Novel", self.books)
+        self.assertEqual(set(self.search("search_items", "calc")), {calculator.id, lamp.id})
+        self.assertEqual(self.search("search_items", "books"), [novel.id])
+
+    def test_title_matches_rank_first(self):
+        in_description = self.create_listing("Desk lamp", self.electronics, "Not a calculator")
+        in_title = self.create_listing("Graphing calculator", self.electronics)
+        self.assertEqual(
+            self.search("search_my_items", "calculator"), [in_title.id, in_description.id]
+        )
+
+    def test_search_sees_edited_listings(self):
+        listing = self.create_listing("Chair", self.books)
+        listing.title = "Wooden stool"
+        listing.save()
+        self.assertEqual(self.search("search_items", "stool"), [listing.id])
+        self.assertEqual(self.search("search_items", "chair"), [])
+
+    def test_search_favorites_only_returns_favorites(self):
+        favorite = self.create_listing("Calculator", self.electronics)
+        self.create_listing("Calculator case", self.electronics)
+        self.user.profile.favorites.add(favorite)
+        self.assertEqual(self.search("search_favorites", "calculator"), [favorite.id])
+
+    def test_punctuation_only_query_returns_everything(self):
+        self.create_listing("Chair", self.books)
+        self.assertEqual(len(self.search("search_items", '"*-')), 1)
+
+
+class TrigramIndexTest(TestCase):
+    def test_misspelled_and_partial_queries(self):
+        index = TrigramIndex()
+        index.build([(1, "TI-84 Calculator"), (2, "Desk lamp"), (3, "Calculus textbook")])
+        self.assertEqual(index.search("calculater", 5), [1, 3])
+        self.assertEqual(set(index.search("calc", 5)), {1, 3})
+        self.assertEqual(index.search("lamp", 5), [2])
+        index.remove(2)
+        self.assertEqual(index.search("lamp", 5), [])
+
+
+class ListingSuggestTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="typer", password="pass")
+        self.category = Category.objects.create(name="Electronics")
+        self.client.force_authenticate(user=self.user)
+
+    def create_listing(self, title, is_sold=False):
+        return Listing.objects.create(
+            title=title, category=self.category, price=5, seller=self.user, is_sold=is_sold
+        )
+
+    def suggest(self, query, **params):
+        response = self.client.get("/api/items/suggest/", {"q": query, **params})
+        self.assertEqual(response.status_code, 200)
+        return [suggestion["title"] for suggestion in response.data["suggestions"]]
+
+    def test_suggests_misspelled_titles(self):
+        self.create_listing("TI-84 Calculator")
+        self.create_listing("Desk lamp")
+        self.assertEqual(self.suggest("calculater"), ["TI-84 Calculator"])
+
+    def test_follows_listing_changes(self):
+        self.suggest("warmup")  # builds the index before the listings below exist
+        listing = self.create_listing("Mini fridge")
+        self.create_listing("Fridge magnet", is_sold=True)
+        self.assertEqual(self.suggest("fridg"), ["Mini fridge"])
+        listing.title = "Microwave"
+        listing.save()
+        self.assertEqual(self.suggest("fridg"), [])
+        self.assertEqual(self.suggest("microwav"), ["Microwave"])
+
+    def test_limit_and_short_queries(self):
+        for i in range(5):
+            self.create_listing(f"Chair {i}")
+        self.assertEqual(len(self.suggest("chair", limit=2)), 2)
+        self.assertEqual(self.suggest("c"), [])
+
+
+class ListingCursorPaginationTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="scroller", password="pass")
+        self.category = Category.objects.create(name="Furniture")
+        self.client.force_authenticate(user=self.user)
+        self.listings = [self.create_listing(f"Chair {i}", price=i % 4) for i in range(25)]
+
+    def create_listing(self, title, price=1):
+        return Listing.objects.create(
+            title=title, category=self.category, price=price, seller=self.user
+        )
+
+    def walk(self, url, params=None, between_pages=None):
+        ids = []
+        response = self.client.get(url, params)
+        while True:
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn("count", response.data)
+            ids += [item["id"] for item in response.data["results"]]
+            if not response.data["next"]:
+                return ids
+            self.assertTrue(response.data["next"].startswith("https://"))
+            if between_pages:
+                between_pages()
+            response = self.client.get(response.data["next"])
+
+    def test_newest_first_and_stable_under_inserts(self):
+        expected = [listing.id for listing in reversed(self.listings)]
+        ids = self.walk("/api/items/", between_pages=lambda: self.create_listing("New chair"))
+        self.assertEqual(ids, expected)
+
+    def test_ordering_on_non_unique_field(self):
+        ids = self.walk("/api/items/", {"ordering": "price"})
+        expected = sorted(self.listings, key=lambda listing: (listing.price, listing.id))
+        self.assertEqual(ids, [listing.id for listing in expected])
+
+    def test_ranked_search_pages(self):
+        ids = self.walk("/api/items/search_items/", {"q": "chair"})
+        self.assertEqual(sorted(ids), sorted(listing.id for listing in self.listings))
+
+
+class ListingCounterTest(APITestCase):
+    def setUp(self):
+        self.seller = User.objects.create_user(username="seller", password="pass")
+        self.buyer = User.objects.create_user(username="buyer", password="pass")
+        self.other_buyer = User.objects.create_user(username="other", password="pass")
+        for user in (self.seller, self.buyer, self.other_buyer):
+            UserProfile.objects.create(user=user)
+        self.category = Category.objects.create(name="Books")
+        self.listing = Listing.objects.create(
+            title="Test Book", category=self.category, price=5, seller=self.seller
+        )
+        self.client.force_authenticate(user=self.buyer)
+
+    def counts(self):
+        self.listing.refresh_from_db()
+        return self.listing.active_request_count, self.listing.favorite_count
+
+    def test_toggle_favorite_updates_count(self):
+        url = f"/api/items/{self.listing.id}/toggle_favorite/"
+        self.client.post(url)
+        self.assertEqual(self.counts(), (0, 1))
+        self.client.post(url)
+        self.assertEqual(self.counts(), (0, 0))
+
+    def test_purchase_requests_update_count(self):
+        first = PurchaseRequest.objects.create(listing=self.listing, requester=self.buyer)
+        PurchaseRequest.objects.create(listing=self.listing, requester=self.other_buyer)
+        self.assertEqual(self.counts(), (2, 0))
+
+        first.status = "cancelled"
+        first.is_active = False
+        first.save()
+        self.assertEqual(self.counts(), (1, 0))
+
+        self.client.force_authenticate(user=self.seller)
+        self.client.post(f"/api/items/{self.listing.id}/mark_sold/")
+        self.assertEqual(self.counts(), (0, 0))
+
+    def test_saving_a_stale_listing_keeps_counts(self):
+        stale = Listing.objects.get(id=self.listing.id)
+        PurchaseRequest.objects.create(listing=self.listing, requester=self.buyer)
+        stale.title = "Renamed"
+        stale.save()
+        self.assertEqual(self.counts(), (1, 0))
+
+    def test_recount_listings_repairs_drift(self):
+        PurchaseRequest.objects.create(listing=self.listing, requester=self.buyer)
+        self.buyer.profile.toggle_favorite(self.listing)
+        Listing.objects.update(active_request_count=7, favorite_count=0)
+        call_command("recount_listings", stdout=StringIO())
+        self.assertEqual(self.counts(), (1, 1))
+
+    def test_ordering_by_favorite_count(self):
+        popular = Listing.objects.create(
+            title="Popular", category=self.category, price=5, seller=self.seller
+        )
+        self.buyer.profile.toggle_favorite(popular)
+        response = self.client.get("/api/items/", {"ordering": "-favorite_count"})
+        self.assertEqual(
+            [item["id"] for item in response.data["results"]], [popular.id, self.listing.id]
+        )
+        self.assertEqual(response.data["results"][0]["favorite_count"], 1)
+
+
+def use_local_storage(test):
+    """
+    Points the default storage of a test at a temporary directory instead of S3.
+    """
+    media_root = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, media_root)
+    storage_settings = override_settings(
+        DEFAULT_FILE_STORAGE="django.core.files.storage.FileSystemStorage",
+        MEDIA_ROOT=media_root,
+        MEDIA_URL="/media/",
+        AWS_STORAGE_BUCKET_NAME=None,
+        IMAGE_RENDITION_WORKERS=0,
+    )
+    storage_settings.enable()
+    test.addCleanup(storage_settings.disable)
+
+
+def jpeg_bytes(size=(2400, 1200)):
+    buffer = BytesIO()
+    Image.new("RGB", size, "blue").save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+class ListingRenditionTest(APITestCase):
+    def setUp(self):
+        use_local_storage(self)
+        self.user = User.objects.create_user(username="photographer", password="pass")
+        self.category = Category.objects.create(name="Electronics")
+        self.client.force_authenticate(user=self.user)
+
+    def photo(self, name, size=(2400, 1200)):
+        image = Image.new("RGB", size, "red")
+        exif = Image.Exif()
+        exif[0x010F] = "PhoneMaker"  # camera make
+        exif[0x0112] = 6  # orientation: rotated 90 degrees
+        buffer = BytesIO()
+        image.save(buffer, format="JPEG", exif=exif)
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type="image/jpeg")
+
+    def create_listing(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                "/api/items/",
+                {
+                    "title": "Camera",
+                    "category": self.category.id,
+                    "price": 120,
+                    "image": self.photo("camera.jpg"),
+                    "additional_images": [self.photo("back.jpg", size=(800, 600))],
+                },
+                format="multipart",
+            )
+        self.assertEqual(response.status_code, 201)
+        return Listing.objects.get(id=response.data["id"])
+
+    def test_renditions_are_resized_without_exif(self):
+        listing = self.create_listing()
+        self.assertEqual(set(listing.renditions), {"thumb", "card", "full"})
+
+        with default_storage.open(listing.renditions["full"]) as stored:
+            full = Image.open(stored)
+            full.load()
+        # the orientation tag was applied, then dropped with the rest of the EXIF data
+        self.assertEqual(full.size, (800, 1600))
+        self.assertEqual(len(full.getexif()), 0)
+        with default_storage.open(listing.renditions["thumb"]) as stored:
+            self.assertEqual(max(Image.open(stored).size), 200)
+
+        item_image = listing.additional_images.get()
+        self.assertEqual(set(item_image.renditions), {"thumb", "card", "full"})
+
+    def test_image_urls_are_serialized(self):
+        listing = self.create_listing()
+        response = self.client.get(f"/api/items/{listing.id}/")
+        self.assertEqual(
+            response.data["image_urls"]["card"], f"/media/{listing.renditions['card']}"
+        )
+        self.assertEqual(len(response.data["additional_images"][0]["image_urls"]), 3)
+
+    def test_image_urls_fall_back_to_the_original(self):
+        listing = self.create_listing()
+        Listing.objects.filter(id=listing.id).update(renditions={})
+        response = self.client.get(f"/api/items/{listing.id}/")
+        self.assertEqual(
+            set(response.data["image_urls"].values()), {response.data["image_url"]}
+        )
+
+    def test_replacing_the_image_regenerates_renditions(self):
+        listing = self.create_listing()
+        old_renditions = listing.renditions
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(
+                f"/api/items/{listing.id}/",
+                {"image": self.photo("camera2.jpg", size=(300, 300))},
+                format="multipart",
+            )
+        self.assertEqual(response.status_code, 200)
+        listing.refresh_from_db()
+        self.assertNotEqual(listing.renditions["thumb"], old_renditions["thumb"])
+
+    def test_images_with_the_same_file_name_get_their_own_renditions(self):
+        def overwrite(storage, name, max_length=None):
+            # like S3, replace whatever is stored under the name instead of renaming
+            if storage.exists(name):
+                storage.delete(name)
+            return name
+
+        listings = []
+        for folder, color in (("a", "red"), ("b", "green")):
+            buffer = BytesIO()
+            Image.new("RGB", (400, 300), color).save(buffer, format="JPEG")
+            key = default_storage.save(f"uploads/{folder}/photo.jpg", BytesIO(buffer.getvalue()))
+            listing = Listing.objects.create(
+                title="Photo", category=self.category, price=5, seller=self.user, image=key
+            )
+            with mock.patch.object(FileSystemStorage, "get_available_name", overwrite):
+                generate_renditions("items.Listing", listing.id)
+            listing.refresh_from_db()
+            listings.append(listing)
+
+        first, second = (listing.renditions["thumb"] for listing in listings)
+        self.assertNotEqual(first, second)
+        with default_storage.open(first) as stored:
+            red, green, _ = Image.open(stored).convert("RGB").getpixel((0, 0))
+        # the first listing still shows its own (red) image, not the second one's
+        self.assertGreater(red, green)
+
+
+class ListingDirectUploadTest(APITestCase):
+    def setUp(self):
+        use_local_storage(self)
+        self.user = User.objects.create_user(username="uploader", password="pass")
+        self.other = User.objects.create_user(username="other", password="pass")
+        self.category = Category.objects.create(name="Electronics")
+        self.client.force_authenticate(user=self.user)
+
+    def upload(self, content_types):
+        response = self.client.post(
+            "/api/items/upload_slots/", {"content_types": content_types}, format="json"
+        )
+        self.assertEqual(response.status_code, 201)
+        slots = response.data["uploads"]
+        for slot in slots:
+            self.assertEqual(slot["method"], "PUT")
+            put = self.client.put(
+                slot["url"], jpeg_bytes(), content_type=slot["headers"]["Content-Type"]
+            )
+            self.assertEqual(put.status_code, 200)
+        return [slot["key"] for slot in slots]
+
+    def test_create_listing_from_uploaded_keys(self):
+        main, extra = self.upload(["image/jpeg", "image/jpeg"])
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                "/api/items/",
+                {
+                    "title": "Monitor",
+                    "category": self.category.id,
+                    "price": 80,
+                    "image_key": main,
+                    "additional_image_keys": [extra],
+                },
+                format="json",
+            )
+        self.assertEqual(response.status_code, 201)
+        listing = Listing.objects.get(id=response.data["id"])
+        self.assertEqual(listing.image.name, main)
+        self.assertEqual(listing.additional_images.get().image.name, extra)
+        self.assertEqual(set(listing.renditions), {"thumb", "card", "full"})
+
+    def test_update_listing_image_from_uploaded_key(self):
+        listing = Listing.objects.create(
+            title="Monitor", category=self.category, price=80, seller=self.user
+        )
+        (key,) = self.upload(["image/jpeg"])
+        response = self.client.patch(
+            f"/api/items/{listing.id}/", {"image_key": key}, format="json"
+        )
+        self.assertEqual(response.status_code, 200)
+        listing.refresh_from_db()
+        self.assertEqual(listing.image.name, key)
+
+    def test_rejects_keys_that_are_missing_or_not_yours(self):
+        (key,) = self.upload(["image/jpeg"])
+        self.client.force_authenticate(user=self.other)
+        data = {"title": "Monitor", "category": self.category.id, "price": 80}
+        response = self.client.post("/api/items/", {**data, "image_key": key}, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("image_key", response.data)
+
+        missing = f"uploads/{self.other.id}/{'0' * 32}.jpg"
+        response = self.client.post(
+            "/api/items/", {**data, "image_key": missing}, format="json"
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_rejects_uploads_that_are_not_images(self):
+        data = {"title": "Monitor", "category": self.category.id, "price": 80}
+        jpeg = jpeg_bytes()
+        buffer = BytesIO()
+        Image.new("RGB", (40, 40), "red").save(buffer, format="PNG")
+        png = buffer.getvalue()
+        for content_type, body in (
+            ("image/jpeg", b"<html>not an image</html>"),
+            ("image/png", png[:-20] + b"\x00" * 8 + png[-12:]),  # corrupt
+            ("image/png", jpeg),  # not the type of its slot
+        ):
+            response = self.client.post(
+                "/api/items/upload_slots/", {"content_types": [content_type]}, format="json"
+            )
+            slot = response.data["uploads"][0]
+            put = self.client.put(slot["url"], body, content_type=content_type)
+            self.assertEqual(put.status_code, 200)
+            response = self.client.post(
+                "/api/items/", {**data, "image_key": slot["key"]}, format="json"
+            )
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.data["image_key"], ["The upload is not an image."])
+        self.assertFalse(Listing.objects.exists())
+
+    def test_upload_slots_validation(self):
+        response = self.client.post(
+            "/api/items/upload_slots/", {"content_types": ["text/html"]}, format="json"
+        )
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(
+            "/api/items/upload_slots/", {"content_types": ["image/png"] * 11}, format="json"
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_local_upload_checks_the_signature_and_content_type(self):
+        response = self.client.post(
+            "/api/items/upload_slots/", {"content_types": ["image/png"]}, format="json"
+        )
+        url = response.data["uploads"][0]["url"]
+        self.client.logout()  # the signed URL is enough
+        self.assertEqual(
+            self.client.put(url, jpeg_bytes(), content_type="image/jpeg").status_code, 400
+        )
+        self.assertEqual(
+            self.client.put(url[:-2] + "x/", jpeg_bytes(), content_type="image/png").status_code,
+            403,
+        )
+        self.assertEqual(
+            self.client.put(url, jpeg_bytes(), content_type="image/png").status_code, 200
+        )
+
+
+class ListingAdditionalImagesTest(APITestCase):
+    def setUp(self):
+        use_local_storage(self)
+        self.user = User.objects.create_user(username="seller", password="pass")
+        self.category = Category.objects.create(name="Furniture")
+        self.client.force_authenticate(user=self.user)
+        self.listing = Listing.objects.create(
+            title="Desk", category=self.category, price=40, seller=self.user
+        )
+        self.images = self.listing.update_additional_images(
+            [SimpleUploadedFile(f"desk{i}.jpg", jpeg_bytes((50, 50))) for i in range(3)]
+        )
+
+    def files(self, count):
+        return [SimpleUploadedFile(f"new{i}.jpg", jpeg_bytes((50, 50))) for i in range(count)]
+
+    def image_ids(self):
+        return set(self.listing.additional_images.values_list("id", flat=True))
+
+    def test_keeps_listed_images_adds_new_and_removes_dropped(self):
+        kept = [self.images[0].id, self.images[2].id]
+        response = self.client.patch(
+            f"/api/items/{self.listing.id}/",
+            {"additional_image_ids": kept, "additional_images": self.files(1)},
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, 200)
+        ids = self.image_ids()
+        self.assertEqual(len(ids), 3)
+        self.assertTrue(set(kept) <= ids)
+        # the dropped image isn't left behind as an orphan row
+        self.assertFalse(ItemImage.objects.filter(id=self.images[1].id).exists())
+
+    def test_patch_without_ids_keeps_images(self):
+        self.client.patch(f"/api/items/{self.listing.id}/", {"title": "Big desk"}, format="json")
+        self.assertEqual(self.image_ids(), {image.id for image in self.images})
+
+    def test_put_without_ids_replaces_images(self):
+        response = self.client.put(
+            f"/api/items/{self.listing.id}/",
+            {
+                "title": "Desk",
+                "category": self.category.id,
+                "price": 40,
+                "additional_images": self.files(2),
+            },
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, 200)
+        ids = self.image_ids()
+        self.assertEqual(len(ids), 2)
+        self.assertFalse(ids & {image.id for image in self.images})
+        self.assertEqual(ItemImage.objects.count(), 2)
+
+    def test_rejects_ids_of_other_listings(self):
+        other = Listing.objects.create(
+            title="Lamp", category=self.category, price=5, seller=self.user
+        )
+        (other_image,) = other.update_additional_images(self.files(1))
+        response = self.client.patch(
+            f"/api/items/{self.listing.id}/",
+            {"additional_image_ids": [other_image.id]},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(self.image_ids()), 3)
+
+    def test_image_inserts_dont_grow_with_the_number_of_images(self):
+        def create_with(count):
+            data = {
+                "title": "Chair",
+                "category": self.category.id,
+                "price": 10,
+                "additional_images": self.files(count),
+            }
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post("/api/items/", data, format="multipart")
+            self.assertEqual(response.status_code, 201)
+            return len(queries)
+
+        self.assertEqual(create_with(1), create_with(5))
+
+
+class GarbageCollectImagesTest(TestCase):
+    def setUp(self):
+        use_local_storage(self)
+        user = User.objects.create_user(username="seller", password="pass")
+        category = Category.objects.create(name="Furniture")
+        self.listing = Listing.objects.create(
+            title="Desk", category=category, price=40, seller=user
+        )
+        self.kept, self.dropped = self.listing.update_additional_images(
+            [SimpleUploadedFile(f"desk{i}.jpg", jpeg_bytes((50, 50))) for i in range(2)]
+        )
+        # what update used to leave behind: a row nothing links to, and a stray file
+        Listing.additional_images.through.objects.filter(itemimage=self.dropped).delete()
+        self.stray = default_storage.save("item_images/stray.jpg", SimpleUploadedFile("s", b"x"))
+
+    def gc(self, *args):
+        out = StringIO()
+        call_command("gc_images", "--min-age=0", "--batch-size=1", *args, stdout=out)
+        return out.getvalue()
+
+    def test_dry_run_deletes_nothing(self):
+        output = self.gc("--dry-run")
+        self.assertIn("Would delete 1 image rows and 1 storage objects.", output)
+        self.assertTrue(ItemImage.objects.filter(id=self.dropped.id).exists())
+        self.assertTrue(default_storage.exists(self.stray))
+
+    def test_deletes_unreferenced_rows_and_objects(self):
+        dropped_file = self.dropped.image.name
+        output = self.gc()
+        self.assertIn("Deleted 1 image rows and 1 storage objects.", output)
+        self.assertIn("image rows: scanned 1, deleted 1", output)
+        self.assertFalse(ItemImage.objects.filter(id=self.dropped.id).exists())
+        self.assertFalse(default_storage.exists(dropped_file))
+        self.assertFalse(default_storage.exists(self.stray))
+        # everything still referenced stays
+        self.assertTrue(default_storage.exists(self.kept.image.name))
+
+    def test_files_shared_with_a_live_row_are_kept(self):
+        self.dropped.refresh_from_db()
+        # a row that reused the orphan's upload key, as resubmitting an upload does
+        shared = ItemImage.objects.create(
+            image=self.dropped.image.name, renditions=self.dropped.renditions
+        )
+        self.listing.additional_images.add(shared)
+        self.gc()
+        self.assertFalse(ItemImage.objects.filter(id=self.dropped.id).exists())
+        self.assertTrue(default_storage.exists(shared.image.name))
+        for key in shared.renditions.values():
+            self.assertTrue(default_storage.exists(key))
+
+    def test_min_age_spares_recent_uploads(self):
+        call_command("gc_images", stdout=StringIO())
+        self.assertTrue(ItemImage.objects.filter(id=self.dropped.id).exists())
+        self.assertTrue(default_storage.exists(self.stray))
@@ -0,0 +1,126 @@
+# trigrams.py - In-process trigram index of listing titles
+# Used for typo-tolerant title suggestions on databases without pg_trgm (SQLite in dev/test).
+# Trigrams are built the same way pg_trgm builds them, so suggestions behave alike on both.
+
+import heapq
+import math
+import re
+import threading
+import time
+
+WORD_PATTERN = re.compile(r"[^\W_]+")
+
+# minimum share of the query's trigrams a title must contain to be suggested
+DEFAULT_THRESHOLD = 0.5
+
+
+def trigrams(text):
+    """
+    Returns the set of trigrams of a string, pg_trgm style: every word is lowercased and
+    padded with two spaces in front and one behind before being cut into trigrams.
+    """
+    result = set()
+    for word in WORD_PATTERN.findall(text.lower()):
+        padded = f"  {word} "
+        result.update(padded[i : i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+def score(query_trigrams, title_trigrams):
+    """
+    Scores a title against a query.
+
+    Returns a (word_similarity, similarity) tuple. word_similarity is the share of the
+    query's trigrams found in the title, so a prefix of a word scores high while typing.
+    similarity (shared / union) breaks ties in favour of titles close to the whole query.
+    """
+    if not query_trigrams or not title_trigrams:
+        return 0.0, 0.0
+    shared = len(query_trigrams & title_trigrams)
+    union = len(query_trigrams) + len(title_trigrams) - shared
+    return shared / len(query_trigrams), shared / union
+
+
+class TrigramIndex:
+    """
+    An inverted index from trigrams to listing IDs, kept in memory.
+
+    The index only proposes candidates. Callers check them against the database, so a
+    stale entry can never surface a sold or deleted listing. It is rebuilt from the
+    database once it is older than max_age seconds to pick up changes made by other
+    processes, and kept current in between by the Listing signals in items.models.
+    """
+
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.built_at = None
+        self.titles = {}  # listing id -> trigram set of its title
+        self.postings = {}  # trigram -> set of listing ids
+
+    def build(self, rows):
+        """
+        Replaces the index content with the given (listing id, title) rows.
+        """
+        with self.lock:
+            self.titles = {}
+            self.postings = {}
+            for listing_id, title in rows:
+                self._add(listing_id, title)
+            self.built_at = time.monotonic()
+
+    def is_stale(self):
+        return self.built_at is None or time.monotonic() - self.built_at > self.max_age
+
+    def add(self, listing_id, title):
+        with self.lock:
+            self._remove(listing_id)
+            self._add(listing_id, title)
+
+    def remove(self, listing_id):
+        with self.lock:
+            self._remove(listing_id)
+
+    def _add(self, listing_id, title):
+        title_trigrams = frozenset(trigrams(title))
+        self.titles[listing_id] = title_trigrams
+        for trigram in title_trigrams:
+            self.postings.setdefault(trigram, set()).add(listing_id)
+
+    def _remove(self, listing_id):
+        for trigram in self.titles.pop(listing_id, ()):
+            ids = self.postings.get(trigram)
+            if ids is not None:
+                ids.discard(listing_id)
+                if not ids:
+                    del self.postings[trigram]
+
+    def search(self, query, limit, threshold=DEFAULT_THRESHOLD):
+        """
+        Returns up to `limit` listing IDs whose titles best match the query, best first.
+
+        A title needs at least ceil(threshold * n) of the query's n trigrams, so it has to
+        appear in one of the n - need + 1 rarest posting lists. Only those lists are
+        scanned to find candidates, which keeps common trigrams like "  s" cheap.
+        """
+        query_trigrams = trigrams(query)
+        if not query_trigrams:
+            return []
+        need = max(1, math.ceil(threshold * len(query_trigrams)))
+
+        with self.lock:
+            postings = sorted(
+                (self.postings.get(trigram, ()) for trigram in query_trigrams), key=len
+            )
+            candidates = set().union(*postings[: len(query_trigrams) - need + 1])
+            scored = []
+            for listing_id in candidates:
+                word_similarity, similarity = score(query_trigrams, self.titles[listing_id])
+                if word_similarity >= threshold:
+                    scored.append((word_similarity, similarity, listing_id))
+
+        return [entry[2] for entry in heapq.nlargest(limit, scored)]
+
+
+# the process-wide index of unsold listing titles
+title_index = TrigramIndex()
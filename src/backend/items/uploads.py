@@ -0,0 +1,204 @@
+# uploads.py - Direct-to-storage uploads of listing images
+# Instead of sending image bytes through the app (and holding a worker for the whole upload),
+# clients ask for upload slots, PUT each image straight to storage with the presigned URL of
+# its slot, then create or update the listing with the keys of the uploaded objects:
+#
+#   POST /api/items/upload_slots/  {"content_types": ["image/jpeg"]}
+#   PUT  <url of the slot>         (the image bytes, with the slot's headers)
+#   POST /api/items/               {"title": ..., "image_key": <key of the slot>}
+#
+# In production the URLs are S3 presigned PUT URLs. Without a bucket (development and tests)
+# LocalUploadStorage hands out signed URLs of the local_upload view, which writes to the
+# default storage, so the same flow works offline.
+
+import re
+import uuid
+
+from django.conf import settings
+from django.core import signing
+from django.core.files.storage import default_storage
+from django.urls import reverse
+from django.utils.module_loading import import_string
+from PIL import Image
+from rest_framework import serializers
+
+# image types that can be uploaded, with the file extension used for their key
+CONTENT_TYPE_EXTENSIONS = {
+    "image/jpeg": "jpg",
+    "image/png": "png",
+    "image/webp": "webp",
+    "image/heic": "heic",
+}
+# the Pillow format an upload's bytes have to be in, by the extension of its key
+EXTENSION_FORMATS = {"jpg": "JPEG", "png": "PNG", "webp": "WEBP"}
+# HEIC/HEIF brands of the ftyp box, as Pillow can't read HEIC without a plugin
+HEIC_BRANDS = {b"heic", b"heix", b"hevc", b"hevx", b"mif1", b"msf1"}
+MAX_SLOTS = 10  # the main image and up to 9 additional ones
+SIGNING_SALT = "items.uploads"
+
+
+def new_upload_key(user, content_type):
+    """
+    Returns a fresh storage key for an upload of the user. Keys are namespaced by user id,
+    so a listing can only ever reference images its seller uploaded.
+    """
+    extension = CONTENT_TYPE_EXTENSIONS[content_type]
+    return f"uploads/{user.id}/{uuid.uuid4().hex}.{extension}"
+
+
+def validate_upload_key(key, user):
+    """
+    Checks that a key names a finished upload of the user, within the size limit, and that
+    it holds an image of the type the key claims.
+
+    Raises:
+        ValidationError: If the key isn't one of the user's uploads, or the upload is
+            missing, too large or not an image.
+
+    Returns:
+        str: The key.
+    """
+    extensions = "|".join(CONTENT_TYPE_EXTENSIONS.values())
+    if not re.fullmatch(rf"uploads/{user.id}/[0-9a-f]{{32}}\.({extensions})", key):
+        raise serializers.ValidationError("This is not one of your uploads.")
+    storage = get_upload_storage()
+    if not storage.exists(key):
+        raise serializers.ValidationError("Nothing has been uploaded with this key yet.")
+    if storage.size(key) > settings.IMAGE_UPLOAD_MAX_SIZE:
+        raise serializers.ValidationError("The uploaded image is too large.")
+    if not storage.is_image(key):
+        raise serializers.ValidationError("The upload is not an image.")
+    return key
+
+
+class BaseUploadStorage:
+    """
+    Hands out upload URLs for keys of the default storage, and walks and deletes its
+    objects for the gc_images command.
+    """
+
+    def presign_put(self, key, content_type, request):
+        """
+        Returns how to upload an object, as a dict with the "url", the "method" and the
+        "headers" the client has to send.
+        """
+        raise NotImplementedError
+
+    def exists(self, key):
+        return default_storage.exists(key)
+
+    def size(self, key):
+        return default_storage.size(key)
+
+    def is_image(self, key):
+        """
+        Returns whether an object holds an image in the format of its key's extension. The
+        client picked the bytes it PUT, so the slot's Content-Type proves nothing.
+        """
+        extension = key.rsplit(".", 1)[-1]
+        try:
+            with default_storage.open(key, "rb") as stored:
+                if extension == "heic":
+                    header = stored.read(12)
+                    return header[4:8] == b"ftyp" and header[8:12] in HEIC_BRANDS
+                image = Image.open(stored)
+                image.verify()  # reads the whole file, the size was checked already
+                return image.format == EXTENSION_FORMATS[extension]
+        except Exception:
+            # anything Pillow can't parse, including decompression bombs
+            return False
+
+    def iter_keys(self, prefix):
+        """
+        Yields the (key, last modified datetime) of every object under a prefix, one
+        directory at a time so memory stays bounded.
+        """
+        try:
+            directories, files = default_storage.listdir(prefix)
+        except FileNotFoundError:
+            return
+        for name in files:
+            key = f"{prefix}{name}"
+            yield key, default_storage.get_modified_time(key)
+        for directory in directories:
+            yield from self.iter_keys(f"{prefix}{directory}/")
+
+    def delete_keys(self, keys):
+        for key in keys:
+            default_storage.delete(key)
+
+
+class S3UploadStorage(BaseUploadStorage):
+    """
+    Presigned S3 PUT URLs for the bucket of the default (S3Boto3Storage) storage.
+    """
+
+    def presign_put(self, key, content_type, request):
+        client = default_storage.connection.meta.client
+        url = client.generate_presigned_url(
+            "put_object",
+            Params={
+                "Bucket": default_storage.bucket_name,
+                "Key": default_storage._normalize_name(key),
+                "ContentType": content_type,
+            },
+            ExpiresIn=settings.IMAGE_UPLOAD_EXPIRY,
+        )
+        return {"url": url, "method": "PUT", "headers": {"Content-Type": content_type}}
+
+    def iter_keys(self, prefix):
+        # the bucket listing is fetched lazily, a page of 1000 keys at a time
+        location = default_storage.location.strip("/")
+        full_prefix = f"{location}/{prefix}" if location else prefix
+        for obj in default_storage.bucket.objects.filter(Prefix=full_prefix).page_size(1000):
+            yield obj.key[len(full_prefix) - len(prefix) :], obj.last_modified
+
+    def delete_keys(self, keys):
+        # one DeleteObjects request per 1000 keys instead of a request per key
+        keys = list(keys)
+        for start in range(0, len(keys), 1000):
+            default_storage.bucket.delete_objects(
+                Delete={
+                    "Objects": [
+                        {"Key": default_storage._normalize_name(key)}
+                        for key in keys[start : start + 1000]
+                    ],
+                    "Quiet": True,
+                }
+            )
+
+
+class LocalUploadStorage(BaseUploadStorage):
+    """
+    Stand-in for S3 presigned URLs: a signed, expiring URL of the local_upload view.
+    """
+
+    def presign_put(self, key, content_type, request):
+        token = signing.dumps({"key": key, "content_type": content_type}, salt=SIGNING_SALT)
+        url = request.build_absolute_uri(reverse("local-upload", args=[token]))
+        return {"url": url, "method": "PUT", "headers": {"Content-Type": content_type}}
+
+    @staticmethod
+    def load_token(token):
+        """
+        Returns the {"key", "content_type"} signed into a token.
+
+        Raises:
+            BadSignature: If the token was tampered with or has expired.
+        """
+        return signing.loads(token, salt=SIGNING_SALT, max_age=settings.IMAGE_UPLOAD_EXPIRY)
+
+
+def get_upload_storage():
+    """
+    Returns the upload storage to use.
+
+    settings.ITEM_UPLOAD_STORAGE can point to an upload storage class by dotted path,
+    otherwise S3 is used when a bucket is configured.
+    """
+    storage_path = getattr(settings, "ITEM_UPLOAD_STORAGE", None)
+    if storage_path:
+        return import_string(storage_path)()
+    if settings.AWS_STORAGE_BUCKET_NAME:
+        return S3UploadStorage()
+    return LocalUploadStorage()
@@ -1,6 +1,6 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import ItemViewSet
+from .views import ItemViewSet, local_upload
 
 router = DefaultRouter()
 router.register(
@@ -10,5 +10,7 @@ router.register(
 # GET /items/favorites/ - Retrieves all favorite listings.
 
 urlpatterns = [
+    # stand-in for S3 presigned upload URLs when no bucket is configured (see items.uploads)
+    path("items/uploads/<str:token>/", local_upload, name="local-upload"),
     path("", include(router.urls)),  # if using ViewSet
 ]
@@ -1,22 +1,46 @@
 # Import Modules
 from rest_framework import viewsets
 from categories.serializers import CategorySerializer
-from .models import Listing, ItemImage
+from .models import Listing
 from purchase_requests.models import PurchaseRequest
 from purchase_requests.serializers import PurchaseRequestSerializer
 from .serializers import ItemSerializer
+from .search import get_search_backend
 from .permissions import IsSellerOrReadOnly
-from rest_framework.decorators import action, api_view, parser_classes
+from .pagination import HttpsCursorPagination
+from .renditions import schedule_renditions
+from .uploads import (
+    CONTENT_TYPE_EXTENSIONS,
+    MAX_SLOTS,
+    LocalUploadStorage,
+    get_upload_storage,
+    new_upload_key,
+)
+from rest_framework.decorators import (
+    action,
+    api_view,
+    authentication_classes,
+    parser_classes,
+    permission_classes,
+)
 from rest_framework.parsers import (
     MultiPartParser,
     FormParser,
+    JSONParser,
 )  # parse form content + media files
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status, filters
 from rest_framework_simplejwt.authentication import JWTAuthentication
-from django.db.models import Q  # for searching stuff
 from django_filters.rest_framework import DjangoFilterBackend
+from django.conf import settings
+from django.core import signing
+from django.db import transaction
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+DEFAULT_SUGGESTIONS = 8
+MAX_SUGGESTIONS = 20
 
 
 class ItemViewSet(viewsets.ModelViewSet):
@@ -37,14 +61,18 @@ class ItemViewSet(viewsets.ModelViewSet):
         ordering_fields (list): Fields used for ordering.
         ordering (list): Default ordering.
         parser_classes (list): Parser classes used for file uploads.
+        pagination_class (Paginator): Cursor pagination, so deep pages of the feed stay cheap.
 
     Methods:
         perform_create(serializer): Sets the seller to the current user when creating a listing.
+        perform_update(serializer): Regenerates the image renditions when the image is replaced.
         get_serializer_context(): Adds the request to the serializer context.
         toggle_favorite(request, pk=None): Toggles a listing as a favorite for the user.
         favorites(request): Returns all favorite listings for the user.
         search_favorites(request): Searches favorite listings for the user.
         search_items(request, pk=None): Searches all listings based on a query.
+        suggest(request): Suggests listing titles for a partial, possibly misspelled query.
+        upload_slots(request): Hands out URLs to upload images straight to storage.
         my_items(request): Returns the logged-in user's listings.
         search_my_items(request): Searches the logged-in user's listings.
         request_purchase(request, pk=None): Creates a purchase request for a listing.
@@ -69,14 +97,18 @@ class ItemViewSet(viewsets.ModelViewSet):
     ]
     filterset_fields = ["category", "seller"]
     search_fields = ["title", "description", "category__name"]  # fields to search by
-    ordering_fields = ["created_at", "price", "title"]
+    ordering_fields = ["created_at", "price", "title", "favorite_count"]
     ordering = ["-created_at"]  # order by creation date in descending order
-    parser_classes = [MultiPartParser, FormParser]  # media files are handled
+    # media files are handled, JSON is enough when images are referenced by upload key
+    parser_classes = [MultiPartParser, FormParser, JSONParser]
+    pagination_class = HttpsCursorPagination  # no COUNT/OFFSET on every page of the feed
 
     def get_queryset(self):
+        # additional images are prefetched so a page loads them in one query instead of one per listing
+        queryset = Listing.objects.prefetch_related("additional_images")
         if self.action == "retrieve":
-            return Listing.objects.all()  # allow sold items in detail view
-        return Listing.objects.filter(is_sold=False)  # hide sold items everywhere else
+            return queryset  # allow sold items in detail view
+        return queryset.filter(is_sold=False)  # hide sold items everywhere else
 
     def create(self, request, *args, **kwargs):
         """
@@ -89,13 +121,15 @@ class ItemViewSet(viewsets.ModelViewSet):
 
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        instance = self.perform_create(serializer)
-        # then check if there are any additional images
-        additional_images = request.FILES.getlist("additional_images")
-        if additional_images:
-            for img in additional_images:
-                item_image = ItemImage.objects.create(image=img)
-                instance.additional_images.add(item_image)
+        # keys of additional images already uploaded to storage, see upload_slots
+        additional_image_keys = serializer.validated_data.pop("additional_image_keys", [])
+        serializer.validated_data.pop("additional_image_ids", None)  # nothing to keep yet
+        with transaction.atomic():
+            instance = self.perform_create(serializer)
+            # then check if there are any additional images (bulk inserted)
+            additional_images = request.FILES.getlist("additional_images") + additional_image_keys
+            for item_image in instance.update_additional_images(additional_images):
+                schedule_renditions(item_image)
 
         headers = self.get_success_headers(serializer.data)
         return Response(
@@ -106,7 +140,19 @@ class ItemViewSet(viewsets.ModelViewSet):
         """
         Set seller to current user when creating listing.
         """
-        return serializer.save(seller=self.request.user)
+        instance = serializer.save(seller=self.request.user)
+        schedule_renditions(instance)  # resized off the request path, see items.renditions
+        return instance
+
+    def perform_update(self, serializer):
+        """
+        Drops the renditions of a replaced image and schedules new ones.
+        """
+        if "image" in serializer.validated_data:
+            instance = serializer.save(renditions={})
+            schedule_renditions(instance)
+        else:
+            serializer.save()
 
     def update(self, request, *args, **kwargs):
         """
@@ -125,17 +171,20 @@ class ItemViewSet(viewsets.ModelViewSet):
             )
         serializer = self.get_serializer(instance, data=request.data, partial=partial)
         serializer.is_valid(raise_exception=True)
-        self.perform_update(serializer)
-        # data = request.data.copy()  # mutable copy of request.data
-
-        # check if there are any additional images
-        instance.additional_images.clear()
-        additional_images = request.FILES.getlist("additional_images")
-        if additional_images:
-            for img in additional_images:
-                item_image = ItemImage.objects.create(image=img)
-                instance.additional_images.add(item_image)
-        # data["uploaded_images"] = additional_images
+        additional_image_keys = serializer.validated_data.pop("additional_image_keys", [])
+        # images not listed in additional_image_ids are removed. Without the list, a PUT
+        # replaces all of them (older clients re-send every image) and a PATCH keeps them
+        keep_ids = serializer.validated_data.pop("additional_image_ids", None)
+        if keep_ids is None and not partial:
+            keep_ids = []
+        with transaction.atomic():
+            self.perform_update(serializer)
+            # data = request.data.copy()  # mutable copy of request.data
+
+            # check if there are any additional images
+            additional_images = request.FILES.getlist("additional_images") + additional_image_keys
+            for item_image in instance.update_additional_images(additional_images, keep_ids):
+                schedule_renditions(item_image)
 
         if getattr(instance, "_prefetched_objects_cache", None):
             # if 'prefetch_related has been applied to a queryset,
@@ -209,9 +258,7 @@ class ItemViewSet(viewsets.ModelViewSet):
             listing.save()
 
             # Optional: deactivate all related purchase requests
-            PurchaseRequest.objects.filter(listing=listing).update(
-                is_active=False, status="declined"
-            )
+            PurchaseRequest.objects.filter(listing=listing).deactivate(status="declined")
 
             return Response(
                 {"detail": "Listing marked as sold."},
@@ -246,18 +293,12 @@ class ItemViewSet(viewsets.ModelViewSet):
                 self.get_object()
             )  # retrieve the listing based on pk provided in URL
 
-            if user_profile.favorites.filter(pk=listing.pk).exists():
-                user_profile.favorites.remove(
-                    listing
-                )  # if item is already in favorites, remove it
-                # A message indicating whether the listing was removed.
-                return Response({"message": "Listing removed from favorites."})
-            else:
-                user_profile.favorites.add(
-                    listing
-                )  # if item is not in favorites, add it
+            # removes the item if it's already in favorites, adds it otherwise
+            if user_profile.toggle_favorite(listing):
                 # A message indicating whether the listing was added.
                 return Response({"message": "Listing added to favorites."})
+            # A message indicating whether the listing was removed.
+            return Response({"message": "Listing removed from favorites."})
         except Listing.DoesNotExist:
             return Response({"error": "Listing not found."}, status=404)
 
@@ -274,8 +315,8 @@ class ItemViewSet(viewsets.ModelViewSet):
         """
         # get instance of currently logged in user
         user_profile = request.user.profile
-        favorites = user_profile.favorites.filter(
-            is_sold=False
+        favorites = user_profile.favorites.filter(is_sold=False).prefetch_related(
+            "additional_images"
         )  # get all the user's favorites
 
         # Paginate stuff
@@ -305,17 +346,11 @@ class ItemViewSet(viewsets.ModelViewSet):
         """
         query = request.query_params.get("q", "")
         user_profile = request.user.profile
-        favorites = user_profile.favorites.filter(is_sold=False)
-        if query:
-            items = favorites.filter(
-                Q(title__icontains=query)
-                | Q(description__icontains=query)
-                | Q(
-                    category__name__icontains=query
-                )  # search in title, description, and category name
-            )
-        else:
-            items = favorites
+        favorites = user_profile.favorites.filter(is_sold=False).prefetch_related(
+            "additional_images"
+        )
+        # search in title, description, and category name, most relevant first
+        items = get_search_backend().search(favorites, query)
         page = self.paginate_queryset(items)
         if page is not None:
             serializer = self.get_serializer(page, many=True)
@@ -336,20 +371,69 @@ class ItemViewSet(viewsets.ModelViewSet):
             Response: A response containing the search results.
         """
         query = request.query_params.get("q", "")
-        if query:
-            items = self.get_queryset().filter(
-                Q(title__icontains=query)
-                | Q(description__icontains=query)
-                | Q(
-                    category__name__icontains=query
-                )  # search in title, description, and category name
-            )
-        else:
-            items = self.get_queryset()
+        # search in title, description, and category name, most relevant first
+        items = get_search_backend().search(self.get_queryset(), query)
         return self.get_paginated_response(
             self.get_serializer(self.paginate_queryset(items), many=True).data
         )
 
+    @action(detail=False, methods=["GET"], permission_classes=[IsAuthenticated])
+    def suggest(self, request):
+        """
+        Suggests listing titles for typeahead, tolerating typos ("calculater" finds "Calculator").
+
+        Args:
+            request (Request): The request object. Takes the query in "q" and an optional
+                "limit" (default 8, at most 20).
+
+        Returns:
+            Response: A response containing the suggested listing ids and titles.
+        """
+        query = request.query_params.get("q", "")
+        try:
+            limit = int(request.query_params.get("limit", DEFAULT_SUGGESTIONS))
+        except ValueError:
+            limit = DEFAULT_SUGGESTIONS
+        limit = min(max(limit, 1), MAX_SUGGESTIONS)
+
+        suggestions = get_search_backend().suggest(self.get_queryset(), query, limit)
+        return Response({"suggestions": suggestions})
+
+    @action(detail=False, methods=["POST"], permission_classes=[IsAuthenticated])
+    def upload_slots(self, request):
+        """
+        Hands out upload slots for images, so their bytes go straight to storage instead of
+        through the app. The keys of the uploaded images are then sent as "image_key" and
+        "additional_image_keys" when creating or updating a listing.
+
+        Args:
+            request (Request): The request object. Takes the "content_types" of the images
+                to upload (at most 10), e.g. ["image/jpeg", "image/png"].
+
+        Returns:
+            Response: A response containing one {"key", "url", "method", "headers"} slot
+                per content type.
+        """
+        content_types = request.data.get("content_types")
+        if not isinstance(content_types, list) or not 0 < len(content_types) <= MAX_SLOTS:
+            return Response(
+                {"detail": f"Provide between 1 and {MAX_SLOTS} content_types."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        unsupported = [ct for ct in content_types if ct not in CONTENT_TYPE_EXTENSIONS]
+        if unsupported:
+            return Response(
+                {"detail": f"Unsupported content types: {', '.join(map(str, unsupported))}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        storage = get_upload_storage()
+        slots = []
+        for content_type in content_types:
+            key = new_upload_key(request.user, content_type)
+            slots.append({"key": key, **storage.presign_put(key, content_type, request)})
+        return Response({"uploads": slots}, status=status.HTTP_201_CREATED)
+
     @action(detail=False, methods=["GET"], permission_classes=[IsAuthenticated])
     def my_items(self, request):
         """
@@ -361,7 +445,9 @@ class ItemViewSet(viewsets.ModelViewSet):
         Returns:
             Response: A response containing the user's listings.
         """
-        items = Listing.objects.filter(seller=request.user)
+        items = Listing.objects.filter(seller=request.user).prefetch_related(
+            "additional_images"
+        )
         page = self.paginate_queryset(items)
         if page is not None:
             serializer = self.get_serializer(page, many=True)
@@ -384,14 +470,7 @@ class ItemViewSet(viewsets.ModelViewSet):
         """
         query = request.query_params.get("q", "")
         base_queryset = self.get_queryset().filter(seller=request.user)
-        if query:
-            items = base_queryset.filter(
-                Q(title__icontains=query)
-                | Q(description__icontains=query)
-                | Q(category__name__icontains=query)
-            )  # Get only their listings
-        else:
-            items = base_queryset
+        items = get_search_backend().search(base_queryset, query)  # Get only their listings
         page = self.paginate_queryset(items)
         if page is not None:
             serializer = self.get_serializer(page, many=True)
@@ -462,3 +541,43 @@ class ItemViewSet(viewsets.ModelViewSet):
 
         listing.delete()
         return Response({"success": "Listing deleted."}, status=status.HTTP_200_OK)
+
+
+@api_view(["PUT"])
+@authentication_classes([])  # the signed token in the URL is the credential
+@permission_classes([AllowAny])
+def local_upload(request, token):
+    """
+    Receives an upload for a slot handed out by LocalUploadStorage, standing in for an S3
+    presigned PUT URL when no bucket is configured.
+
+    Args:
+        request (Request): The request object, with the image bytes as its body.
+        token (str): The signed key and content type of the slot.
+
+    Returns:
+        Response: An empty response once the image is stored.
+    """
+    try:
+        slot = LocalUploadStorage.load_token(token)
+    except signing.BadSignature:
+        return Response(
+            {"detail": "This upload URL is invalid or has expired."},
+            status=status.HTTP_403_FORBIDDEN,
+        )
+    if request.content_type.split(";")[0].strip() != slot["content_type"]:
+        return Response(
+            {"detail": "The Content-Type doesn't match the upload slot."},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    # read straight from the stream, the body would be capped by DATA_UPLOAD_MAX_MEMORY_SIZE
+    data = request._request.read(settings.IMAGE_UPLOAD_MAX_SIZE + 1)
+    if len(data) > settings.IMAGE_UPLOAD_MAX_SIZE:
+        return Response(
+            {"detail": "The image is too large."},
+            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        )
+    default_storage.delete(slot["key"])  # a retried PUT overwrites, like on S3
+    default_storage.save(slot["key"], ContentFile(data))
+    return Response(status=status.HTTP_200_OK)
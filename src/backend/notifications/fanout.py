@@ -0,0 +1,267 @@
+# fanout.py - Creating notifications off the request path
+# Sending a chat message or a purchase request used to INSERT its Notification right away,
+# and a burst of 20 chat messages made 20 nearly identical "sent a message" rows.
+# notify() and notify_chat() now only queue the notification once the transaction commits,
+# and a worker thread saves everything that queued up in one go, with one bulk INSERT for new
+# rows and one bulk UPDATE for collapsed ones.
+#
+# Chat notifications of the same recipient and room collapse into one row with a count: the
+# ones queued together, and into the recipient's unread row of that room if it is less than
+# CHAT_NOTIFICATION_WINDOW seconds old. Collapsed rows move to the top of the feed and are
+# pushed to the recipient's socket again. Pushes carry the recipient's unread count (see
+# notifications.unread).
+#
+# A batch that fails to save goes back in the queue and is retried with backoff (right away
+# with NOTIFICATION_WORKER off), up to NOTIFICATION_RETRIES times, then logged and dropped.
+# Whatever is still queued when the process exits is saved before it does.
+
+import atexit
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from . import unread
+from .models import Notification, NotificationType
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_pending = []  # notifications committed but not saved yet
+_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Returns the process-wide worker, created on first use. A single thread, so collapsing
+    never races with itself.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="notifications")
+    return _executor
+
+
+def chat_key(room_id):
+    return f"chat:{room_id}"
+
+
+def chat_text(sender_name, count):
+    if count == 1:
+        return f"{sender_name} sent a message about an item you posted"
+    return f"{sender_name} sent {count} messages about an item you posted"
+
+
+def notify(recipient_id, notification_type, message, related_item=None):
+    """
+    Queues a notification, to be saved once the current transaction commits.
+
+    Args:
+        recipient_id (int): The id of the user to notify.
+        notification_type (str): A NotificationType.
+        message (str): The text of the notification.
+        related_item (str): The title of the item it is about, if any.
+    """
+    queue(
+        {
+            "recipient_id": recipient_id,
+            "type": notification_type,
+            "message": message,
+            "related_item": related_item,
+            "collapse_key": None,
+        }
+    )
+
+
+def notify_chat(recipient_id, room_id, sender_name):
+    """
+    Queues the notification of a chat message, to be saved once the current transaction
+    commits and collapsed with the others of the room.
+    """
+    queue(
+        {
+            "recipient_id": recipient_id,
+            "type": NotificationType.CHAT,
+            "message": chat_text(sender_name, 1),
+            "related_item": None,
+            "collapse_key": chat_key(room_id),
+            "sender_name": sender_name,
+        }
+    )
+
+
+def queue(pending):
+    pending["created_at"] = timezone.now()
+
+    def enqueue():
+        with _lock:
+            _pending.append(pending)
+            first = len(_pending) == 1  # otherwise a drain is on its way already
+        if not settings.NOTIFICATION_WORKER:
+            drain(backoff=False)  # don't keep the committing request waiting on the backoff
+        elif first:
+            get_executor().submit(run_in_worker)
+
+    transaction.on_commit(enqueue)
+
+
+def run_in_worker():
+    """
+    Worker entry point. Errors are logged instead of being lost in the future, and the
+    thread's database connection is cleaned up after every batch.
+    """
+    close_old_connections()
+    try:
+        drain(close_old_connections)
+    except Exception:
+        logger.exception("Could not save notifications")
+    finally:
+        close_old_connections()
+
+
+def drain(before_retry=None, backoff=True):
+    """
+    Saves the queued notifications, retrying failed batches with exponential backoff.
+
+    Args:
+        before_retry (callable): Called before every retry, e.g. to drop a broken
+            database connection.
+        backoff (bool): False to retry right away, e.g. when a request thread is waiting.
+    """
+    while True:
+        attempts = deliver_pending()
+        if not attempts:
+            return
+        if backoff:
+            time.sleep(settings.NOTIFICATION_RETRY_BACKOFF * 2 ** (attempts - 1))
+        if before_retry is not None:
+            before_retry()
+
+
+def deliver_pending():
+    """
+    Saves the queued notifications. A batch that fails goes back in front of the queue.
+
+    Returns:
+        int: The most attempts of the notifications queued again, 0 if none were.
+    """
+    global _pending
+    with _lock:
+        batch, _pending = _pending, []
+    if not batch:
+        return 0
+    try:
+        deliver(batch)
+    except Exception:
+        logger.exception("Could not save %s notifications", len(batch))
+        return requeue(batch)
+    return 0
+
+
+def requeue(batch):
+    """
+    Puts notifications that could not be saved back in front of the queue, dropping the ones
+    out of retries.
+
+    Returns:
+        int: The most attempts of the notifications queued again, 0 if none were.
+    """
+    retried = []
+    for pending in batch:
+        pending["attempts"] = pending.get("attempts", 0) + 1
+        if pending["attempts"] > settings.NOTIFICATION_RETRIES:
+            logger.error(
+                "Dropping a %s notification of user %s after %s attempts",
+                pending["type"],
+                pending["recipient_id"],
+                pending["attempts"],
+            )
+        else:
+            retried.append(pending)
+    with _lock:
+        _pending[:0] = retried
+    return max((pending["attempts"] for pending in retried), default=0)
+
+
+# save what is still queued when the process exits (the worker thread is joined first)
+atexit.register(deliver_pending)
+
+
+def deliver(batch):
+    """
+    Saves queued notifications, collapsing the chat ones.
+
+    Args:
+        batch (list[dict]): Queued notifications, oldest first.
+
+    Returns:
+        list[Notification]: The notifications created or updated.
+    """
+    rows = []
+    collapsible = {}  # (recipient id, collapse key) -> row
+    for pending in batch:
+        key = (pending["recipient_id"], pending["collapse_key"])
+        if pending["collapse_key"] and key in collapsible:
+            row = collapsible[key]
+            row["count"] += 1
+            row["created_at"] = pending["created_at"]
+            continue
+        row = {**pending, "count": 1}
+        rows.append(row)
+        if pending["collapse_key"]:
+            collapsible[key] = row
+
+    with transaction.atomic():
+        existing = {}
+        if collapsible:
+            since = timezone.now() - timedelta(seconds=settings.CHAT_NOTIFICATION_WINDOW)
+            candidates = (
+                Notification.objects.select_for_update()
+                .filter(
+                    recipient_id__in={recipient_id for recipient_id, _ in collapsible},
+                    collapse_key__in={key for _, key in collapsible},
+                    is_read=False,
+                    created_at__gte=since,
+                )
+                .order_by("created_at")
+            )
+            # the newest row of each recipient and room wins
+            existing = {(n.recipient_id, n.collapse_key): n for n in candidates}
+
+        created, updated = [], []
+        for row in rows:
+            notification = existing.get((row["recipient_id"], row["collapse_key"]))
+            if notification is None:
+                notification = Notification(
+                    recipient_id=row["recipient_id"],
+                    type=row["type"],
+                    related_item=row["related_item"],
+                    collapse_key=row["collapse_key"],
+                    count=0,
+                )
+                created.append(notification)
+            else:
+                updated.append(notification)
+            notification.count += row["count"]
+            notification.created_at = row["created_at"]
+            if row["collapse_key"]:
+                notification.message = chat_text(row["sender_name"], notification.count)
+            else:
+                notification.message = row["message"]
+
+        Notification.objects.bulk_create(created)
+        Notification.objects.bulk_update(updated, ["count", "created_at", "message"])
+        # bump the recipients' cached unread counts and push the notifications with them
+        by_recipient = {}
+        for notification in created + updated:
+            by_recipient.setdefault(notification.recipient_id, []).append(notification)
+        new_counts = Counter(notification.recipient_id for notification in created)
+        for recipient_id, notifications in by_recipient.items():
+            unread.adjust(recipient_id, new_counts[recipient_id], notifications)
+    return created + updated
@@ -0,0 +1,165 @@
+import asyncio
+import random
+import time
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat import views as chat_views
+from chat.consumers import UserConsumer
+from notifications.fanout import deliver
+from notifications.models import Notification, NotificationType
+from notifications.views import NotificationViewSet
+
+# how often the app polls each unread count when it has no socket, see
+# app/(tabs)/_layout.tsx and components/Header.tsx
+POLL_INTERVAL = 120  # seconds
+POLLED_VIEWS = (
+    ("/api/notifications/unread_count/", NotificationViewSet.as_view({"get": "unread_count"})),
+    ("/api/chat/unread-count/", chat_views.unread_count),
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the unread count polling that pushing notifications over ws/user/ saves: "
+        "the requests per second --users polling clients make and what each costs, vs. the "
+        "cost of pushing notifications to as many connected sockets. The bench users are "
+        "deleted afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--users",
+            type=int,
+            default=1000,
+            help="Concurrent users (default: 1000)",
+        )
+        parser.add_argument(
+            "--notifications",
+            type=int,
+            default=500,
+            help="Notifications pushed to random users (default: 500)",
+        )
+        parser.add_argument(
+            "--polls",
+            type=int,
+            default=500,
+            help="Poll requests timed to get the cost of one (default: 500)",
+        )
+        parser.add_argument(
+            "--per-user",
+            type=int,
+            default=20,
+            help="Notifications every user has already, half of them read (default: 20)",
+        )
+
+    def handle(self, *args, **options):
+        users = User.objects.bulk_create(
+            User(username=f"bench_notify_{i}") for i in range(options["users"])
+        )
+        try:
+            Notification.objects.bulk_create(
+                (
+                    Notification(
+                        recipient=user,
+                        type=NotificationType.PURCHASE,
+                        message="bench",
+                        is_read=i % 2 == 0,
+                    )
+                    for user in users
+                    for i in range(options["per_user"])
+                ),
+                batch_size=1000,
+            )
+            poll_time = self.time_polls(users, options["polls"])
+            sent, push_time = async_to_sync(self.push)(users, options["notifications"])
+        finally:
+            # deleting the users takes their notifications
+            User.objects.filter(id__in=[user.id for user in users]).delete()
+
+        polls_per_second = len(users) * len(POLLED_VIEWS) / POLL_INTERVAL
+        per_push = push_time / sent
+        self.stdout.write(
+            f"polling: {len(users)} users x {len(POLLED_VIEWS)} counts every {POLL_INTERVAL}s "
+            f"= {polls_per_second:.1f} requests/s, {poll_time * 1000:.2f} ms each, "
+            f"{polls_per_second * poll_time * 1000:.0f} ms of server time per second"
+        )
+        self.stdout.write(
+            f"   push: {sent} notifications to {len(users)} sockets in {push_time:.2f}s, "
+            f"{per_push * 1000:.2f} ms each, no requests from connected clients"
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"connected clients save {polls_per_second:.1f} requests/s; pushing costs less "
+                f"than their polling below {polls_per_second * poll_time / per_push:.0f} "
+                "notifications/s"
+            )
+        )
+
+    def time_polls(self, users, count):
+        """
+        Returns the average seconds one unread count request takes, JWT authentication
+        included.
+        """
+        factory = APIRequestFactory()
+        tokens = {user.id: str(AccessToken.for_user(user)) for user in users}
+        requests = []
+        for i in range(count):
+            path, view = POLLED_VIEWS[i % len(POLLED_VIEWS)]
+            token = tokens[random.choice(users).id]
+            requests.append((view, factory.get(path, HTTP_AUTHORIZATION=f"Bearer {token}")))
+
+        started = time.perf_counter()
+        for view, request in requests:
+            response = view(request)
+            assert response.status_code == 200, response.data
+        return (time.perf_counter() - started) / count
+
+    async def push(self, users, count):
+        """
+        Connects a user socket per user, then saves count notifications for random users and
+        waits for every push to arrive. Returns the number of notifications pushed and the
+        elapsed seconds.
+        """
+        communicators = {}
+        for user in users:
+            communicator = WebsocketCommunicator(UserConsumer.as_asgi(), "/ws/user/")
+            communicator.scope["user"] = user
+            connected, _ = await communicator.connect()
+            assert connected
+            await communicator.receive_json_from()  # the unread counts
+            communicators[user.id] = communicator
+
+        recipients = [random.choice(users).id for _ in range(count)]
+        batch = [
+            {
+                "recipient_id": recipient_id,
+                "type": NotificationType.PURCHASE,
+                "message": "bench requested to buy your item",
+                "related_item": None,
+                "collapse_key": None,
+                "created_at": timezone.now(),
+            }
+            for recipient_id in recipients
+        ]
+
+        started = time.perf_counter()
+        await database_sync_to_async(deliver)(batch)
+        await asyncio.gather(
+            *(
+                communicators[recipient_id].receive_json_from(timeout=30)
+                for recipient_id in recipients
+            )
+        )
+        elapsed = time.perf_counter() - started
+
+        for communicator in communicators.values():
+            await communicator.disconnect()
+        return count, elapsed
@@ -0,0 +1,113 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from notifications import unread
+from notifications.models import Notification
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete notifications past the retention policy: read ones older than "
+        "NOTIFICATION_READ_RETENTION days and all of them older than NOTIFICATION_RETENTION "
+        "days. Deletes one primary key range at a time, so no statement holds its locks for "
+        "long, and reports the rows removed per second. Meant to run daily, e.g. from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Width of the primary key range deleted per statement (default: 1000)",
+        )
+        parser.add_argument(
+            "--read-days",
+            type=int,
+            default=settings.NOTIFICATION_READ_RETENTION,
+            help="Keep read notifications this many days "
+            f"(default: {settings.NOTIFICATION_READ_RETENTION})",
+        )
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=settings.NOTIFICATION_RETENTION,
+            help="Keep any notification this many days "
+            f"(default: {settings.NOTIFICATION_RETENTION})",
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=0,
+            help="Maximum deletions per second, 0 for no limit (default: 0)",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report what would be deleted",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        rate = options["rate"]
+        dry_run = options["dry_run"]
+        now = timezone.now()
+        read_cutoff = now - timedelta(days=options["read_days"])
+        cutoff = now - timedelta(days=options["days"])
+        expired = Q(created_at__lt=cutoff) | Q(is_read=True, created_at__lt=read_cutoff)
+
+        # the id range holding expired rows: created_at only moves forward (see
+        # notifications.fanout), so no row past the newest one older than a cutoff can expire
+        oldest = Notification.objects.order_by("id").values_list("id", flat=True).first()
+        newest = (
+            Notification.objects.filter(created_at__lt=max(read_cutoff, cutoff))
+            .order_by("-id")
+            .values_list("id", flat=True)
+            .first()
+        )
+        if oldest is None or newest is None:
+            self.stdout.write(self.style.SUCCESS("Nothing to prune."))
+            return
+
+        started = time.monotonic()
+        deleted = 0
+        for start in range(oldest, newest + 1, batch_size):
+            chunk = Notification.objects.filter(expired, id__gte=start, id__lt=start + batch_size)
+            if dry_run:
+                removed = chunk.count()
+            else:
+                with transaction.atomic():
+                    # unread rows take their users' cached counts with them
+                    recipients = set(
+                        chunk.filter(is_read=False).values_list("recipient_id", flat=True)
+                    )
+                    removed, _ = chunk.delete()
+                    for recipient_id in recipients:
+                        transaction.on_commit(lambda user_id=recipient_id: unread.forget(user_id))
+            if not removed:
+                continue
+            deleted += removed
+            elapsed = time.monotonic() - started
+            if rate:
+                # sleep off any deletions made ahead of the allowed rate
+                time.sleep(max(0, deleted / rate - elapsed))
+                elapsed = time.monotonic() - started
+            self.stdout.write(
+                f"ids {start}-{min(start + batch_size - 1, newest)} of {newest}: "
+                f"{'deletable' if dry_run else 'deleted'} {deleted} "
+                f"({deleted / elapsed if elapsed else 0:.0f}/s)"
+            )
+
+        elapsed = time.monotonic() - started
+        verb = "Would delete" if dry_run else "Deleted"
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{verb} {deleted} notifications in {elapsed:.1f}s "
+                f"({deleted / elapsed if elapsed else 0:.0f} rows/s)."
+            )
+        )
@@ -1,7 +1,12 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from django.utils import timezone
 
+from chat import events
+from . import unread
+
 
 class NotificationType(models.TextChoices):
     PURCHASE = "purchase", "Purchase Request"
@@ -21,13 +26,60 @@ class Notification(models.Model):
     related_item = models.CharField(
         max_length=100, null=True, blank=True
     )  # item that this notification is about
+    # notifications with the same key (e.g. the messages of a chat room) collapse into one
+    # row, count is how many it stands for (see notifications.fanout)
+    collapse_key = models.CharField(max_length=50, null=True, blank=True)
+    count = models.PositiveIntegerField(default=1)
 
     class Meta:
         ordering = ["-created_at"]
+        indexes = [
+            # the notification feed of a user, newest first (id breaks ties for the cursor)
+            models.Index(
+                fields=["recipient", "-created_at", "-id"], name="notification_feed_idx"
+            ),
+            # the same feed filtered by type
+            models.Index(
+                fields=["recipient", "type", "-created_at", "-id"],
+                name="notification_type_feed_idx",
+            ),
+            # the unread badge
+            models.Index(
+                fields=["recipient"],
+                condition=models.Q(is_read=False),
+                name="notification_unread_idx",
+            ),
+            # the unread row new notifications collapse into
+            models.Index(
+                fields=["recipient", "collapse_key"],
+                condition=models.Q(is_read=False, collapse_key__isnull=False),
+                name="notification_collapse_idx",
+            ),
+        ]
 
     def __str__(self):
         return f"{self.type} notification for {self.recipient.username}"
 
+    def push(self, unread_count):
+        """
+        Sends the notification to the recipient's socket (see chat.events), with their unread
+        count so the app never has to poll it. notifications.unread calls this once the
+        notification is committed.
+
+        Args:
+            unread_count (int): The recipient's unread notifications.
+        """
+        from .serializers import NotificationSerializer
+
+        events.send_to_user(
+            self.recipient_id,
+            {
+                "type": "notification",
+                "notification": NotificationSerializer(self).data,
+                "unread_count": unread_count,
+            },
+        )
+
     @property
     def time_display(self):
         """
@@ -54,3 +106,10 @@ class Notification(models.Model):
             return f"{minutes}m ago"
         else:
             return "Just now"
+
+
+# bulk_create() callers count and push their notifications themselves (see notifications.fanout)
+@receiver(post_save, sender=Notification)
+def count_notification(sender, instance, created, **kwargs):
+    if created:
+        unread.adjust(instance.recipient_id, 0 if instance.is_read else 1, [instance])
@@ -8,4 +8,13 @@ class NotificationSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Notification
-        fields = ["id", "type", "message", "time", "is_read", "related_item"]
+        fields = [
+            "id",
+            "type",
+            "message",
+            "time",
+            "created_at",
+            "is_read",
+            "related_item",
+            "count",
+        ]
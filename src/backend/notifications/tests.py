@@ -1,7 +1,20 @@
 from django.test import TestCase
 from django.contrib.auth.models import User
 from django.utils import timezone
-from datetime import timedelta
+from datetime import timedelta, timezone as dt_timezone
+from urllib.parse import quote
+from django.test import override_settings
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from rest_framework.test import APITestCase
+from django.core.cache import cache
+from django.core.management import call_command
+from io import StringIO
+from chat.models import ChatRoom, Message
+from unittest import mock
+from django.db import DatabaseError
+from . import fanout, unread
+from .fanout import chat_key, chat_text, deliver
 from .models import Notification, NotificationType
 from .serializers import NotificationSerializer
 
@@ -49,3 +62,346 @@ class NotificationModelTests(TestCase):
         self.notification.created_at = timezone.now() - timedelta(minutes=1)
         self.notification.save()
         self.assertEqual(self.notification.time_display, "1m ago")
+
+
+@override_settings(NOTIFICATION_WORKER=False)
+class NotificationFanoutTests(TestCase):
+    """Tests for saving notifications after commit, collapsing the chat ones"""
+
+    def setUp(self):
+        self.seller = User.objects.create_user(username="seller", password="testpass")
+        self.buyer = User.objects.create_user(username="buyer", password="testpass")
+        self.room = ChatRoom.objects.create(user1=self.buyer, user2=self.seller, item_id=1)
+
+    def send(self, count):
+        for i in range(count):
+            Message.objects.create(
+                room=self.room, sender=self.buyer, receiver=self.seller, content=str(i)
+            )
+
+    def test_saved_only_after_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.send(1)
+        self.assertFalse(Notification.objects.exists())
+        for callback in callbacks:
+            callback()
+        self.assertEqual(Notification.objects.get().message, chat_text("buyer", 1))
+
+    def test_chat_burst_collapses_into_one_row(self):
+        for _ in range(4):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.send(5)
+        notification = Notification.objects.get(recipient=self.seller)
+        self.assertEqual(notification.count, 20)
+        self.assertEqual(notification.message, "buyer sent 20 messages about an item you posted")
+        self.assertEqual(NotificationSerializer(notification).data["count"], 20)
+
+    def test_read_or_old_rows_are_not_reused(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.send(2)
+        Notification.objects.update(is_read=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.send(1)
+        Notification.objects.filter(is_read=False).update(
+            created_at=timezone.now() - timedelta(hours=1)
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.send(1)
+        counts = list(Notification.objects.order_by("id").values_list("count", flat=True))
+        self.assertEqual(counts, [2, 1, 1])
+
+    def test_batch_is_saved_with_bulk_queries(self):
+        other_room = ChatRoom.objects.create(user1=self.buyer, user2=self.seller, item_id=2)
+        batch = [
+            {
+                "recipient_id": self.seller.id,
+                "type": NotificationType.CHAT,
+                "message": chat_text("buyer", 1),
+                "related_item": None,
+                "collapse_key": chat_key(room.id),
+                "sender_name": "buyer",
+                "created_at": timezone.now(),
+            }
+            for room in [self.room] * 10 + [other_room] * 5
+        ]
+        batch += [
+            {
+                "recipient_id": self.seller.id,
+                "type": NotificationType.PURCHASE,
+                "message": f"buyer{i} requested to buy your item 'Lamp'",
+                "related_item": "Lamp",
+                "collapse_key": None,
+                "created_at": timezone.now(),
+            }
+            for i in range(3)
+        ]
+        # a SELECT for the rows to collapse into and one INSERT, plus the savepoint
+        with self.assertNumQueries(4):
+            saved = deliver(batch)
+        self.assertEqual(sorted(n.count for n in saved), [1, 1, 1, 5, 10])
+        with self.assertNumQueries(4):  # one UPDATE instead of the INSERT this time
+            deliver(batch[:15])
+        self.assertEqual(
+            sorted(Notification.objects.values_list("count", flat=True)), [1, 1, 1, 10, 20]
+        )
+
+    def test_failed_batch_is_retried(self):
+        calls = []
+
+        def flaky(batch):
+            calls.append(len(batch))
+            if len(calls) == 1:
+                raise DatabaseError("gone away")
+            return deliver(batch)
+
+        with mock.patch("notifications.fanout.deliver", side_effect=flaky), mock.patch(
+            "notifications.fanout.time.sleep"
+        ) as sleep:
+            with self.assertLogs("notifications.fanout"):
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.send(3)
+        self.assertEqual(calls[:2], [1, 1])  # the first one again
+        sleep.assert_not_called()  # inline retries don't hold up the request
+        self.assertEqual(Notification.objects.get().count, 3)
+
+    @override_settings(NOTIFICATION_RETRIES=2)
+    def test_batch_is_dropped_after_the_retries(self):
+        with mock.patch("notifications.fanout.deliver", side_effect=DatabaseError) as failing:
+            with self.assertLogs("notifications.fanout") as logs:
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.send(1)
+        self.assertEqual(failing.call_count, 3)
+        self.assertIn("after 3 attempts", logs.output[-1])
+        self.assertEqual(fanout._pending, [])
+
+    @override_settings(NOTIFICATION_RETRIES=2, NOTIFICATION_RETRY_BACKOFF=1)
+    def test_worker_backs_off_between_retries(self):
+        with override_settings(NOTIFICATION_WORKER=True):
+            with mock.patch("notifications.fanout.get_executor"):  # drained below instead
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.send(1)
+        with mock.patch("notifications.fanout.deliver", side_effect=DatabaseError), mock.patch(
+            "notifications.fanout.time.sleep"
+        ) as sleep:
+            with self.assertLogs("notifications.fanout"):
+                fanout.drain()
+        self.assertEqual(sleep.call_args_list, [mock.call(1), mock.call(2)])
+
+
+class NotificationPushTests(APITestCase):
+    """Tests for pushing unread counts to the user's socket"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser", password="testpass")
+        self.client.force_authenticate(user=self.user)
+        self.layer = get_channel_layer()
+        self.channel = async_to_sync(self.layer.new_channel)()
+        async_to_sync(self.layer.group_add)(f"user_{self.user.id}", self.channel)
+
+    def test_new_notifications_carry_the_unread_count(self):
+        for i in range(2):
+            with self.captureOnCommitCallbacks(execute=True):
+                Notification.objects.create(
+                    recipient=self.user, type=NotificationType.PURCHASE, message=str(i)
+                )
+        counts = [async_to_sync(self.layer.receive)(self.channel)["unread_count"] for _ in "ab"]
+        self.assertEqual(counts, [1, 2])
+
+    def test_reset_clears_the_badge_of_every_device(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post("/api/notifications/reset_unread_count/")
+        event = async_to_sync(self.layer.receive)(self.channel)
+        self.assertEqual(event, {"type": "notification_count", "unread_count": 0})
+
+
+class UnreadCountTests(APITestCase):
+    """Tests for the cached unread notification count"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser", password="testpass")
+        self.client.force_authenticate(user=self.user)
+        self.notifications = [self.create() for _ in range(3)]
+
+    def create(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Notification.objects.create(
+                recipient=self.user, type=NotificationType.PURCHASE, message="hi"
+            )
+
+    def unread_count(self):
+        return self.client.get("/api/notifications/unread_count/").data["unread_count"]
+
+    def test_count_is_a_cache_hit(self):
+        self.assertEqual(self.unread_count(), 3)  # counted once
+        self.create()
+        with self.assertNumQueries(0):  # the user is authenticated without a query here
+            self.assertEqual(self.unread_count(), 4)
+
+    def test_mark_as_read_takes_off_the_rows_it_changed(self):
+        self.assertEqual(self.unread_count(), 3)
+        ids = [n.id for n in self.notifications[:2]]
+        for _ in range(2):  # the second time nothing changes
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(
+                    "/api/notifications/mark_as_read/", {"notification_ids": ids}, format="json"
+                )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self.unread_count(), 1)
+
+    def test_reset_and_rebuild(self):
+        self.assertEqual(self.unread_count(), 3)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post("/api/notifications/reset_unread_count/")
+        self.assertEqual(self.unread_count(), 0)
+        self.create()
+        cache.clear()
+        self.assertEqual(self.unread_count(), 1)
+
+    def test_reset_keeps_a_notification_created_meanwhile(self):
+        self.assertEqual(self.unread_count(), 3)
+        with self.captureOnCommitCallbacks() as reset_callbacks:
+            self.client.post("/api/notifications/reset_unread_count/")
+        self.create()  # committed after the UPDATE, before the reset's commit hook
+        for callback in reset_callbacks:
+            callback()
+        self.assertEqual(self.unread_count(), 1)
+
+    def test_count_is_not_cached_when_a_delta_raced_it(self):
+        cache.clear()
+        count_rows, raced = unread.count_rows, []
+
+        def racing_count(user_id):
+            rows = count_rows(user_id)
+            if not raced:  # a notification committed while the rows were counted
+                raced.append(True)
+                self.create()
+            return rows
+
+        with mock.patch("notifications.unread.count_rows", side_effect=racing_count):
+            self.assertEqual(unread.count(self.user.id), 3)
+        self.assertIsNone(cache.get(unread.count_key(self.user.id)))
+        self.assertEqual(self.unread_count(), 4)
+
+
+class PruneNotificationsTests(TestCase):
+    """Tests for the prune_notifications retention command"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="testuser", password="testpass")
+        now = timezone.now()
+        self.kept = [
+            self.create(now - timedelta(days=10), is_read=True),
+            self.create(now - timedelta(days=60), is_read=False),
+            self.create(now, is_read=False),
+        ]
+        self.expired = [
+            self.create(now - timedelta(days=40), is_read=True),
+            self.create(now - timedelta(days=200), is_read=False),
+        ]
+
+    def create(self, created_at, is_read):
+        return Notification.objects.create(
+            recipient=self.user,
+            type=NotificationType.PURCHASE,
+            message="hi",
+            created_at=created_at,
+            is_read=is_read,
+        )
+
+    def prune(self, *args):
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("prune_notifications", "--batch-size", "2", *args, stdout=out)
+        return out.getvalue()
+
+    def test_deletes_past_the_retention_policy(self):
+        self.assertEqual(unread.count(self.user.id), 3)
+        out = self.prune()
+        self.assertIn("Deleted 2 notifications", out)
+        self.assertEqual(
+            set(Notification.objects.values_list("id", flat=True)), {n.id for n in self.kept}
+        )
+        # an unread row went, so the cached count is rebuilt
+        self.assertEqual(unread.count(self.user.id), 2)
+
+    def test_dry_run_deletes_nothing(self):
+        out = self.prune("--dry-run")
+        self.assertIn("Would delete 2 notifications", out)
+        self.assertEqual(Notification.objects.count(), 5)
+
+
+class NotificationFeedTests(APITestCase):
+    """Tests for the keyset-paginated notification feed"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="testpass")
+        self.client.force_authenticate(user=self.user)
+        now = timezone.now()
+        # every other one a chat notification, the even ones read, all at the same time so
+        # the cursor has to break ties on id
+        Notification.objects.bulk_create(
+            Notification(
+                recipient=self.user,
+                type=NotificationType.CHAT if i % 2 else NotificationType.PURCHASE,
+                message=str(i),
+                created_at=now - timedelta(minutes=i // 10),
+                is_read=i % 2 == 0,
+            )
+            for i in range(50)
+        )
+        self.ids = list(
+            Notification.objects.order_by("-created_at", "-id").values_list("id", flat=True)
+        )
+
+    def feed(self, url="/api/notifications/", **params):
+        ids, pages = [], 0
+        while url:
+            response = self.client.get(url, params if pages == 0 else None)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn("count", response.data)  # no COUNT(*) per page
+            ids += [notification["id"] for notification in response.data["results"]]
+            url, pages = response.data["next"], pages + 1
+        return ids, pages
+
+    def test_pages_follow_created_at_then_id(self):
+        ids, pages = self.feed()
+        self.assertEqual(ids, self.ids)
+        self.assertEqual(pages, 3)
+
+    def test_type_and_unread_filters(self):
+        chat = list(
+            Notification.objects.filter(type=NotificationType.CHAT)
+            .order_by("-created_at", "-id")
+            .values_list("id", flat=True)
+        )
+        self.assertEqual(self.feed(type="chat")[0], chat)
+        self.assertEqual(self.feed(type="all", unread_only="true")[0], chat)  # the odd ones
+        self.assertEqual(self.feed(type="purchase", unread_only="true")[0], [])
+
+    def test_since_returns_only_newer_ones(self):
+        newest = Notification.objects.get(id=self.ids[10])  # the second minute
+        response = self.client.get(
+            "/api/notifications/", {"since": newest.created_at.isoformat()}
+        )
+        self.assertEqual([n["id"] for n in response.data["results"]], self.ids[:10])
+
+        response = self.client.get("/api/notifications/", {"since": "yesterday"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_since_accepts_offsets_z_and_epoch_seconds(self):
+        since = Notification.objects.get(id=self.ids[10]).created_at
+        offset = since.astimezone(dt_timezone(timedelta(hours=2))).isoformat()
+        forms = [
+            # an unencoded "+" in the query string, which arrives as a space
+            f"/api/notifications/?since={offset}",
+            f"/api/notifications/?since={quote(offset)}",
+            f"/api/notifications/?since={since.isoformat().replace('+00:00', 'Z')}",
+            f"/api/notifications/?since={since.timestamp()}",
+        ]
+        for url in forms:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            self.assertEqual([n["id"] for n in response.data["results"]], self.ids[:10], url)
@@ -0,0 +1,90 @@
+# unread.py - Cached unread notification counts
+# The unread badge of every user is kept in the cache and moved by deltas as notifications are
+# created and read, so reading it is a cache hit instead of a COUNT. A missing count (evicted,
+# expired or never read) is counted from the table on the next count() call.
+# Every committed change is pushed to the user's socket with the new count (see chat.events).
+
+from django.core.cache import cache
+from django.db import transaction
+
+from chat import events
+
+# counts are rebuilt from the table at least this often, in case the cache missed a delta
+COUNT_TIMEOUT = 24 * 60 * 60
+REBUILD_TIMEOUT = 60  # seconds a recount may take
+
+
+def count_key(user_id):
+    return f"notifications:unread:{user_id}"
+
+
+def rebuild_key(user_id):
+    # deltas that arrived while count() was counting
+    return f"notifications:unread:{user_id}:rebuild"
+
+
+def count(user_id):
+    """
+    Returns the number of unread notifications of the user.
+    """
+    unread_count = cache.get(count_key(user_id))
+    if unread_count is None:
+        # cached only if no delta came in while counting, as the count may or may not
+        # include it (see chat.unread.total)
+        cache.set(rebuild_key(user_id), 0, REBUILD_TIMEOUT)
+        unread_count = count_rows(user_id)
+        if cache.get(rebuild_key(user_id)) == 0:
+            cache.add(count_key(user_id), unread_count, COUNT_TIMEOUT)
+        cache.delete(rebuild_key(user_id))
+    return unread_count
+
+
+def count_rows(user_id):
+    from .models import Notification
+
+    return Notification.objects.filter(recipient_id=user_id, is_read=False).count()
+
+
+def adjust(user_id, delta, notifications=()):
+    """
+    Adds delta to the user's cached count once the transaction commits, then pushes the
+    notifications given, or the count alone, to their socket.
+
+    Args:
+        user_id (int): The id of the user.
+        delta (int): How many notifications became unread (negative when read).
+        notifications (list[Notification]): New or updated notifications of the user.
+    """
+
+    def committed():
+        try:
+            unread_count = cache.incr(count_key(user_id), delta)
+        except ValueError:
+            # not cached, counted without caching it as other deltas of the transaction may
+            # still be on their way, and a count() counting right now is told not to cache
+            try:
+                cache.incr(rebuild_key(user_id), 1)
+            except ValueError:
+                pass
+            unread_count = count_rows(user_id)
+        else:
+            if unread_count < 0:
+                forget(user_id)
+                unread_count = count_rows(user_id)
+        push(user_id, unread_count, notifications)
+
+    transaction.on_commit(committed)
+
+
+def forget(user_id):
+    """
+    Drops the cached count of a user, e.g. after their notifications were edited or deleted.
+    """
+    cache.delete(count_key(user_id))
+
+
+def push(user_id, unread_count, notifications=()):
+    for notification in notifications:
+        notification.push(unread_count)
+    if not notifications:
+        events.send_to_user(user_id, {"type": "notification_count", "unread_count": unread_count})
@@ -1,24 +1,84 @@
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
+import re
+from datetime import datetime, timezone as dt_timezone
+from django.utils.dateparse import parse_datetime
+from django.utils import timezone
 from .models import Notification, NotificationType
 from .serializers import NotificationSerializer
 from django.db.models import Q
+from items.pagination import HttpsCursorPagination
+from . import unread
+
+
+def parse_since(value):
+    """
+    Parses the since parameter: an ISO 8601 time ("Z" or an offset), or Unix epoch seconds.
+
+    Returns:
+        datetime: The aware time, or None if the value is neither.
+    """
+    try:
+        return datetime.fromtimestamp(float(value), tz=dt_timezone.utc)
+    except (ValueError, OverflowError, OSError):
+        pass
+    # an unencoded "+hh:mm" offset arrives with its "+" decoded to a space
+    value = re.sub(r" (\d{2}:?\d{2})$", r"+\1", value)
+    try:
+        since = parse_datetime(value)
+    except ValueError:
+        return None
+    if since is not None and timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    return since
+
+
+class NotificationCursorPagination(HttpsCursorPagination):
+    """
+    The notification feed, newest first on (-created_at, -id), which the feed indexes of
+    Notification cover with or without a type.
+    """
+
+    page_size = 20
 
 
 class NotificationViewSet(viewsets.ModelViewSet):
     serializer_class = NotificationSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = NotificationCursorPagination
+    # no ?ordering=, the feed is only ever read in index order
+    filter_backends = []
 
     def get_queryset(self):
+        """
+        The user's notifications, filtered by the query parameters:
+            type         "purchase" or "chat" ("all" or none for both)
+            unread_only  "true" for the unread ones only
+            since        an ISO 8601 time or epoch seconds, for the ones created (or
+                         collapsed into, see notifications.fanout) after it, e.g. the
+                         created_at of the newest notification the app has
+        """
         user = self.request.user
         notification_type = self.request.query_params.get("type", None)
+        unread_only = self.request.query_params.get("unread_only", "").lower() == "true"
+        since = self.request.query_params.get("since")
 
         queryset = Notification.objects.filter(recipient=user)
 
         # for the all condition we have on the frontend
         if notification_type and notification_type != "all":
             queryset = queryset.filter(type=notification_type)
+        if unread_only:
+            queryset = queryset.filter(is_read=False)
+        if since:
+            since_time = parse_since(since)
+            if since_time is None:
+                raise ValidationError(
+                    {"error": "since is not an ISO 8601 time or epoch seconds"}
+                )
+            queryset = queryset.filter(created_at__gt=since_time)
         return queryset
 
     @action(detail=False, methods=["post"])
@@ -33,25 +93,38 @@ class NotificationViewSet(viewsets.ModelViewSet):
             )
 
         notifications = Notification.objects.filter(
-            id__in=notification_ids, recipient=request.user
+            id__in=notification_ids, recipient=request.user, is_read=False
         )
-        notifications.update(is_read=True)
+        # the cached count goes down by exactly the rows that were unread
+        changed = notifications.update(is_read=True)
+        if changed:
+            unread.adjust(request.user.id, -changed)
         return Response({"status": "notification marked as read"})
 
     @action(detail=False, methods=["get"])
     def unread_count(self, request):
-        count = Notification.objects.filter(
-            recipient=request.user, is_read=False
-        ).count()
-        return Response({"unread_count": count})
+        # a cache read, kept up to date as notifications are created and read
+        return Response({"unread_count": unread.count(request.user.id)})
 
     @action(detail=False, methods=["post"])
     def reset_unread_count(self, request):
-        Notification.objects.filter(recipient=request.user, is_read=False).update(
+        changed = Notification.objects.filter(recipient=request.user, is_read=False).update(
             is_read=True
         )
+        # down by the rows read, not to 0: one created meanwhile still counts; the new
+        # count is pushed to the user's other devices too
+        unread.adjust(request.user.id, -changed)
         return Response({"status": "reset unread count"})
 
+    # notifications edited or deleted one at a time get counted again on the next read
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        unread.forget(self.request.user.id)
+
+    def perform_destroy(self, instance):
+        super().perform_destroy(instance)
+        unread.forget(self.request.user.id)
+
 
 # notification utility functions OUTSIDE the class
 
@@ -0,0 +1,176 @@
+# mailer.py - Sending mail off the request path
+# Sending an OTP used to open an SMTP connection in the request thread and wait 1-3 seconds
+# for the server, so sign-ups piled up behind each other at the start of a semester.
+# queue_mail() only queues the message once the transaction commits and returns. A single
+# worker thread sends everything that queued up over one SMTP connection, kept open until
+# the queue is empty. A message that fails is retried on a fresh connection (the old one may
+# be the problem) with exponential backoff, after the rest of the queue, so one bad message
+# doesn't hold back the OTPs behind it, and given up on after EMAIL_RETRIES retries. The
+# connection is closed while waiting for a retry, so it doesn't sit idle until the server
+# drops it. Whatever is still queued when the process exits is sent before it does.
+#
+# With settings.EMAIL_WORKER off messages are sent right away in the committing thread
+# instead, and failed ones retried without any backoff, which is what the tests use (with
+# the locmem backend, see django.core.mail.outbox).
+
+import atexit
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_pending = []  # messages committed but not sent yet
+_lock = threading.Lock()
+_wakeup = threading.Event()  # set when a message is queued, ends the wait for a retry
+
+
+def get_executor():
+    """
+    Returns the process-wide sender, created on first use. A single thread, so there is
+    only ever one SMTP connection open.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mailer")
+    return _executor
+
+
+def queue_mail(subject, message, recipient_list, from_email=None):
+    """
+    Queues a plain text email, to be sent once the current transaction commits.
+
+    Args:
+        subject (str): The subject line.
+        message (str): The body.
+        recipient_list (list[str]): The addresses to send it to.
+        from_email (str): The sender, settings.DEFAULT_FROM_EMAIL if None.
+    """
+    email = EmailMessage(subject, message, from_email, recipient_list)
+
+    def enqueue():
+        with _lock:
+            _pending.append(email)
+            first = len(_pending) == 1  # otherwise the sender will pick it up
+        _wakeup.set()
+        if not settings.EMAIL_WORKER:
+            send_pending(backoff=False)  # don't keep the committing request waiting
+        elif first:
+            get_executor().submit(run_in_worker)
+
+    transaction.on_commit(enqueue)
+
+
+def run_in_worker():
+    """
+    Worker entry point. Errors are logged instead of being lost in the future.
+    """
+    try:
+        send_pending()
+    except Exception:
+        logger.exception("Could not send mail")
+
+
+def take_pending():
+    global _pending
+    with _lock:
+        batch, _pending = _pending, []
+    return batch
+
+
+def send_pending(retry=True, backoff=True):
+    """
+    Sends the queued messages, and the ones queued while sending, over one connection.
+    Failed messages are retried once their backoff is over, in between new ones.
+
+    Args:
+        retry (bool): False to give up on failed messages right away, e.g. on exit.
+        backoff (bool): False to retry failed messages without waiting.
+
+    Returns:
+        int: The number of messages sent.
+    """
+    sent = 0
+    connection = None
+    deferred = []  # (when to retry, message) of the messages that failed
+    try:
+        while True:
+            _wakeup.clear()
+            now = time.monotonic()
+            due = [email for when, email in deferred if when <= now]
+            deferred = [(when, email) for when, email in deferred if when > now]
+            batch = take_pending() + due
+            if not batch:
+                if not deferred:
+                    return sent
+                # nothing else to send: wait for the next retry, or for new mail, without
+                # holding the connection open (the retry reconnects anyway)
+                if connection is not None:
+                    close_quietly(connection)
+                    connection = None
+                _wakeup.wait(min(when for when, _ in deferred) - now)
+                continue
+            for email in batch:
+                connection, ok = send(connection, email)
+                if ok:
+                    sent += 1
+                    continue
+                email.attempts = getattr(email, "attempts", 0) + 1
+                if not retry or email.attempts > settings.EMAIL_RETRIES:
+                    logger.error(
+                        "Giving up on %r to %s after %s attempts",
+                        email.subject,
+                        email.to,
+                        email.attempts,
+                    )
+                else:
+                    delay = settings.EMAIL_RETRY_BACKOFF * 2 ** (email.attempts - 1)
+                    deferred.append((time.monotonic() + (delay if backoff else 0), email))
+    finally:
+        if connection is not None:
+            close_quietly(connection)
+
+
+def send(connection, email):
+    """
+    Makes one attempt at sending a message.
+
+    Args:
+        connection: An open email backend, or None to open one.
+        email (EmailMessage): The message.
+
+    Returns:
+        tuple: The connection to send the next message with (None if it had to be closed)
+            and whether the message was sent.
+    """
+    try:
+        if connection is None:
+            # opened here so the backend doesn't close it after every message
+            connection = get_connection()
+            connection.open()
+        email.connection = connection
+        email.send()
+        return connection, True
+    except Exception:
+        logger.warning("Sending %r failed", email.subject, exc_info=True)
+        # reconnect for the next message, in case the server dropped the connection
+        if connection is not None:
+            close_quietly(connection)
+        return None, False
+
+
+def close_quietly(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+# send what is still queued when the process exits (the sender thread is joined first)
+atexit.register(send_pending, retry=False)
@@ -1,9 +1,15 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+from rest_framework.test import APITestCase
+from unittest.mock import patch
 from .models import OTP
 from django.db import models
 from datetime import datetime, timedelta, timezone
 from django.contrib.auth.models import User
 from .serializers import EmailSerializer, OTPVerificationSerializer, TokenSerializer
+from . import mailer
+from .mailer import queue_mail, send_pending
 
 
 class OTPAuthTestCase(TestCase):
@@ -27,3 +33,114 @@ class OTPAuthSerializerTestCase(TestCase):
         self.assertEqual(
             self.serial1.data, {"email": "grain@grin.edu", "otp": "566723"}
         )
+
+
+class FlakyBackend(EmailBackend):
+    """The locmem backend, failing the first `failures` sends and counting connections"""
+
+    failures = 0
+    opened = 0
+    closed = 0
+
+    def open(self):
+        FlakyBackend.opened += 1
+
+    def close(self):
+        FlakyBackend.closed += 1
+
+    def send_messages(self, messages):
+        if FlakyBackend.failures:
+            FlakyBackend.failures -= 1
+            raise ConnectionError("connection dropped")
+        return super().send_messages(messages)
+
+
+@override_settings(
+    EMAIL_WORKER=False,
+    EMAIL_BACKEND="otpauth.tests.FlakyBackend",
+    EMAIL_RETRIES=2,
+    EMAIL_RETRY_BACKOFF=0,
+)
+class MailerTestCase(APITestCase):
+    def setUp(self):
+        FlakyBackend.failures = 0
+        FlakyBackend.opened = 0
+        FlakyBackend.closed = 0
+
+    def test_otp_is_sent_after_the_response(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post("/otpauth/request-otp/", {"email": "grain@grin.edu"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(mail.outbox), 0)  # queued, not sent by the request
+        for callback in callbacks:
+            callback()
+        self.assertEqual(len(mail.outbox), 1)
+        otp = OTP.objects.get(email="grain@grin.edu")
+        self.assertIn(otp.otp, mail.outbox[0].body)
+        self.assertEqual(mail.outbox[0].to, ["grain@grin.edu"])
+
+    def queue(self, count):
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(count):
+                queue_mail(f"subject {i}", "body", [f"user{i}@grin.edu"])
+
+    def test_one_connection_for_the_queue(self):
+        # the worker doesn't run, so the messages wait for it like behind a slow send
+        with override_settings(EMAIL_WORKER=True), patch("otpauth.mailer.get_executor"):
+            self.queue(5)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(send_pending(), 5)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(FlakyBackend.opened, 1)
+
+    def test_failed_send_is_retried_on_a_new_connection(self):
+        FlakyBackend.failures = 1
+        with self.assertLogs("otpauth.mailer", "WARNING"):
+            self.queue(1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(FlakyBackend.opened, 2)
+
+    def test_failed_message_is_retried_after_the_rest_of_the_queue(self):
+        with override_settings(EMAIL_WORKER=True), patch("otpauth.mailer.get_executor"):
+            self.queue(3)
+        FlakyBackend.failures = 1
+        with self.assertLogs("otpauth.mailer", "WARNING"):
+            self.assertEqual(send_pending(), 3)
+        self.assertEqual(
+            [email.subject for email in mail.outbox], ["subject 1", "subject 2", "subject 0"]
+        )
+
+    @override_settings(EMAIL_RETRY_BACKOFF=0.05)
+    def test_connection_is_closed_while_waiting_for_a_retry(self):
+        with override_settings(EMAIL_WORKER=True), patch("otpauth.mailer.get_executor"):
+            self.queue(2)
+        open_while_waiting = []
+        wait = mailer._wakeup.wait
+
+        def record(timeout):
+            open_while_waiting.append(FlakyBackend.opened - FlakyBackend.closed)
+            return wait(timeout)
+
+        FlakyBackend.failures = 1
+        with patch.object(mailer._wakeup, "wait", side_effect=record):
+            with self.assertLogs("otpauth.mailer", "WARNING"):
+                self.assertEqual(send_pending(), 2)
+        self.assertTrue(open_while_waiting)
+        self.assertEqual(set(open_while_waiting), {0})
+        self.assertEqual(FlakyBackend.opened, FlakyBackend.closed)
+
+    @override_settings(EMAIL_RETRY_BACKOFF=60)
+    def test_inline_retry_does_not_wait(self):
+        FlakyBackend.failures = 1
+        waited = AssertionError("waited for the backoff")
+        with patch.object(mailer._wakeup, "wait", side_effect=waited):
+            with self.assertLogs("otpauth.mailer", "WARNING"):
+                self.queue(1)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_message_is_dropped_after_the_retries(self):
+        FlakyBackend.failures = 3  # the first attempt and both retries
+        with self.assertLogs("otpauth.mailer", "ERROR"):
+            self.queue(2)
+        # the second message still goes out
+        self.assertEqual([email.subject for email in mail.outbox], ["subject 1"])
@@ -8,7 +8,6 @@ from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.views import (
     TokenRefreshView,
 )  # built in view from rest framework simple jwt
-from django.core.mail import send_mail
 from django.conf import settings
 import os
 from dotenv import load_dotenv
@@ -19,6 +18,7 @@ from rest_framework.permissions import IsAuthenticated
 # from userprofile.models import UserProfile #TODO: uncomment when we make the userprofile api
 # from userprofile.serializers import UserSerializer #TODO: same as above
 from .models import OTP
+from .mailer import queue_mail
 from .serializers import (
     ContactFormSerializer,
     EmailSerializer,
@@ -44,12 +44,10 @@ class RequestOTPView(APIView):
             OTP.objects.filter(email=email).delete()
             otp = OTP.objects.create(email=email)
             # print(f"\n\n{otp.otp}\n\n")  # TODO: comment this to send email
-            # Send email with OTP
+            # Send email with OTP, in the background so the response doesn't wait for SMTP
             subject = "Your OTP for authentication"
             message = f"Your OTP is {otp.otp}. It will expire in 10 minutes."
-            send_mail(
-                subject, message, settings.DEFAULT_FROM_EMAIL, [email]
-            )  # TODO: uncomment this to send email
+            queue_mail(subject, message, [email], settings.DEFAULT_FROM_EMAIL)
 
             return Response(
                 {"detail": "OTP sent to your email"}, status=status.HTTP_200_OK
@@ -120,22 +118,11 @@ class ContactFormView(APIView):
             subject = "New contact form from PioneerMart"
             message = f"Message from PioneerMart contact form:\n\nUser: {user_email}\n\n{description}"
             recipient_email = os.getenv("EMAIL_HOST_USER")
-            try:
-                send_mail(
-                    subject,
-                    message,
-                    settings.DEFAULT_FROM_EMAIL,
-                    [os.getenv("EMAIL_HOST_USER")],
-                    fail_silently=False,
-                )
-                return Response(
-                    {"detail": "Your message has been sent successfully"},
-                    status=status.HTTP_200_OK,
-                )
-            except Exception as e:
-                return Response(
-                    {"detail": "Failed to send message. Please try again later."},
-                    status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                )
+            # sent in the background and retried there (see otpauth.mailer)
+            queue_mail(subject, message, [recipient_email], settings.DEFAULT_FROM_EMAIL)
+            return Response(
+                {"detail": "Your message has been sent successfully"},
+                status=status.HTTP_200_OK,
+            )
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.20 on 2026-10-17 17:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('purchase_requests', '0005_alter_purchaserequest_options_purchaserequest_seller'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='purchaserequest',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['listing'], name='purchase_req_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='purchaserequest',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['requester', 'listing'], name='purchase_req_requester_idx'),
+        ),
+    ]
@@ -3,11 +3,37 @@
 # It prevents duplicate requests and tracks when the request was made and whether it is still active.
 
 # Import Modules
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Q, UniqueConstraint
-from notifications.models import Notification, NotificationType
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from notifications import fanout
+from notifications.models import NotificationType
 from items.models import Listing
 from django.contrib.auth.models import User
+from collections import Counter
+
+
+class PurchaseRequestQuerySet(models.QuerySet):
+    def deactivate(self, **fields):
+        """
+        Bulk-deactivates the purchase requests, optionally setting other fields (like status),
+        and takes the ones that were active off their listing's active_request_count.
+
+        Returns:
+            int: The number of updated purchase requests.
+        """
+        with transaction.atomic():
+            # lock the active rows so they can't change between counting and updating
+            active = list(
+                self.filter(is_active=True)
+                .select_for_update()
+                .values_list("listing_id", flat=True)
+            )
+            updated = self.update(is_active=False, **fields)
+            for listing_id, count in Counter(active).items():
+                Listing.adjust_counter(listing_id, "active_request_count", -count)
+        return updated
 
 
 class PurchaseRequest(models.Model):
@@ -48,18 +74,36 @@ class PurchaseRequest(models.Model):
     is_active = models.BooleanField(default=True)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="pending")
 
+    objects = PurchaseRequestQuerySet.as_manager()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remember the stored value so save() knows whether the listing's count has to change
+        instance._stored_is_active = instance.__dict__.get("is_active")
+        return instance
+
     def save(self, *args, **kwargs):
         is_new = self.pk is None
         if not self.seller:
             self.seller = self.listing.seller
-        super().save(*args, **kwargs)
+        was_active = False if is_new else getattr(self, "_stored_is_active", None)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if was_active is not None and was_active != self.is_active:
+                Listing.adjust_counter(
+                    self.listing_id, "active_request_count", 1 if self.is_active else -1
+                )
+                # keep the listing object we hold in step with the database
+                self.listing.refresh_from_db(fields=["active_request_count"])
+        self._stored_is_active = self.is_active
 
-        # create a notification for the purchase request
+        # create a notification for the purchase request, once it is committed
         if is_new:
-            Notification.objects.create(
-                recipient=self.listing.seller,
-                type=NotificationType.PURCHASE,
-                message=f"{self.requester.username} requested to buy your item '{self.listing.title}'",
+            fanout.notify(
+                self.listing.seller_id,
+                NotificationType.PURCHASE,
+                f"{self.requester.username} requested to buy your item '{self.listing.title}'",
                 related_item=self.listing.title,
             )
 
@@ -77,9 +121,32 @@ class PurchaseRequest(models.Model):
             )
         ]
         ordering = ["-created_at"]  # get the newest purchase request first
+        # only active requests are counted and checked for duplicates, so only those are indexed
+        indexes = [
+            models.Index(
+                fields=["listing"],
+                condition=Q(is_active=True),
+                name="purchase_req_active_idx",
+            ),
+            models.Index(
+                fields=["requester", "listing"],
+                condition=Q(is_active=True),
+                name="purchase_req_requester_idx",
+            ),
+        ]
 
     def __str__(self):
         """
         Returns a readable string representation of the purchase request.
         """
         return f"Request for {self.listing.title} by {self.requester.username}"
+
+
+@receiver(post_delete, sender=PurchaseRequest)
+def discount_deleted_request(sender, instance, **kwargs):
+    """
+    Takes a deleted active request off its listing's count. Does nothing when the listing
+    itself is being deleted, as the update then matches no row.
+    """
+    if instance.is_active:
+        Listing.adjust_counter(instance.listing_id, "active_request_count", -1)
@@ -137,7 +137,7 @@ class PurchaseRequestViewSet(viewsets.ModelViewSet):
         # deactivate all other purchase requests for this listing
         PurchaseRequest.objects.filter(listing=listing).exclude(
             id=purchase_request.id
-        ).update(is_active=False, status="declined")
+        ).deactivate(status="declined")
 
         return Response({"detail": "Purchase request accepted"})
 
@@ -18,6 +18,10 @@ jest.mock("@/app/contexts/AuthContext", () => ({
   }),
 }));
 
+jest.mock("@/app/contexts/NotificationContext", () => ({
+  useNotification: () => ({ live: false }),
+}));
+
 jest.mock("@react-navigation/native", () => ({
   useRoute: jest.fn(),
   useFocusEffect: jest.fn((fn) => fn()), // just calls the effect immediately
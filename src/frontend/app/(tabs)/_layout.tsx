@@ -10,13 +10,15 @@ import { useNotification } from "../contexts/NotificationContext";
 // This defines the basic layout of the app after user's logged in
 export default function TabLayout() {
   const { authToken } = useAuth();
-  const { unreadCount, refreshUnreadCount } = useNotification();
+  const { unreadCount, refreshUnreadCount, live } = useNotification();
 
   useEffect(() => {
+    // the user socket pushes the count while it's connected
+    if (live) return;
     refreshUnreadCount();
     const interval = setInterval(refreshUnreadCount, 120000);
     return () => clearInterval(interval);
-  }, []);
+  }, [live]);
 
   return (
     <>
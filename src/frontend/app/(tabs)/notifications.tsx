@@ -23,6 +23,7 @@ export type AppNotification = {
   type: "purchase" | "chat";
   message: string;
   time: string;
+  created_at: string;
 };
 
 const NotificationIcon = ({ type }: { type: AppNotification["type"] }) => {
@@ -1,7 +1,7 @@
 import { useUserStore } from "@/stores/userStore";
 import { ChatRoom, ChatRoomsScreenRouteParams } from "@/types/chat";
 import { RouteProp, useFocusEffect } from "@react-navigation/native";
-import { useCallback, useState } from "react";
+import { useCallback, useRef, useState } from "react";
 import {
   Alert,
   Text,
@@ -44,6 +44,8 @@ const ChatRoomsScreen: React.FC<Props> = ({}) => {
   const BASE_URL = Constants?.expoConfig?.extra?.apiUrl;
   const [rooms, setRooms] = useState<ChatRoom[]>([]);
   const [isRefreshing, setIsRefreshing] = useState<boolean>(false);
+  const [nextPage, setNextPage] = useState<string | null>(null); // URL of the next page of rooms
+  const loadingMore = useRef<boolean>(false); // the next page is on its way
   const { userData } = useUserStore();
   const { authToken } = useAuth();
   const { fetchUnreadCount } = useChatStore(); //for unread messages
@@ -76,6 +78,8 @@ const ChatRoomsScreen: React.FC<Props> = ({}) => {
         );
       });
       setRooms(sortedRooms);
+      // the rooms come a page at a time, most recently active first
+      setNextPage(data.next ?? null);
       if (authToken) {
         fetchUnreadCount(authToken); // get the unread count with the chat rooms
       }
@@ -84,6 +88,35 @@ const ChatRoomsScreen: React.FC<Props> = ({}) => {
     }
   };
 
+  // called when the user scrolls to the end of the list
+  const fetchMoreRooms = async (): Promise<void> => {
+    if (!nextPage || loadingMore.current) return;
+    loadingMore.current = true;
+    try {
+      const cleanToken = authToken?.trim();
+      const response = await api.get(nextPage, {
+        headers: {
+          Authorization: `Bearer ${cleanToken}`,
+          "Content-Type": "application/json",
+          Accept: "application/json",
+        },
+      });
+      const data = response.data;
+      setRooms((prevRooms) => {
+        const known = new Set(prevRooms.map((room) => room.id));
+        return [
+          ...prevRooms,
+          ...data.rooms.filter((room: ChatRoom) => !known.has(room.id)),
+        ];
+      });
+      setNextPage(data.next ?? null);
+    } catch (error) {
+      console.error("Error fetching more rooms:", error);
+    } finally {
+      loadingMore.current = false;
+    }
+  };
+
   const handleRefresh = async (): Promise<void> => {
     setIsRefreshing(true);
     await fetchRooms();
@@ -235,6 +268,8 @@ const ChatRoomsScreen: React.FC<Props> = ({}) => {
           renderItem={renderRoom}
           keyExtractor={(item) => item?.id.toString()}
           style={styles.roomList}
+          onEndReached={fetchMoreRooms}
+          onEndReachedThreshold={0.5}
           contentContainerStyle={
             rooms.length === 0 ? styles.emptyList : undefined
           }
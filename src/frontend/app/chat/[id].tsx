@@ -35,6 +35,9 @@ const ChatScreen = () => {
   const [messages, setMessages] = useState<Message[]>([]); // state for all messagees in the chat
   const [messageText, setMessageText] = useState<string>(""); // state for the actual content of a message
   const [connected, setConnected] = useState<boolean>(false); // state for whether websocket is connected
+  const [hasOlder, setHasOlder] = useState<boolean>(false); // whether older messages are left to load
+  const loadingOlder = useRef<boolean>(false); // a page of older messages is on its way
+  const keepScroll = useRef<boolean>(false); // don't jump to the end for a page of older messages
   const ws = useRef<WebSocket | null>(null); // react ref for websocket needed for chatting w/ persistent connection
   const flatListRef = useRef<FlatList | null>(null); // react ref for interacting with FlatList
   const authToken = useAuth(); // auth token
@@ -47,8 +50,9 @@ const ChatScreen = () => {
     const baseUrlObj = new URL(BASE_URL);
     const host = baseUrlObj.host; // this includes hostname and port
 
-    // construct WebSocket URL with trailing slash
-    socketUrl = `ws://${host}/ws/chat/${roomId}/`;
+    // construct WebSocket URL with trailing slash, authenticated with our JWT
+    const token = encodeURIComponent(authToken.authToken?.trim() ?? "");
+    socketUrl = `ws://${host}/ws/chat/${roomId}/?token=${token}`;
 
     //setup event handlers for websocket connection
     ws.current = new WebSocket(socketUrl);
@@ -57,6 +61,8 @@ const ChatScreen = () => {
     };
     ws.current.onmessage = (e) => {
       const data = JSON.parse(e.data) as WebSocketMessage;
+      // only chat messages go in the list, other events (e.g. read receipts) carry a type
+      if (data.type && data.type !== "chat_message") return;
       // update state for messages when user receives a message
       setMessages((prevMessages) => [
         ...prevMessages,
@@ -112,33 +118,54 @@ const ChatScreen = () => {
     }
   };
 
+  // the history comes a page at a time, the latest first: `before` asks for the page
+  // before the message with that id
+  const getHistoryPage = async (before?: string) => {
+    const cleanToken = authToken.authToken?.trim();
+    const response = await api.get(`${BASE_URL}/api/chat/history/${roomId}/`, {
+      params: before ? { before } : {},
+      headers: {
+        Authorization: `Bearer ${cleanToken}`,
+        "Content-Type": "application/json",
+        Accept: "application/json",
+      },
+    });
+    setHasOlder(Boolean(response.data.has_older));
+    // Transform the data to ensure consistent format
+    return response.data.messages.map((msg: any) => ({
+      id: msg.id.toString(),
+      content: msg.content,
+      userId: msg.sender?.id?.toString() || "",
+      username: msg.sender?.username || "Unknown",
+      timestamp: msg.timestamp,
+    })) as Message[];
+  };
+
   const fetchChatHistory = async (): Promise<void> => {
     try {
-      const cleanToken = authToken.authToken?.trim();
-      const response = await api.get(
-        `${BASE_URL}/api/chat/history/${roomId}/`,
-        {
-          headers: {
-            Authorization: `Bearer ${cleanToken}`,
-            "Content-Type": "application/json",
-            Accept: "application/json",
-          },
-        }
-      );
-      // Transform the data to ensure consistent format
-      const transformedMessages = response.data.messages.map((msg: any) => ({
-        id: msg.id.toString(),
-        content: msg.content,
-        userId: msg.sender?.id?.toString() || "",
-        username: msg.sender?.username || "Unknown",
-        timestamp: msg.timestamp,
-      }));
-      setMessages(transformedMessages);
+      setMessages(await getHistoryPage());
     } catch (error) {
       console.error("Error fetching chat history:", error);
     }
   };
 
+  // called when the user scrolls back to the top of the list
+  const fetchOlderMessages = async (): Promise<void> => {
+    // the oldest message in the list always comes from the history, so it has a real id
+    const oldest = messages[0];
+    if (!hasOlder || loadingOlder.current || !oldest) return;
+    loadingOlder.current = true;
+    try {
+      const older = await getHistoryPage(oldest.id);
+      keepScroll.current = true;
+      setMessages((prevMessages) => [...older, ...prevMessages]);
+    } catch (error) {
+      console.error("Error fetching older messages:", error);
+    } finally {
+      loadingOlder.current = false;
+    }
+  };
+
   const sendMessage = (): void => {
     if (messageText.trim() === "" || !connected || !ws.current) return;
     const messageData: WebSocketMessage = {
@@ -237,7 +264,15 @@ const ChatScreen = () => {
             renderItem={renderMessage}
             keyExtractor={(item) => item?.id}
             style={styles.messageList}
+            onStartReached={fetchOlderMessages}
+            onStartReachedThreshold={0.1}
+            // older messages go in above what the user is looking at
+            maintainVisibleContentPosition={{ minIndexForVisible: 0 }}
             onContentSizeChange={() => {
+              if (keepScroll.current) {
+                keepScroll.current = false;
+                return;
+              }
               if (flatListRef.current) {
                 flatListRef.current.scrollToEnd({ animated: true });
               }
@@ -1,12 +1,24 @@
 import { NotificationContextType } from "@/types/types";
-import React, { createContext, useContext, useEffect, useState } from "react";
+import React, {
+  createContext,
+  useContext,
+  useEffect,
+  useRef,
+  useState,
+} from "react";
 import { useAuth } from "./AuthContext";
 import { notificationsApi } from "@/services/notificationsApi";
+import { useChatStore } from "@/stores/chatStore";
+import Constants from "expo-constants";
+
+const BASE_URL = Constants?.expoConfig?.extra?.apiUrl;
+const RECONNECT_DELAY = 5000; // ms before reopening a dropped user socket
 
 const NotificationContext = createContext<NotificationContextType>({
   unreadCount: 0,
   refreshUnreadCount: () => {},
   resetUnreadCount: () => {},
+  live: false,
 });
 
 export const NotificationProvider = ({
@@ -16,6 +28,8 @@ export const NotificationProvider = ({
 }) => {
   const { authToken } = useAuth();
   const [unreadCount, setUnreadCount] = useState(0);
+  const [live, setLive] = useState(false); // whether the user socket is connected
+  const ws = useRef<WebSocket | null>(null);
 
   const refreshUnreadCount = async () => {
     if (!authToken) return;
@@ -33,9 +47,57 @@ export const NotificationProvider = ({
     refreshUnreadCount();
   }, [authToken]);
 
+  // one socket for every count the app shows, pushed by the backend instead of polled
+  useEffect(() => {
+    if (!authToken) return;
+    let closed = false;
+    let retry: ReturnType<typeof setTimeout> | undefined;
+
+    const connect = () => {
+      const host = new URL(BASE_URL).host;
+      const token = encodeURIComponent(authToken.trim());
+      const socket = new WebSocket(`ws://${host}/ws/user/?token=${token}`);
+      ws.current = socket;
+      socket.onopen = () => setLive(true);
+      socket.onmessage = (e) => {
+        const data = JSON.parse(e.data);
+        const chat = useChatStore.getState();
+        switch (data.type) {
+          case "unread_counts": // sent right after connecting
+            setUnreadCount(data.notifications);
+            chat.setUnreadCount(data.chat);
+            break;
+          case "notification":
+          case "notification_count":
+            setUnreadCount(data.unread_count);
+            break;
+          case "unread_count": // unread chat messages of a room changed
+            if (data.total !== null && data.total !== undefined) {
+              chat.setUnreadCount(data.total);
+            } else {
+              chat.adjustUnreadCount(data.delta);
+            }
+            break;
+        }
+      };
+      socket.onclose = () => {
+        setLive(false);
+        if (!closed) retry = setTimeout(connect, RECONNECT_DELAY);
+      };
+    };
+    connect();
+
+    return () => {
+      closed = true;
+      if (retry) clearTimeout(retry);
+      ws.current?.close();
+      ws.current = null;
+    };
+  }, [authToken]);
+
   return (
     <NotificationContext.Provider
-      value={{ unreadCount, refreshUnreadCount, resetUnreadCount }}
+      value={{ unreadCount, refreshUnreadCount, resetUnreadCount, live }}
     >
       {children}
     </NotificationContext.Provider>
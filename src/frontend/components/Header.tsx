@@ -8,6 +8,7 @@ import React, { useEffect } from "react";
 import { ScreenId } from "@/types/types";
 import { useChatStore } from "@/stores/chatStore";
 import { useAuth } from "@/app/contexts/AuthContext";
+import { useNotification } from "@/app/contexts/NotificationContext";
 import { Badge } from "react-native-paper";
 import { useTheme } from "@/app/contexts/ThemeContext";
 
@@ -21,8 +22,11 @@ const Header: React.FC<HeaderProps> = ({ screenId }) => {
   const route = useRoute();
   const { unreadCount, fetchUnreadCount } = useChatStore();
   const { authToken } = useAuth();
+  const { live } = useNotification();
 
   useEffect(() => {
+    // the user socket pushes the count while it's connected
+    if (live) return;
     if (authToken) {
       fetchUnreadCount(authToken);
     }
@@ -31,7 +35,7 @@ const Header: React.FC<HeaderProps> = ({ screenId }) => {
     }, 120000); // check unread count every minute
 
     return () => clearInterval(intervalId);
-  }, [authToken]); //runs when authToken changes
+  }, [authToken, live]); //runs when authToken changes or the socket connects/drops
 
   // Refresh unread count when screen comes into focus
   React.useCallback(() => {
@@ -1,12 +1,12 @@
 import { AppNotification } from "@/app/(tabs)/notifications";
-import api, { PaginatedResponse } from "@/types/api";
+import api, { CursorPaginatedResponse } from "@/types/api";
 import Constants from "expo-constants";
 
 const BASE_URL = Constants?.expoConfig?.extra?.apiUrl;
 export const notificationsApi = {
   getNotifications: async (type = "all", token: string | null) => {
     // const response = await api.get(`/notifications/?type=${type}`);
-    const response = await api.get<PaginatedResponse<AppNotification>>(
+    const response = await api.get<CursorPaginatedResponse<AppNotification>>(
       `${BASE_URL}/api/notifications/?type=${type}`,
       {
         headers: {
@@ -10,9 +10,11 @@ interface ChatState {
   isLoading: boolean;
   fetchUnreadCount: (token: string | null) => Promise<void>;
   resetUnreadCount: () => void;
+  setUnreadCount: (count: number) => void;
+  adjustUnreadCount: (delta: number) => void;
 }
 
-export const useChatStore = create<ChatState>((set) => ({
+export const useChatStore = create<ChatState>((set, get) => ({
   unreadCount: 0,
   isLoading: false,
 
@@ -37,4 +39,11 @@ export const useChatStore = create<ChatState>((set) => ({
   resetUnreadCount: () => {
     set({ unreadCount: 0 });
   },
+  // counts pushed over the user socket (see NotificationContext)
+  setUnreadCount: (count: number) => {
+    set({ unreadCount: count });
+  },
+  adjustUnreadCount: (delta: number) => {
+    set({ unreadCount: Math.max(get().unreadCount + delta, 0) });
+  },
 }));
@@ -5,6 +5,9 @@ export interface PaginatedResponse<T> {
   results: T[];
 }
 
+// keyset pages (items.pagination.HttpsCursorPagination) have no count
+export type CursorPaginatedResponse<T> = Omit<PaginatedResponse<T>, "count">;
+
 import Toast from "react-native-toast-message";
 import AsyncStorage from "@react-native-async-storage/async-storage";
 // putting this api service so that we don't need another api file
@@ -27,11 +27,13 @@ export interface ChatRoom {
 }
 
 export interface WebSocketMessage {
+  type?: string; // set on events other than chat messages, e.g. "read_receipt"
   message: string;
   user_id?: number;
   receiver_id?: number;
   username?: string;
   timestamp?: string;
+  seq?: number | null; // number of the message in the room, reconnect with ?resume_from=<seq>
 }
 
 export interface ChatScreenRouteParams {
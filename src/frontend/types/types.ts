@@ -67,4 +67,5 @@ export interface NotificationContextType {
   unreadCount: number;
   refreshUnreadCount: () => void;
   resetUnreadCount: () => void;
+  live: boolean; // the user socket is connected, so counts are pushed and need no polling
 }